@@ -7,9 +7,9 @@ import os
 import sys
 import traceback
 import datetime
-import psycopg2
 import re
 import secrets
+import queue
 from flask import Flask, request, send_file, redirect
 from twilio.twiml.messaging_response import MessagingResponse
 
@@ -34,21 +34,44 @@ except Exception as e:
     print(f"📋 Traceback:\n{traceback.format_exc()}")
     bot = None
 
-# === INICIALIZAR BASE DE DATOS AL INICIAR LA APP ===
-if bot and hasattr(bot, 'inicializar_bd'):
+# === PREPARAR ESQUEMA DE BASE DE DATOS AL INICIAR LA APP ===
+# Normalmente ya lo hizo la fase release (`python bot.py`); aquí solo se
+# confirma la versión y, si falta, se migra bajo advisory lock.
+if bot and hasattr(bot, 'preparar_bd'):
     try:
-        if bot.inicializar_bd():
-            print("✅ Base de datos inicializada al arrancar la app.")
+        if bot.preparar_bd():
+            print("✅ Esquema de base de datos al día.")
         else:
-            print("⚠️ La inicialización de la base de datos falló o ya estaba lista.")
+            print("⚠️ No se pudo preparar el esquema de la base de datos.")
     except Exception as e:
-        print(f"❌ Error al inicializar BD al inicio: {e}")
+        print(f"❌ Error al preparar BD al inicio: {e}")
         print(traceback.format_exc())
 else:
-    print("⚠️ Módulo 'bot' no disponible para inicializar BD al inicio.")
+    print("⚠️ Módulo 'bot' no disponible para preparar BD al inicio.")
 
 app = Flask(__name__)
 
+# === MODO DEL WEBHOOK ===
+# "sincrono" (por defecto): procesa el mensaje y responde en el TwiML.
+# "asincrono": encola, responde TwiML vacío al instante y la respuesta sale
+# por la API de Twilio desde un pool de hilos (ver mensajeria.py).
+# "cola": guarda el mensaje en inbound_messages y lo procesa worker.py;
+# sobrevive a reinicios y escala agregando procesos worker.
+# Los dos últimos envían por la API: sin credenciales de Twilio no arrancan
+# (MENSAJERIA_LOCAL=1 usa el stub en memoria, solo para desarrollo).
+import mensajeria
+WEBHOOK_MODO = os.environ.get("WEBHOOK_MODO", "sincrono").strip().lower()
+procesador = None
+MENSAJE_OCUPADO = "⏳ Estamos recibiendo muchos mensajes. Reenvía tu mensaje en un minuto, por favor."
+if WEBHOOK_MODO == "asincrono" and bot is not None:
+    procesador = mensajeria.ProcesadorAsincrono(
+        bot.procesar_mensaje_idempotente,
+        mensajeria.crear_cliente_mensajes(),
+        hilos=int(os.environ.get("WEBHOOK_HILOS", "4")),
+        max_pendientes=int(os.environ.get("WEBHOOK_MAX_PENDIENTES", "1000"))
+    )
+    print(f"✅ Webhook en modo asíncrono ({os.environ.get('WEBHOOK_HILOS', '4')} hilos)")
+
 # === RUTA PRINCIPAL ===
 @app.route("/")
 def home():
@@ -72,8 +95,36 @@ def webhook():
         r.message("❌ Error interno: módulo 'bot' no disponible")
         return str(r)
 
+    message_sid = request.form.get("MessageSid") or None
+
+    if WEBHOOK_MODO == "cola":
+        try:
+            bot.encolar_mensaje_entrante(sender, incoming_msg, message_sid)
+            print("📥 [WEBHOOK] Mensaje guardado en la cola durable")
+            return str(MessagingResponse())
+        except Exception as e:
+            # Igual que con la cola asíncrona llena: procesarlo en línea lo
+            # adelantaría a los mensajes del remitente que ya esperan en inbound_messages
+            print(f"⚠️ [WEBHOOK] No se pudo encolar ({e}), se pide reenviar el mensaje")
+            r = MessagingResponse()
+            r.message(MENSAJE_OCUPADO)
+            return str(r)
+
+    if procesador is not None:
+        try:
+            procesador.encolar(sender, incoming_msg, message_sid)
+            print("📥 [WEBHOOK] Mensaje encolado, respuesta por API")
+            return str(MessagingResponse())
+        except queue.Full:
+            # No se procesa en línea: adelantaría a los mensajes del mismo
+            # remitente que ya esperan en su cola y rompería el orden FIFO
+            print("⚠️ [WEBHOOK] Cola llena, se pide reenviar el mensaje")
+            r = MessagingResponse()
+            r.message(MENSAJE_OCUPADO)
+            return str(r)
+
     try:
-        respuesta = bot.procesar_mensaje_whatsapp(incoming_msg, remitente=sender)
+        respuesta, duplicado = bot.procesar_mensaje_idempotente(incoming_msg, remitente=sender, message_sid=message_sid)
         print(f"✅ RESPUESTA GENERADA: {respuesta}")
     except Exception as e:
         print(f"❌ ERROR EN FUNCION: {type(e).__name__}: {e}")
@@ -81,7 +132,9 @@ def webhook():
         respuesta = "❌ Hubo un error al procesar tu mensaje. Intenta más tarde."
 
     r = MessagingResponse()
-    r.message(respuesta)
+    # Reintento cuyo primer intento sigue en curso: no se responde dos veces
+    if respuesta:
+        r.message(respuesta)
     print("📤 [WEBHOOK] Enviando respuesta a Twilio")
     return str(r)
 
@@ -153,11 +206,7 @@ def activar_finca_con_empleados():
         return "❌ Máximo 3 empleados permitidos.", 400
 
     try:
-        database_url = os.environ.get("DATABASE_URL")
-        if not database_url:
-            return "❌ DATABASE_URL no configurada", 500
-
-        with psycopg2.connect(database_url) as conn:
+        with bot.obtener_conexion() as conn:
             with conn.cursor() as cur:
                 clave_secreta = secrets.token_urlsafe(16)
                 
@@ -188,6 +237,11 @@ def activar_finca_con_empleados():
                     """, (emp, "Empleado", finca_id))
 
                 conn.commit()
+
+        # Dueño y empleados pudieron cambiar de finca o de suscripción
+        bot.invalidar_usuario_cache(finca_id=finca_id)
+        for telefono in [dueno_formateado] + lista_empleados:
+            bot.invalidar_usuario_cache(telefono=telefono)
         
         empleados_txt = ", ".join(lista_empleados) if lista_empleados else "ninguno"
         url_dashboard = f"https://finca-bot-ukhk.onrender.com/finca/{clave_secreta}"
@@ -206,10 +260,6 @@ def activar_finca_con_empleados():
 @app.route("/finca/<clave>")
 def dashboard_finca(clave):
     try:
-        database_url = os.environ.get("DATABASE_URL")
-        if not database_url:
-            return "❌ DATABASE_URL no configurada", 500
-        
         hoy = datetime.date.today()
         
         # === OBTENER TODOS LOS FILTROS ===
@@ -243,9 +293,9 @@ def dashboard_finca(clave):
             fecha_inicio = hoy.replace(day=1)
             fecha_fin = hoy
         
-        filtro_fecha_params = (fecha_inicio.isoformat(), fecha_fin.isoformat())
+        filtro_fecha_params = (fecha_inicio, fecha_fin)
         
-        with psycopg2.connect(database_url) as conn:
+        with bot.obtener_conexion() as conn:
             with conn.cursor() as cur:
                 cur.execute("SELECT nombre, id FROM fincas WHERE clave_secreta = %s", (clave,))
                 finca_row = cur.fetchone()
@@ -254,6 +304,13 @@ def dashboard_finca(clave):
                 
                 nombre_finca, finca_id = finca_row
                 
+                # === CACHÉ POR VERSIÓN DE DATOS: SIN ESCRITURAS NUEVAS, LA MISMA PÁGINA ===
+                version_datos = bot.version_finca(cur, finca_id)
+                clave_cache = ("dashboard", hoy, request.query_string.decode())
+                html_cacheado = bot.resultado_en_cache(finca_id, version_datos, clave_cache)
+                if html_cacheado is not None:
+                    return html_cacheado
+                
                 # === OBTENER VALORES ÚNICOS PARA LOS FILTROS (DROPDOWNS) ===
                 cur.execute("""
                     SELECT DISTINCT especie FROM animales
@@ -293,6 +350,9 @@ def dashboard_finca(clave):
                 cur.execute(inventario_query, tuple(inventario_params))
                 inventario = cur.fetchall()
                 
+                # === GANANCIA DIARIA DE PESO (CON FILTROS) ===
+                ganancias = bot.consultar_ganancia_diaria(cur, finca_id, especie_filter or None, corral_filter or None)
+                
                 # === CONTAR ANIMALES POR ESPECIE ===
                 cur.execute("""
                     SELECT especie, COUNT(*)
@@ -313,16 +373,25 @@ def dashboard_finca(clave):
                         a.peso,
                         a.corral,
                         a.estado,
-                        (SELECT sa.fecha || ' | ' || sa.tratamiento FROM salud_animal sa
-                         WHERE sa.id_externo = a.id_externo AND sa.tipo = 'vacuna'
-                         ORDER BY sa.fecha DESC LIMIT 1) AS ultima_vacuna,
-                        (SELECT sa.fecha || ' | ' || sa.tratamiento FROM salud_animal sa
-                         WHERE sa.id_externo = a.id_externo AND sa.tipo = 'desparasitación'
-                         ORDER BY sa.fecha DESC LIMIT 1) AS ultima_desparasitacion,
-                        (SELECT sa.fecha || ' | ' || sa.tratamiento FROM salud_animal sa
-                         WHERE sa.id_externo = a.id_externo AND sa.tipo = 'reproducción'
-                         ORDER BY sa.fecha DESC LIMIT 1) AS ultima_reproduccion
+                        vac.fecha, vac.tratamiento,
+                        desp.fecha, desp.tratamiento,
+                        rep.fecha, rep.tratamiento
                     FROM animales a
+                    LEFT JOIN LATERAL (
+                        SELECT sa.fecha, sa.tratamiento FROM salud_animal sa
+                        WHERE sa.id_externo = a.id_externo AND sa.tipo = 'vacuna'
+                        ORDER BY sa.fecha DESC LIMIT 1
+                    ) vac ON TRUE
+                    LEFT JOIN LATERAL (
+                        SELECT sa.fecha, sa.tratamiento FROM salud_animal sa
+                        WHERE sa.id_externo = a.id_externo AND sa.tipo = 'desparasitación'
+                        ORDER BY sa.fecha DESC LIMIT 1
+                    ) desp ON TRUE
+                    LEFT JOIN LATERAL (
+                        SELECT sa.fecha, sa.tratamiento FROM salud_animal sa
+                        WHERE sa.id_externo = a.id_externo AND sa.tipo = 'reproducción'
+                        ORDER BY sa.fecha DESC LIMIT 1
+                    ) rep ON TRUE
                     WHERE a.finca_id = %s AND a.estado = 'activo'
                 """
                 sanidad_params = [finca_id]
@@ -342,7 +411,7 @@ def dashboard_finca(clave):
                     FROM registros
                     WHERE finca_id = %s AND fecha BETWEEN %s AND %s
                  """
-                movimientos_params = [finca_id, fecha_inicio.isoformat(), fecha_fin.isoformat()]
+                movimientos_params = [finca_id, fecha_inicio, fecha_fin]
                 if tipo_actividad_filter:
                     movimientos_query += " AND tipo_actividad = %s"
                     movimientos_params.append(tipo_actividad_filter)
@@ -350,23 +419,10 @@ def dashboard_finca(clave):
                 cur.execute(movimientos_query, tuple(movimientos_params))
                 registros = cur.fetchall()
                 
-                # === FINANZAS ===
-                finanzas_query = """
-                    SELECT
-                        SUM(CASE WHEN tipo_actividad IN ('produccion', 'salida_animal') THEN valor ELSE 0 END),
-                        SUM(CASE WHEN tipo_actividad = 'gasto' THEN valor ELSE 0 END) +
-                        SUM(CASE WHEN jornales > 0 THEN valor ELSE 0 END)
-                    FROM registros
-                    WHERE finca_id = %s AND fecha BETWEEN %s AND %s
-                """
-                finanzas_params = [finca_id, fecha_inicio.isoformat(), fecha_fin.isoformat()]
+                # === FINANZAS (RESUMEN DIARIO: UNA FILA POR DÍA Y TIPO) ===
+                ingresos, gastos, total_movimientos = bot.consultar_finanzas(cur, finca_id, fecha_inicio, fecha_fin)
                 if tipo_actividad_filter:
-                    finanzas_query += " AND tipo_actividad = %s"
-                    finanzas_params.append(tipo_actividad_filter)
-                cur.execute(finanzas_query, tuple(finanzas_params))
-                finanzas = cur.fetchone()
-                ingresos = finanzas[0] or 0
-                gastos = finanzas[1] or 0
+                    ingresos, gastos, _ = bot.consultar_finanzas(cur, finca_id, fecha_inicio, fecha_fin, tipo_actividad_filter)
                 balance = ingresos - gastos
                 
                 # === KPIs ADICIONALES ===
@@ -383,12 +439,6 @@ def dashboard_finca(clave):
                 vencimiento = cur.fetchone()[0]
                 dias_suscripcion = (vencimiento - hoy).days if vencimiento else 0
                 
-                cur.execute("""
-                    SELECT COUNT(*) FROM registros
-                    WHERE finca_id = %s AND fecha BETWEEN %s AND %s
-                """, (finca_id, fecha_inicio.isoformat(), fecha_fin.isoformat()))
-                total_movimientos = cur.fetchone()[0]
-                
                 # === CONTAR FILTROS ACTIVOS ===
                 filtros_activos_count = sum(1 for f in [especie_filter, corral_filter, tipo_actividad_filter] if f)
                 
@@ -400,17 +450,13 @@ def dashboard_finca(clave):
                 def calcular_estado_sanidad(fecha_ultima, dias_vencimiento=30):
                     if not fecha_ultima:
                         return "—"
-                    try:
-                        ultima = datetime.datetime.strptime(fecha_ultima, "%Y-%m-%d").date()
-                        dias_desde = (hoy - ultima).days
-                        if dias_desde <= dias_vencimiento:
-                            return "✅"
-                        elif dias_desde <= dias_vencimiento * 2:
-                            return "⚠️"
-                        else:
-                            return "❌"
-                    except:
-                        return "—"
+                    dias_desde = (hoy - fecha_ultima).days
+                    if dias_desde <= dias_vencimiento:
+                        return "✅"
+                    elif dias_desde <= dias_vencimiento * 2:
+                        return "⚠️"
+                    else:
+                        return "❌"
                 
                 # Banner de estado para eliminaciones
                 eliminado_msg = ""
@@ -825,24 +871,20 @@ def dashboard_finca(clave):
                 </thead>
                 <tbody>
 """
-                for marca, especie, peso, corral, estado, vac, desp, rep in sanidad_animales:
+                for marca, especie, peso, corral, estado, vac_fecha, vac_trat, desp_fecha, desp_trat, rep_fecha, rep_trat in sanidad_animales:
                     especie_txt = "🐮 Bovino" if especie == "bovino" else "🐷 Porcino" if especie == "porcino" else "🦘 Otro"
                     peso_str = f"{peso:.1f} kg" if peso else "—"
                     corral_str = corral or "—"
                     
-                    vac_fecha = vac.split(' | ')[0] if vac and ' | ' in vac else vac
-                    desp_fecha = desp.split(' | ')[0] if desp and ' | ' in desp else desp
-                    rep_fecha = rep.split(' | ')[0] if rep and ' | ' in rep else rep
-                    
                     vac_icon = calcular_estado_sanidad(vac_fecha)
                     desp_icon = calcular_estado_sanidad(desp_fecha)
                     rep_icon = calcular_estado_sanidad(rep_fecha, dias_vencimiento=45)
                     
                     estado_general = "🟢" if estado == "activo" else "🔴"
                     
-                    vac_txt = vac if vac else "—"
-                    desp_txt = desp if desp else "—"
-                    rep_txt = rep if rep else "—"
+                    vac_txt = f"{vac_fecha} | {vac_trat or ''}" if vac_fecha else "—"
+                    desp_txt = f"{desp_fecha} | {desp_trat or ''}" if desp_fecha else "—"
+                    rep_txt = f"{rep_fecha} | {rep_trat or ''}" if rep_fecha else "—"
                     
                     html += f"""
                     <tr>
@@ -909,6 +951,39 @@ def dashboard_finca(clave):
         </div>
     </div>
     
+    <!-- GANANCIA DE PESO - FULL WIDTH -->
+    <h2>📈 Ganancia Diaria de Peso</h2>
+    <div class="tabla-section">
+        <div class="tabla-wrapper">
+            <table>
+                <thead>
+                    <tr>
+                        <th>Corral</th>
+                        <th>Marca</th>
+                        <th>Pesajes</th>
+                        <th>Peso inicial</th>
+                        <th>Peso actual</th>
+                        <th>Días</th>
+                        <th>GDP (kg/día)</th>
+                    </tr>
+                </thead>
+                <tbody>
+"""
+                corral_actual = None
+                for g in ganancias:
+                    if g.corral != corral_actual:
+                        corral_actual = g.corral
+                        html += f"<tr style='background:#f1f8f4;font-weight:600;'><td>{g.corral}</td><td colspan='5'>Promedio del corral ({g.animales_corral} animales)</td><td>{g.gdp_corral:.2f}</td></tr>"
+                    html += f"<tr><td></td><td>{g.marca}</td><td>{g.pesajes}</td><td>{g.peso_inicial:.1f}</td><td>{g.peso_actual:.1f}</td><td>{g.dias}</td><td>{g.gdp:.2f}</td></tr>"
+                if not ganancias:
+                    html += "<tr><td colspan='7' style='text-align: center; color: #6c757d; padding: 30px;'>Aún no hay animales con dos pesajes en días distintos</td></tr>"
+                
+                html += """
+                </tbody>
+            </table>
+        </div>
+    </div>
+    
     <!-- MOVIMIENTOS - FULL WIDTH -->
     <h2>📝 Últimos Movimientos</h2>
     <div class="tabla-section">
@@ -1040,6 +1115,7 @@ def dashboard_finca(clave):
 </body>
 </html>
 """
+                bot.guardar_resultado(finca_id, version_datos, clave_cache, html)
                 return html
     except Exception as e:
         print(f"❌ Error dashboard: {e}")
@@ -1053,10 +1129,7 @@ def mi_finca_id():
     if not telefono:
         return "❌ Usa: /mi-finca-id?telefono=whatsapp:+573143539351", 400
     try:
-        database_url = os.environ.get("DATABASE_URL")
-        if not database_url:
-            return "❌ DATABASE_URL no configurada", 500
-        with psycopg2.connect(database_url) as conn:
+        with bot.obtener_conexion() as conn:
             with conn.cursor() as cur:
                 cur.execute("""
                     SELECT f.id, f.nombre FROM fincas f
@@ -1075,14 +1148,16 @@ def mi_finca_id():
 @app.route("/reiniciar-bd")
 def reiniciar_bd():
     try:
-        database_url = os.environ.get("DATABASE_URL")
-        if not database_url:
-            return "❌ DATABASE_URL no configurada", 500
-        with psycopg2.connect(database_url) as conn:
+        with bot.obtener_conexion() as conn:
             with conn.cursor() as cur:
-                cur.execute("DROP TABLE IF EXISTS registros, salud_animal, animales, usuarios, fincas CASCADE")
+                # finca_version_seq no se borra: las versiones no se repiten tras el reinicio
+                # y los otros procesos no sirven de su caché resultados de la base anterior
+                cur.execute("DROP TABLE IF EXISTS registros, salud_animal, pesajes, finca_resumen_diario, finca_version, reportes_precalculados, animales, usuarios, fincas, schema_version, conversaciones, inbound_messages, mensajes_procesados CASCADE")
                 conn.commit()
         if bot and hasattr(bot, 'inicializar_bd'):
+            bot.invalidar_usuario_cache()
+            bot.limpiar_cache_message_sid()
+            bot.limpiar_cache_resultados()
             if bot.inicializar_bd():
                 return "✅ Base de datos reiniciada.", 200
         return "⚠️ Módulo bot no disponible.", 500
@@ -1100,6 +1175,52 @@ def admin_renovar_suscripcion(telefono):
         return f"<pre>{resultado}</pre>"
     return "❌ Módulo bot no disponible"
 
+# === RUTA: ESTADO DEL POOL DE CONEXIONES (SOLO ADMIN) ===
+@app.route("/admin/pool")
+def admin_estado_pool():
+    """Tamaño del pool y tiempos de espera, para ajustar DB_POOL_* bajo carga."""
+    if bot and hasattr(bot, 'estadisticas_pool'):
+        return bot.estadisticas_pool(), 200
+    return "❌ Módulo bot no disponible", 500
+
+@app.route("/admin/cache")
+def admin_estado_cache():
+    """Tasa de aciertos de la caché de resultados (reportes, dashboard, Excel) y de usuarios."""
+    return {
+        "resultados": bot.estadisticas_cache_resultados(),
+        "usuarios": bot.estadisticas_cache_usuarios(),
+    }, 200
+
+@app.route("/admin/reconstruir-resumen")
+def admin_reconstruir_resumen():
+    """Recalcula finca_resumen_diario desde registros (?finca_id=N para una sola finca)."""
+    finca_id = request.args.get("finca_id", type=int)
+    try:
+        filas = bot.reconstruir_resumen_diario(finca_id)
+    except Exception as e:
+        return f"❌ Error: {e}", 500
+    return {"finca_id": finca_id, "filas": filas}, 200
+
+@app.route("/admin/webhook")
+def admin_estado_webhook():
+    """Modo del webhook, cola y latencia de respuesta, y lotes del group commit de registros."""
+    datos = {"modo": WEBHOOK_MODO}
+    if procesador is not None:
+        datos.update(procesador.estadisticas())
+    if WEBHOOK_MODO == "cola" and bot is not None:
+        try:
+            datos["cola"] = bot.estadisticas_cola()
+        except Exception as e:
+            return f"❌ Error: {e}", 500
+    if bot is not None:
+        datos["registros_agrupados"] = bot.estadisticas_escritura_agrupada()
+    return datos, 200
+
+def _respuesta_excel(contenido, filename):
+    from io import BytesIO
+    return send_file(BytesIO(contenido), mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+                    as_attachment=True, download_name=filename)
+
 # === RUTA: EXPORTAR A EXCEL (CON PESTAÑA DE SANIDAD ANIMAL) ===
 @app.route("/finca/<clave>/exportar-excel")
 def exportar_finca_excel(clave):
@@ -1107,10 +1228,6 @@ def exportar_finca_excel(clave):
         import pandas as pd
         from io import BytesIO
         
-        database_url = os.environ.get("DATABASE_URL")
-        if not database_url:
-            return "❌ DATABASE_URL no configurada", 500
-
         fecha_inicio_str = request.args.get("fecha_inicio")
         fecha_fin_str = request.args.get("fecha_fin")
         hoy = datetime.date.today()
@@ -1126,13 +1243,21 @@ def exportar_finca_excel(clave):
             fecha_inicio = hoy.replace(day=1)
             fecha_fin = hoy
 
-        with psycopg2.connect(database_url) as conn:
+        with bot.obtener_conexion() as conn:
             cur = conn.cursor()
             cur.execute("SELECT nombre, id FROM fincas WHERE clave_secreta = %s", (clave,))
             finca_row = cur.fetchone()
             if not finca_row:
                 return "❌ Acceso denegado.", 403
             nombre_finca, finca_id = finca_row
+            filename = f"Finca_{nombre_finca.replace(' ','_')}_{hoy.strftime('%Y%m%d')}.xlsx"
+
+            # === 0. CACHÉ POR VERSIÓN DE DATOS ===
+            version_datos = bot.version_finca(cur, finca_id)
+            clave_cache = ("excel", fecha_inicio, fecha_fin, hoy)
+            contenido = bot.resultado_en_cache(finca_id, version_datos, clave_cache)
+            if contenido is not None:
+                return _respuesta_excel(contenido, filename)
 
             # === 1. INVENTARIO DE ANIMALES (sin filtro de fecha) ===
             df_animales = pd.read_sql_query("""
@@ -1149,7 +1274,7 @@ def exportar_finca_excel(clave):
                 SELECT fecha, tipo_actividad AS tipo, detalle, lugar, cantidad, valor, observacion, jornales
                 FROM registros WHERE finca_id = %s AND fecha BETWEEN %s AND %s
                 ORDER BY fecha DESC LIMIT 500
-            """, conn, params=(finca_id, fecha_inicio.isoformat(), fecha_fin.isoformat()))
+            """, conn, params=(finca_id, fecha_inicio, fecha_fin))
 
             # === 3. SANIDAD ANIMAL (NUEVO - CON filtro de fechas) ===
             df_sanidad = pd.read_sql_query("""
@@ -1164,17 +1289,10 @@ def exportar_finca_excel(clave):
                 LEFT JOIN animales a ON sa.id_externo = a.id_externo
                 WHERE sa.finca_id = %s AND sa.fecha BETWEEN %s AND %s
                 ORDER BY sa.fecha DESC
-            """, conn, params=(finca_id, fecha_inicio.isoformat(), fecha_fin.isoformat()))
+            """, conn, params=(finca_id, fecha_inicio, fecha_fin))
 
             # === 4. FINANZAS (CON filtro de fechas) ===
-            cur.execute("""
-                SELECT
-                    COALESCE(SUM(CASE WHEN tipo_actividad IN ('produccion', 'salida_animal') THEN valor ELSE 0 END), 0),
-                    COALESCE(SUM(CASE WHEN tipo_actividad = 'gasto' THEN valor ELSE 0 END) + 
-                    SUM(CASE WHEN jornales > 0 THEN valor ELSE 0 END), 0)
-                FROM registros WHERE finca_id = %s AND fecha BETWEEN %s AND %s
-            """, (finca_id, fecha_inicio.isoformat(), fecha_fin.isoformat()))
-            finanzas = cur.fetchone()
+            finanzas = bot.consultar_finanzas(cur, finca_id, fecha_inicio, fecha_fin)
             cur.close()
 
         # === CREAR ARCHIVO EXCEL ===
@@ -1204,10 +1322,9 @@ def exportar_finca_excel(clave):
             if not df_sanidad.empty:
                 df_sanidad.to_excel(writer, sheet_name='💉 Sanidad Animal', index=False)
 
-        output.seek(0)
-        filename = f"Finca_{nombre_finca.replace(' ','_')}_{hoy.strftime('%Y%m%d')}.xlsx"
-        return send_file(output, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-                        as_attachment=True, download_name=filename)
+        contenido = output.getvalue()
+        bot.guardar_resultado(finca_id, version_datos, clave_cache, contenido)
+        return _respuesta_excel(contenido, filename)
 
     except ImportError:
         return "❌ Librerías Excel no instaladas.", 500
@@ -1222,11 +1339,7 @@ def exportar_finca_excel(clave):
 @app.route("/finca/<clave>/ingreso-manual")
 def ingreso_manual_datos(clave):
     try:
-        database_url = os.environ.get("DATABASE_URL")
-        if not database_url:
-            return "❌ DATABASE_URL no configurada", 500
-        
-        with psycopg2.connect(database_url) as conn:
+        with bot.obtener_conexion() as conn:
             with conn.cursor() as cur:
                 cur.execute("SELECT nombre, id FROM fincas WHERE clave_secreta = %s", (clave,))
                 finca_row = cur.fetchone()
@@ -1583,6 +1696,14 @@ def ingreso_manual_datos(clave):
                             <small>Si seleccionas un animal, se completará automáticamente en la observación</small>
                         </div>
                         
+                        <div class="form-group" id="group-subtipo-salida" style="display: none;">
+                            <label>🐄 Motivo de la Salida</label>
+                            <select name="subtipo" id="subtipo">
+                                <option value="venta">💸 Venta</option>
+                                <option value="muerte">🪦 Muerte</option>
+                            </select>
+                        </div>
+                        
                         <div class="form-row">
                             <div class="form-group">
                                 <label>⚖️ Peso Promedio (kg)</label>
@@ -1684,6 +1805,7 @@ def ingreso_manual_datos(clave):
             if (['ingreso_animal', 'salida_animal'].includes(tipo)) {{
                 camposAnimales.classList.add('activo');
             }}
+            document.getElementById('group-subtipo-salida').style.display = tipo === 'salida_animal' ? 'block' : 'none';
             if (tipo === 'sanidad_animal') {{
                 camposAnimales.classList.add('activo');
                 camposSanidad.classList.add('activo');
@@ -1759,13 +1881,8 @@ def ingreso_manual_datos(clave):
 @app.route("/finca/<clave>/guardar-manual", methods=["POST"])
 def guardar_manual_datos(clave):
     try:
-        database_url = os.environ.get("DATABASE_URL")
-        if not database_url:
-            logger.error("❌ DATABASE_URL no configurada")
-            return "❌ DATABASE_URL no configurada", 500
-        
         # === 1. VALIDAR FINCA Y USUARIO ===
-        with psycopg2.connect(database_url) as conn:
+        with bot.obtener_conexion() as conn:
             with conn.cursor() as cur:
                 cur.execute("SELECT nombre, id FROM fincas WHERE clave_secreta = %s", (clave,))
                 finca_row = cur.fetchone()
@@ -1825,113 +1942,55 @@ def guardar_manual_datos(clave):
         # === 4. TRANSACCIÓN ÚNICA PARA TODAS LAS OPERACIONES (MEJORA #2) ===
         animales_registrados = 0
         animales_vendidos = 0
+        etiqueta_salida = "💸 Vendidos"
         
-        with psycopg2.connect(database_url) as conn:  # UNA SOLA CONEXIÓN
+        with bot.obtener_conexion() as conn:  # UNA SOLA CONEXIÓN
             with conn.cursor() as cur:
                 # 4.1 Guardar Registro Principal
-                fecha_hoy = datetime.date.today().isoformat()
-                fecha_registro = datetime.datetime.now().isoformat()
-                mensaje_completo = f"{detalle} {lugar} {observacion}".strip()
-                
-                cur.execute('''
-                    INSERT INTO registros 
-                    (fecha, tipo_actividad, accion, detalle, lugar, cantidad, valor, unidad, observacion, jornales, fecha_registro, finca_id, usuario_id)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                ''', (
-                    fecha_hoy, tipo, tipo, detalle, lugar, cantidad, valor, "manual_web", observacion, jornales, fecha_registro, finca_id, usuario_id
-                ))
-                logger.info(f"✅ Registro principal guardado: {tipo} - {detalle}")
+                registro_id = bot.guardar_registro(
+                    tipo, tipo, detalle, lugar, cantidad, valor, "manual_web", observacion, jornales,
+                    finca_id=finca_id, usuario_id=usuario_id, cursor=cur
+                )
+                logger.info(f"✅ Registro principal guardado (id {registro_id}): {tipo} - {detalle}")
                 
                 # 4.2 Procesar Ingreso de Animales (si aplica)
                 if tipo == "ingreso_animal" and observacion:
-                    marcas = re.findall(r"marca\s+([a-z0-9-]+)", observacion, re.IGNORECASE)
-                    for marca in marcas:
-                        marca_upper = marca.upper()
-                        peso_valor = None
-                        pattern = r"marca\s+" + re.escape(marca) + r".*?peso\s*(\d+(?:\.\d+)?)\s*kg"
-                        peso_match = re.search(pattern, observacion, re.IGNORECASE)
-                        if peso_match:
-                            peso_valor = float(peso_match.group(1))
-                        
-                        especie = "bovino"
-                        if any(p in detalle.lower() for p in ["cerdo", "lechón", "cerda", "chancho", "porcino"]):
-                            especie = "porcino"
-                        
-                        categoria = None
-                        if "ternera" in detalle.lower(): categoria = "ternera"
-                        elif "ternero" in detalle.lower(): categoria = "ternero"
-                        elif "vaca" in detalle.lower(): categoria = "vaca"
-                        elif "toro" in detalle.lower(): categoria = "toro"
-                        elif "lechón" in detalle.lower(): categoria = "lechón"
-                        elif "cerda" in detalle.lower(): categoria = "cerda"
-                        
-                        cur.execute("""
-                            INSERT INTO animales (especie, id_externo, marca_o_arete, categoria, corral, estado, peso, finca_id)
-                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                            ON CONFLICT (id_externo) DO UPDATE
-                            SET peso = EXCLUDED.peso, estado = EXCLUDED.estado, categoria = EXCLUDED.categoria
-                        """, (
-                            especie,
-                            f"V-M-{marca_upper}" if especie == "bovino" else f"C-{marca_upper}",
-                            marca_upper,
-                            categoria,
-                            lugar,
-                            "activo",
-                            peso_valor,
-                            finca_id
-                        ))
-                        animales_registrados += 1
-                        logger.info(f"🐮 Animal registrado: {marca_upper}")
+                    clasificacion = bot.clasificar_texto(detalle)
+                    especie = clasificacion.especie or "bovino"
+                    marcas_guardadas, errores_ingreso = bot.upsert_animales(
+                        cur, bot.extraer_marcas(observacion), especie, clasificacion.categoria, lugar, finca_id
+                    )
+                    animales_registrados = len(marcas_guardadas)
+                    logger.info(f"🐮 Animales registrados: {', '.join(marcas_guardadas)}")
+                    for error in errores_ingreso:
+                        logger.warning(f"⚠️ {error}")
                 
                 # 4.3 Procesar Salida/Venta de Animales (si aplica)
                 if tipo == "salida_animal" and observacion:
-                    marcas = re.findall(r"marca\s+([a-z0-9-]+)", observacion, re.IGNORECASE)
-                    marcas = [m.upper() for m in marcas]
-                    for marca in marcas:
-                        try:
-                            cur.execute("""
-                                SELECT id_externo FROM animales
-                                WHERE (marca_o_arete = %s OR id_externo LIKE %s)
-                                AND finca_id = %s AND estado = 'activo'
-                            """, (marca, f"%{marca}%", finca_id))
-                            row = cur.fetchone()
-                            if row:
-                                id_externo = row[0]
-                                cur.execute("""
-                                    UPDATE animales SET estado = 'vendido', observaciones = %s WHERE id_externo = %s
-                                """, (f"Vendido: {detalle} - {observacion}", id_externo))
-                                animales_vendidos += 1
-                                logger.info(f"💸 Animal vendido: {marca}")
-                        except Exception as e:
-                            logger.warning(f"⚠️ Error venta {marca}: {e}")
+                    marcas = [animal.marca for animal in bot.extraer_marcas(observacion)]
+                    # El formulario trae el motivo; sin él, el mismo vocabulario del flujo de WhatsApp
+                    subtipo_salida = request.form.get("subtipo", "")
+                    if subtipo_salida not in bot.ESTADOS_SALIDA:
+                        subtipo_salida = bot.resolver_subtipo(tipo, f"{detalle} {observacion}") or "venta"
+                    estado_salida = bot.ESTADOS_SALIDA[subtipo_salida]
+                    etiqueta_salida = "💸 Vendidos" if subtipo_salida == "venta" else "🪦 Muertos"
+                    nota = f"{'Vendido' if subtipo_salida == 'venta' else 'Muerte'}: {detalle} - {observacion}"
+                    encontradas, faltantes = bot.registrar_salida_animales(cur, marcas, estado_salida, nota, finca_id)
+                    animales_vendidos = len(encontradas)
+                    logger.info(f"💸 Animales dados de baja ({estado_salida}): {', '.join(encontradas)}")
+                    for marca in faltantes:
+                        logger.warning(f"⚠️ Animal {marca} no encontrado o ya no está activo")
                 
                 # 4.4 Procesar Sanidad Animal (si aplica)
                 if tipo == "sanidad_animal" and observacion:
-                    detalle_lower = detalle.lower()
-                    tipo_sanidad = "sanidad"
-                    if any(kw in detalle_lower for kw in ["vacuna", "vacunacion", "vacunación", "aftosa", "carbon", "carbón", "brucelosis","peste"]):
-                        tipo_sanidad = "vacuna"
-                    elif any(kw in detalle_lower for kw in ["desparasit", "lavado"," lombriz", "purga", " purgante", "nuche", "vitamin" "garrapata", "gusano"]):
-                        tipo_sanidad = "desparasitación"
-                    elif any(kw in detalle_lower for kw in ["monta", "insemin", "preñez", "celo", "reproduccion", "reproducción", "inseminacion", "servicio"]):
-                        tipo_sanidad = "reproducción"
+                    tipo_sanidad = bot.clasificar_texto(detalle).tipo_sanidad
                     
-                    marcas = re.findall(r"marca\s+([a-z0-9-]+)", observacion, re.IGNORECASE)
-                    marcas = [m.upper() for m in marcas]
-                    
-                    for marca in marcas:
-                        try:
-                            cur.execute("SELECT id_externo FROM animales WHERE (marca_o_arete = %s OR id_externo LIKE %s) AND finca_id = %s", (marca, f"%{marca}%", finca_id))
-                            row = cur.fetchone()
-                            if row:
-                                id_externo = row[0]
-                                cur.execute("""
-                                    INSERT INTO salud_animal (id_externo, tipo, tratamiento, fecha, observacion, finca_id)
-                                    VALUES (%s, %s, %s, %s, %s, %s)
-                                """, (id_externo, tipo_sanidad, detalle, fecha_hoy, observacion, finca_id))
-                                logger.info(f"💉 Sanidad guardada: {marca} - {tipo_sanidad}")
-                        except Exception as e:
-                            logger.warning(f"⚠️ Error sanidad {marca}: {e}")
+                    tratadas, faltantes = bot.registrar_sanidad_animales(
+                        cur, bot.extraer_marcas(observacion), tipo_sanidad, detalle, observacion, finca_id
+                    )
+                    logger.info(f"💉 Sanidad guardada ({tipo_sanidad}): {', '.join(tratadas)}")
+                    for marca in faltantes:
+                        logger.warning(f"⚠️ Animal {marca} no encontrado para sanidad")
                 
                 # 4.5 COMMIT ÚNICO AL FINAL (TODO O NADA)
                 conn.commit()
@@ -1973,7 +2032,7 @@ def guardar_manual_datos(clave):
                 <div class="info-row"><span>📍 Lugar</span><span>{lugar if lugar else '—'}</span></div>
                 <div class="info-row"><span>📅 Fecha</span><span>{datetime.date.today().strftime('%d/%m/%Y')}</span></div>
                 {f'<div class="info-row"><span>🐮 Animales</span><span>{animales_registrados} registrados</span></div>' if animales_registrados > 0 else ''}
-                {f'<div class="info-row"><span>💸 Vendidos</span><span>{animales_vendidos} actualizados</span></div>' if animales_vendidos > 0 else ''}
+                {f'<div class="info-row"><span>{etiqueta_salida}</span><span>{animales_vendidos} actualizados</span></div>' if animales_vendidos > 0 else ''}
             </div>
             <div class="acciones">
                 <a href="/finca/{clave}/ingreso-manual" class="btn btn-secondary">📝 Otro Registro</a>
@@ -1994,11 +2053,7 @@ def guardar_manual_datos(clave):
 @app.route("/finca/<clave>/eliminar-registro/<int:id_registro>")
 def eliminar_registro(clave, id_registro):
     try:
-        database_url = os.environ.get("DATABASE_URL")
-        if not database_url:
-            return redirect(f"/finca/{clave}?eliminado=error")
-
-        with psycopg2.connect(database_url) as conn:
+        with bot.obtener_conexion() as conn:
             with conn.cursor() as cur:
                 # 1. Validar que la clave corresponde a una finca real
                 cur.execute("SELECT id FROM fincas WHERE clave_secreta = %s", (clave,))
@@ -2009,7 +2064,7 @@ def eliminar_registro(clave, id_registro):
                 finca_id = finca_row[0]
 
                 # 2. Eliminar SOLO si el registro pertenece a esta finca (protección contra manipulación de URL)
-                cur.execute("DELETE FROM registros WHERE id = %s AND finca_id = %s", (id_registro, finca_id))
+                bot.eliminar_registro(cur, id_registro, finca_id)
                 conn.commit()
                 
         return redirect(f"/finca/{clave}?eliminado=ok")
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+bench_flujo.py - Micro-benchmark del flujo conversacional (no toca la base de datos)
+Uso: python bench_flujo.py [repeticiones] [conversaciones]
+"""
+import sys
+import datetime
+import timeit
+import tracemalloc
+
+import bot
+
+# (nombre, paso, tipo, mensaje)
+CASOS = [
+    ("menú: opción inválida", "waiting_for_category", "", "xyz"),
+    ("menú: 1 siembra", "waiting_for_category", "", "1"),
+    ("menú: labor (última)", "waiting_for_category", "", "labor"),
+    ("subtipo: inventario", "waiting_for_subtipo", "ingreso_animal", "inventario inicial"),
+    ("subtipo: muerte", "waiting_for_subtipo", "salida_animal", "murieron dos"),
+    ("detalle", "waiting_for_detalle", "gasto", "medicina"),
+    ("cantidad", "waiting_for_cantidad", "gasto", "3"),
+    ("unidad", "waiting_for_unidad", "gasto", "frascos"),
+    ("jornales", "waiting_for_jornales", "labor", "2"),
+    ("valor", "waiting_for_valor", "gasto", "50000"),
+    ("lugar", "waiting_for_lugar", "gasto", "bodega"),
+    ("observación", "waiting_for_observacion", "gasto", "fin"),
+]
+
+def medir(repeticiones):
+    resultados = []
+    for nombre, paso, tipo, mensaje in CASOS:
+        state = bot.ConversationState(step=paso, tipo=tipo)
+
+        def paso_unico():
+            state.step = paso
+            bot.iniciar_flujo_conversacional_existente(mensaje, "bench", state)
+
+        tiempos = timeit.repeat(paso_unico, number=repeticiones, repeat=5)
+        resultados.append((nombre, min(tiempos) / repeticiones * 1e6))
+    return resultados
+
+def medir_memoria(conversaciones):
+    """Bytes retenidos por conversación activa (a mitad de flujo) en MemoryConversationStore."""
+    almacen_original = bot.user_state
+    bot.user_state = bot.MemoryConversationStore(max_conversaciones=conversaciones)
+    try:
+        tracemalloc.start()
+        inicio = tracemalloc.get_traced_memory()[0]
+        for i in range(conversaciones):
+            # Cada mensaje trae su propia copia de usuario_info, como obtener_usuario_por_whatsapp
+            usuario_info = {
+                "id": i, "nombre": f"Trabajador {i}", "rol": "empleado",
+                "finca_id": i // 4, "finca_nombre": f"Finca {i // 4}",
+                "suscripcion_activa": True, "vencimiento_suscripcion": datetime.date(2030, 1, 1)
+            }
+            for mensaje in ("6", f"medicina {i}", "3", "frascos"):
+                bot.iniciar_flujo_conversacional_con_finca(mensaje, dict(usuario_info))
+        total = tracemalloc.get_traced_memory()[0] - inicio
+        tracemalloc.stop()
+    finally:
+        bot.user_state = almacen_original
+    return total / conversaciones
+
+if __name__ == "__main__":
+    repeticiones = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    conversaciones = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    resultados = medir(repeticiones)
+    for nombre, micro in resultados:
+        print(f"{nombre:<26} {micro:8.3f} µs")
+    print(f"{'promedio':<26} {sum(m for _, m in resultados) / len(resultados):8.3f} µs")
+    print(f"{'memoria por conversación':<26} {medir_memoria(conversaciones):8.0f} bytes")
@@ -7,7 +7,18 @@ import os
 import psycopg2
 import re
 import datetime
+import json
+import random
+import select
+import threading
+import time
+import zlib
+from collections import OrderedDict, namedtuple
+from dataclasses import dataclass, fields
 from urllib.parse import urlparse
+from psycopg2 import extensions as pg_extensions
+from psycopg2 import pool as pg_pool
+from psycopg2.extras import Json, execute_values
 # === AGREGAR DESPUÉS DE LOS IMPORTS EXISTENTES ===
 import logging
 from contextlib import contextmanager
@@ -33,44 +44,360 @@ def _obtener_database_url():
             raise EnvironmentError("DATABASE_URL no configurada")
     return _DB_URL_CACHE
 
+def _entero_env(nombre, defecto):
+    """Lee un entero de las variables de entorno con valor por defecto."""
+    try:
+        return int(os.environ.get(nombre, defecto))
+    except (TypeError, ValueError):
+        logger.warning(f"⚠️ Valor inválido para {nombre}, usando {defecto}")
+        return defecto
+
+class PoolConexiones:
+    """
+    Pool acotado de conexiones PostgreSQL compartido por todo el proceso.
+
+    - Nunca abre más de `max_conexiones`; si están todas en uso, espera
+      hasta `espera_maxima` segundos antes de lanzar PoolError.
+    - Al entregar una conexión ociosa más de `verificar_tras` segundos
+      la verifica con un SELECT 1 y la reemplaza si está caída.
+    - Recicla las conexiones que superan `edad_maxima` segundos.
+    """
+
+    def __init__(self, dsn, max_conexiones=10, edad_maxima=1800, espera_maxima=10, verificar_tras=30):
+        self._dsn = dsn
+        self.max_conexiones = max_conexiones
+        self.edad_maxima = edad_maxima
+        self.espera_maxima = espera_maxima
+        self.verificar_tras = verificar_tras
+        self._cond = threading.Condition()
+        self._libres = []       # [(conn, creada_en, ultimo_uso)]
+        self._creadas_en = {}   # id(conn) -> creada_en, para conexiones prestadas
+        self._total = 0
+        self._en_uso = 0
+        self._esperando = 0
+        self._stats = {
+            "prestamos": 0,
+            "esperas": 0,
+            "espera_total_ms": 0.0,
+            "espera_max_ms": 0.0,
+            "timeouts": 0,
+            "creadas": 0,
+            "recicladas": 0,
+            "descartadas": 0,
+        }
+
+    def _crear(self):
+        conn = psycopg2.connect(self._dsn)
+        self._stats["creadas"] += 1
+        return conn, time.monotonic()
+
+    def _cerrar(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _es_util(self, conn, creada_en, ultimo_uso):
+        """Verifica edad y salud de una conexión ociosa antes de prestarla."""
+        ahora = time.monotonic()
+        if conn.closed:
+            return False
+        if ahora - creada_en > self.edad_maxima:
+            self._stats["recicladas"] += 1
+            return False
+        if ahora - ultimo_uso > self.verificar_tras:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+                conn.rollback()
+            except Exception as e:
+                logger.warning(f"⚠️ Conexión del pool no responde, se reemplaza: {e}")
+                return False
+        return True
+
+    def obtener(self):
+        """Presta una conexión; bloquea si el pool está lleno."""
+        inicio = time.monotonic()
+        limite = inicio + self.espera_maxima
+        conn = None
+        with self._cond:
+            while True:
+                if self._libres:
+                    conn, creada_en, ultimo_uso = self._libres.pop()
+                    break
+                if self._total < self.max_conexiones:
+                    self._total += 1
+                    break
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    self._stats["timeouts"] += 1
+                    raise pg_pool.PoolError(
+                        f"Pool agotado: {self.max_conexiones} conexiones en uso tras {self.espera_maxima}s"
+                    )
+                self._esperando += 1
+                try:
+                    self._cond.wait(restante)
+                finally:
+                    self._esperando -= 1
+            self._en_uso += 1
+            espera_ms = (time.monotonic() - inicio) * 1000
+            self._stats["prestamos"] += 1
+            if espera_ms >= 1:
+                self._stats["esperas"] += 1
+            self._stats["espera_total_ms"] += espera_ms
+            self._stats["espera_max_ms"] = max(self._stats["espera_max_ms"], espera_ms)
+
+        # La conexión (o la creación) se hace fuera del candado
+        try:
+            if conn is not None and not self._es_util(conn, creada_en, ultimo_uso):
+                self._cerrar(conn)
+                conn = None
+            if conn is None:
+                conn, creada_en = self._crear()
+        except Exception:
+            with self._cond:
+                self._total -= 1
+                self._en_uso -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._creadas_en[id(conn)] = creada_en
+        return conn
+
+    def devolver(self, conn, descartar=False):
+        """Devuelve una conexión al pool; `descartar` la cierra definitivamente."""
+        with self._cond:
+            creada_en = self._creadas_en.pop(id(conn), 0)
+        if not descartar and not conn.closed:
+            try:
+                if conn.get_transaction_status() != pg_extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                if conn.autocommit:
+                    conn.autocommit = False
+            except Exception:
+                descartar = True
+        if not descartar and time.monotonic() - creada_en > self.edad_maxima:
+            self._stats["recicladas"] += 1
+            descartar = True
+        if descartar or conn.closed:
+            self._cerrar(conn)
+        with self._cond:
+            self._en_uso -= 1
+            if descartar or conn.closed:
+                self._total -= 1
+                self._stats["descartadas"] += 1
+            else:
+                self._libres.append((conn, creada_en, time.monotonic()))
+            self._cond.notify()
+
+    def cerrar_todo(self):
+        """Cierra las conexiones libres al apagar el proceso. No sirve tras un fork: ver _pool_tras_fork."""
+        with self._cond:
+            libres, self._libres = self._libres, []
+            self._total -= len(libres)
+        for conn, _, _ in libres:
+            self._cerrar(conn)
+
+    def estadisticas(self):
+        with self._cond:
+            datos = dict(self._stats)
+            datos.update({
+                "max_conexiones": self.max_conexiones,
+                "abiertas": self._total,
+                "en_uso": self._en_uso,
+                "libres": len(self._libres),
+                "esperando": self._esperando,
+            })
+        prestamos = datos["prestamos"] or 1
+        datos["espera_promedio_ms"] = round(datos["espera_total_ms"] / prestamos, 3)
+        datos["espera_total_ms"] = round(datos["espera_total_ms"], 3)
+        datos["espera_max_ms"] = round(datos["espera_max_ms"], 3)
+        return datos
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+def obtener_pool():
+    """Crea (una sola vez por proceso) y retorna el pool de conexiones."""
+    global _POOL
+    if _POOL is None:
+        with _POOL_LOCK:
+            if _POOL is None:
+                _POOL = PoolConexiones(
+                    _obtener_database_url(),
+                    max_conexiones=_entero_env("DB_POOL_MAX", 10),
+                    edad_maxima=_entero_env("DB_POOL_EDAD_MAXIMA", 1800),
+                    espera_maxima=_entero_env("DB_POOL_ESPERA_MAXIMA", 10),
+                    verificar_tras=_entero_env("DB_POOL_VERIFICAR_TRAS", 30),
+                )
+                logger.info(f"🔗 Pool de BD creado (máx. {_POOL.max_conexiones} conexiones)")
+    return _POOL
+
+# Un hijo de fork (gunicorn --preload, multiprocessing) hereda los sockets del
+# padre. No se cierran: close() enviaría Terminate por el socket compartido y
+# cortaría la sesión del padre. Se abandonan sin recolectar y el hijo abre las suyas.
+_POOLS_HEREDADOS = []
+
+def _pool_tras_fork():
+    global _POOL, _POOL_LOCK
+    if _POOL is not None:
+        _POOLS_HEREDADOS.append(_POOL)
+    _POOL = None
+    _POOL_LOCK = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_pool_tras_fork)
+
+def cerrar_pool():
+    """Cierra las conexiones libres del pool del proceso (al apagar worker.py o programador.py)."""
+    if _POOL is not None:
+        _POOL.cerrar_todo()
+
+def estadisticas_pool():
+    """Tamaño y tiempos de espera del pool, para ajustar DB_POOL_* bajo carga."""
+    if _POOL is None:
+        return {"max_conexiones": _entero_env("DB_POOL_MAX", 10), "abiertas": 0, "en_uso": 0}
+    return _POOL.estadisticas()
+
 @contextmanager
 def obtener_conexion():
-    """Context manager para conexiones seguras a BD."""
-    conn = None
+    """Context manager para conexiones seguras a BD (prestadas del pool)."""
+    pool = obtener_pool()
+    conn = pool.obtener()
+    descartar = False
     try:
-        database_url = _obtener_database_url()
-        conn = psycopg2.connect(database_url)
-        logger.info("🔗 Conexión a BD establecida")
+        logger.debug("🔗 Conexión prestada del pool")
         yield conn
         conn.commit()
         logger.debug("✅ Transacción confirmada")
     except Exception as e:
         logger.error(f"❌ Error en conexión a BD: {e}")
-        if conn:
-            conn.rollback()
-            logger.warning("🔄 Transacción revertida")
+        if isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError)) or conn.closed:
+            descartar = True
+        else:
+            try:
+                conn.rollback()
+                logger.warning("🔄 Transacción revertida")
+            except Exception:
+                descartar = True
         raise
     finally:
-        if conn:
-            conn.close()
-            logger.debug("🔌 Conexión cerrada")
+        pool.devolver(conn, descartar=descartar)
+        logger.debug("🔌 Conexión devuelta al pool")
 
 print("🔧 Iniciando bot.py (versión con salida_animal)...")
 
-# === 1. CONEXIÓN A POSTGRESQL CON MIGRACIÓN AUTOMÁTICA ===
-# === 1. CONEXIÓN A POSTGRESQL CON MIGRACIÓN AUTOMÁTICA ===
-def inicializar_bd():
-    try:
-        # Usamos la función centralizada para obtener la URL
-        database_url = _obtener_database_url()
-        conn = None
+# === 1. CONEXIÓN A POSTGRESQL CON MIGRACIONES VERSIONADAS ===
+# Cada migración se aplica una sola vez y queda anotada en schema_version.
+# Las migraciones ya publicadas no se editan: los cambios van en una nueva.
+# Las marcadas "concurrente" corren fuera de transacción (CREATE INDEX
+# CONCURRENTLY no bloquea escrituras pero no admite BEGIN/COMMIT); las que
+# tienen "funcion" reciben la conexión en autocommit y controlan sus pasos.
+_LOTE_MIGRACION = 5000
+
+def _convertir_fecha_a_date(tabla, respaldo):
+    """
+    Convierte <tabla>.fecha de TEXT a DATE sin bloquear la tabla mientras se copia:
+    1) agrega fecha_d DATE, 2) la llena por lotes con commits cortos,
+    3) en una transacción breve completa lo que falte y cambia las columnas.
+    Los índices sobre fecha se recrean en migraciones posteriores.
+    """
+    # El regex descarta rápido lo que no parece fecha; texto_a_fecha atrapa las
+    # que lo parecen pero no existen (2024-13-45) y cae al respaldo, sin abortar
+    expresion = (
+        f"COALESCE(CASE WHEN fecha ~ '^\\d{{4}}-\\d{{2}}-\\d{{2}}' "
+        f"THEN texto_a_fecha(substr(fecha, 1, 10)) END, {respaldo})"
+    )
+
+    def migrar(conn):
+        with conn.cursor() as cursor:
+            cursor.execute("""
+            CREATE OR REPLACE FUNCTION texto_a_fecha(texto TEXT) RETURNS DATE
+            LANGUAGE plpgsql IMMUTABLE AS $$
+            BEGIN
+                RETURN texto::date;
+            EXCEPTION WHEN others THEN
+                RETURN NULL;
+            END
+            $$
+            """)
+            cursor.execute("""
+            SELECT data_type FROM information_schema.columns
+            WHERE table_name = %s AND column_name = 'fecha'
+            """, (tabla,))
+            fila = cursor.fetchone()
+            if fila and fila[0] == "date":
+                return
+            cursor.execute(f"ALTER TABLE {tabla} ADD COLUMN IF NOT EXISTS fecha_d DATE")
+            total = 0
+            while True:
+                cursor.execute(f"""
+                UPDATE {tabla} SET fecha_d = {expresion}
+                WHERE id IN (SELECT id FROM {tabla} WHERE fecha_d IS NULL LIMIT %s)
+                """, (_LOTE_MIGRACION,))
+                if cursor.rowcount == 0:
+                    break
+                total += cursor.rowcount
+            logger.info(f"📅 {tabla}: {total} filas copiadas a fecha_d")
+        conn.autocommit = False
         try:
-            conn = psycopg2.connect(database_url)
-            logger.info("🔗 BD conectada para inicialización")
-            cursor = conn.cursor()
-            
-            # === Tablas principales (LÓGICA ORIGINAL INTACTA) ===
-            cursor.execute('''
+            with conn.cursor() as cursor:
+                cursor.execute(f"LOCK TABLE {tabla} IN ACCESS EXCLUSIVE MODE")
+                cursor.execute(f"UPDATE {tabla} SET fecha_d = {expresion} WHERE fecha_d IS NULL")
+                cursor.execute(f"ALTER TABLE {tabla} DROP COLUMN fecha")
+                cursor.execute(f"ALTER TABLE {tabla} RENAME COLUMN fecha_d TO fecha")
+                cursor.execute(f"ALTER TABLE {tabla} ALTER COLUMN fecha SET NOT NULL")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.autocommit = True
+
+    return migrar
+
+# === RESUMEN DIARIO: (finca, día, tipo) → conteo y sumas, mantenido en cada escritura ===
+# Las columnas *_positivo conservan la regla de los reportes (valor > 0); las
+# demás, la del dashboard y el Excel (suma directa).
+_COLUMNAS_RESUMEN = "finca_id, dia, tipo_actividad, conteo, jornales, valor, valor_positivo, valor_jornales, valor_jornales_positivo"
+_SUMAS_RESUMEN = (
+    "COUNT(*)",
+    "COALESCE(SUM(jornales), 0)",
+    "COALESCE(SUM(valor::float8), 0)",
+    "COALESCE(SUM(valor::float8) FILTER (WHERE valor > 0), 0)",
+    "COALESCE(SUM(valor::float8) FILTER (WHERE jornales > 0), 0)",
+    "COALESCE(SUM(valor::float8) FILTER (WHERE jornales > 0 AND valor > 0), 0)",
+)
+_SQL_RESUMEN_DESDE_REGISTROS = f"""
+    ({_COLUMNAS_RESUMEN})
+    SELECT finca_id, fecha, tipo_actividad, {", ".join(_SUMAS_RESUMEN)}
+    FROM registros WHERE finca_id IS NOT NULL
+    GROUP BY finca_id, fecha, tipo_actividad
+"""
+
+def _sql_acumular_resumen(origen, signo):
+    """INSERT ... ON CONFLICT que suma (signo 1) o resta (signo -1) las filas del CTE `origen`."""
+    prefijo = "-" if signo < 0 else ""
+    return f"""
+    INSERT INTO finca_resumen_diario ({_COLUMNAS_RESUMEN})
+    SELECT finca_id, fecha, tipo_actividad, {", ".join(prefijo + suma for suma in _SUMAS_RESUMEN)}
+    FROM {origen} WHERE finca_id IS NOT NULL
+    GROUP BY finca_id, fecha, tipo_actividad
+    ON CONFLICT (finca_id, dia, tipo_actividad) DO UPDATE
+    SET conteo = finca_resumen_diario.conteo + EXCLUDED.conteo,
+        jornales = finca_resumen_diario.jornales + EXCLUDED.jornales,
+        valor = finca_resumen_diario.valor + EXCLUDED.valor,
+        valor_positivo = finca_resumen_diario.valor_positivo + EXCLUDED.valor_positivo,
+        valor_jornales = finca_resumen_diario.valor_jornales + EXCLUDED.valor_jornales,
+        valor_jornales_positivo = finca_resumen_diario.valor_jornales_positivo + EXCLUDED.valor_jornales_positivo
+    """
+
+MIGRACIONES = [
+    {
+        "version": 1,
+        "descripcion": "Esquema base multi-finca + suscripción",
+        "sql": [
+            '''
             CREATE TABLE IF NOT EXISTS fincas (
                 id SERIAL PRIMARY KEY,
                 nombre VARCHAR(100) UNIQUE NOT NULL,
@@ -79,9 +406,8 @@ def inicializar_bd():
                 vencimiento_suscripcion DATE,
                 clave_secreta TEXT UNIQUE
             )
-            ''')
-            
-            cursor.execute('''
+            ''',
+            '''
             CREATE TABLE IF NOT EXISTS usuarios (
                 id SERIAL PRIMARY KEY,
                 telefono_whatsapp VARCHAR(25) UNIQUE NOT NULL,
@@ -89,9 +415,8 @@ def inicializar_bd():
                 rol VARCHAR(20) NOT NULL CHECK (rol IN ('dueño', 'supervisor', 'trabajador')),
                 finca_id INTEGER NOT NULL REFERENCES fincas(id) ON DELETE CASCADE
             )
-            ''')
-            
-            cursor.execute('''
+            ''',
+            '''
             CREATE TABLE IF NOT EXISTS animales (
                 id SERIAL PRIMARY KEY,
                 especie TEXT NOT NULL,
@@ -105,9 +430,8 @@ def inicializar_bd():
                 fecha_registro DATE DEFAULT CURRENT_DATE,
                 finca_id INTEGER REFERENCES fincas(id) ON DELETE SET NULL
             )
-            ''')
-            
-            cursor.execute('''
+            ''',
+            '''
             CREATE TABLE IF NOT EXISTS registros (
                 id SERIAL PRIMARY KEY,
                 fecha TEXT NOT NULL,
@@ -124,9 +448,8 @@ def inicializar_bd():
                 finca_id INTEGER REFERENCES fincas(id) ON DELETE SET NULL,
                 usuario_id INTEGER REFERENCES usuarios(id) ON DELETE SET NULL
             )
-            ''')
-            
-            cursor.execute('''
+            ''',
+            '''
             CREATE TABLE IF NOT EXISTS salud_animal (
                 id SERIAL PRIMARY KEY,
                 id_externo TEXT NOT NULL,
@@ -137,10 +460,14 @@ def inicializar_bd():
                 finca_id INTEGER REFERENCES fincas(id) ON DELETE SET NULL,
                 FOREIGN KEY (id_externo) REFERENCES animales (id_externo)
             )
-            ''')
-            
-            # === Migración: asegurar columna 'jornales' ===
-            cursor.execute("""
+            ''',
+        ],
+    },
+    {
+        "version": 2,
+        "descripcion": "Columna jornales en registros",
+        "sql": [
+            """
             DO $$
             BEGIN
             IF NOT EXISTS (
@@ -150,47 +477,989 @@ def inicializar_bd():
                 ALTER TABLE registros ADD COLUMN jornales INTEGER;
             END IF;
             END $$;
-            """)
-            
-            conn.commit()
-            logger.info("✅ Tablas verificadas/creadas")
-            print("✅ Base de datos lista (multi-finca + suscripción).")
-            return True
-            
-        except Exception as e:
-            logger.error(f"❌ Error en inicialización: {e}")
-            if conn:
+            """,
+        ],
+    },
+    {
+        "version": 3,
+        "descripcion": "Índice registros(finca_id, fecha) para dashboard y reportes",
+        "concurrente": True,
+        "sql": ["CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_registros_finca_fecha ON registros (finca_id, fecha)"],
+    },
+    {
+        "version": 4,
+        "descripcion": "Índice animales(finca_id, estado) para inventario",
+        "concurrente": True,
+        "sql": ["CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_animales_finca_estado ON animales (finca_id, estado)"],
+    },
+    {
+        "version": 5,
+        "descripcion": "Índice animales(marca_o_arete) para búsquedas por marca",
+        "concurrente": True,
+        "sql": ["CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_animales_marca ON animales (marca_o_arete)"],
+    },
+    {
+        "version": 6,
+        "descripcion": "Índice salud_animal(id_externo, tipo, fecha) para última sanidad por animal",
+        "concurrente": True,
+        "sql": ["CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_salud_animal_externo_tipo_fecha ON salud_animal (id_externo, tipo, fecha)"],
+    },
+    {
+        "version": 7,
+        "descripcion": "registros.fecha de TEXT a DATE",
+        "funcion": _convertir_fecha_a_date("registros", "COALESCE(fecha_registro::date, CURRENT_DATE)"),
+    },
+    {
+        "version": 8,
+        "descripcion": "salud_animal.fecha de TEXT a DATE",
+        "funcion": _convertir_fecha_a_date("salud_animal", "CURRENT_DATE"),
+    },
+    {
+        "version": 9,
+        "descripcion": "Recrear índice registros(finca_id, fecha) sobre la columna DATE",
+        "concurrente": True,
+        "sql": ["CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_registros_finca_fecha ON registros (finca_id, fecha)"],
+    },
+    {
+        "version": 10,
+        "descripcion": "Recrear índice salud_animal(id_externo, tipo, fecha) sobre la columna DATE",
+        "concurrente": True,
+        "sql": ["CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_salud_animal_externo_tipo_fecha ON salud_animal (id_externo, tipo, fecha)"],
+    },
+    {
+        "version": 11,
+        "descripcion": "Tabla UNLOGGED conversaciones para estado compartido entre workers",
+        "sql": [
+            """
+            CREATE UNLOGGED TABLE IF NOT EXISTS conversaciones (
+                clave TEXT PRIMARY KEY,
+                estado JSONB NOT NULL,
+                actualizado_en TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_conversaciones_actualizado ON conversaciones (actualizado_en)",
+        ],
+    },
+    {
+        "version": 12,
+        "descripcion": "Cola durable inbound_messages para el modo WEBHOOK_MODO=cola",
+        "sql": [
+            """
+            CREATE TABLE IF NOT EXISTS inbound_messages (
+                id BIGSERIAL PRIMARY KEY,
+                message_sid TEXT UNIQUE,
+                remitente TEXT NOT NULL,
+                cuerpo TEXT NOT NULL,
+                estado TEXT NOT NULL DEFAULT 'pendiente',
+                intentos INTEGER NOT NULL DEFAULT 0,
+                recibido_en TIMESTAMPTZ NOT NULL DEFAULT now(),
+                tomado_en TIMESTAMPTZ,
+                terminado_en TIMESTAMPTZ,
+                latencia_ms INTEGER,
+                respuesta TEXT,
+                error TEXT
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_inbound_pendientes ON inbound_messages (id) WHERE estado = 'pendiente'",
+            "CREATE INDEX IF NOT EXISTS idx_inbound_procesando ON inbound_messages (tomado_en) WHERE estado = 'procesando'",
+        ],
+    },
+    {
+        "version": 13,
+        "descripcion": "Tabla mensajes_procesados para reintentos idempotentes de Twilio",
+        "sql": [
+            """
+            CREATE TABLE IF NOT EXISTS mensajes_procesados (
+                message_sid TEXT PRIMARY KEY,
+                respuesta TEXT,
+                creado_en TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_mensajes_procesados_creado ON mensajes_procesados (creado_en)",
+        ],
+    },
+    {
+        "version": 14,
+        "descripcion": "Índice inbound_messages(remitente, id) para el orden FIFO por remitente",
+        "concurrente": True,
+        "sql": [
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_inbound_remitente_activos ON inbound_messages (remitente, id) WHERE estado IN ('pendiente', 'procesando')",
+        ],
+    },
+    {
+        "version": 15,
+        "descripcion": "Índice animales(finca_id, marca_o_arete) para salidas por conjunto de marcas",
+        "concurrente": True,
+        "sql": [
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_animales_finca_marca ON animales (finca_id, marca_o_arete)",
+        ],
+    },
+    {
+        "version": 16,
+        "descripcion": "Tabla pesajes: historial de pesos por animal (animales.peso queda como el último)",
+        "sql": [
+            """
+            CREATE TABLE IF NOT EXISTS pesajes (
+                id BIGSERIAL PRIMARY KEY,
+                finca_id INTEGER NOT NULL REFERENCES fincas(id) ON DELETE CASCADE,
+                id_externo TEXT NOT NULL,
+                peso REAL NOT NULL,
+                fecha DATE NOT NULL DEFAULT CURRENT_DATE,
+                registrado_en TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_pesajes_finca_animal_fecha ON pesajes (finca_id, id_externo, fecha)",
+            # El peso vigente de cada animal es el primer punto de su historial
+            """
+            INSERT INTO pesajes (finca_id, id_externo, peso)
+            SELECT finca_id, id_externo, peso FROM animales
+            WHERE peso IS NOT NULL AND finca_id IS NOT NULL
+            """,
+        ],
+    },
+    {
+        "version": 17,
+        "descripcion": "Resumen financiero diario por finca y tipo de actividad (finca_resumen_diario)",
+        "sql": [
+            """
+            CREATE TABLE IF NOT EXISTS finca_resumen_diario (
+                finca_id INTEGER NOT NULL REFERENCES fincas(id) ON DELETE CASCADE,
+                dia DATE NOT NULL,
+                tipo_actividad TEXT NOT NULL,
+                conteo INTEGER NOT NULL DEFAULT 0,
+                jornales INTEGER NOT NULL DEFAULT 0,
+                valor DOUBLE PRECISION NOT NULL DEFAULT 0,
+                valor_positivo DOUBLE PRECISION NOT NULL DEFAULT 0,
+                valor_jornales DOUBLE PRECISION NOT NULL DEFAULT 0,
+                valor_jornales_positivo DOUBLE PRECISION NOT NULL DEFAULT 0,
+                PRIMARY KEY (finca_id, dia, tipo_actividad)
+            )
+            """,
+            "INSERT INTO finca_resumen_diario " + _SQL_RESUMEN_DESDE_REGISTROS + " ON CONFLICT DO NOTHING",
+        ],
+    },
+    {
+        "version": 18,
+        "descripcion": "Versión de datos por finca (finca_version) incrementada por triggers de escritura",
+        "sql": [
+            # Sin FK a fincas: el borrado en cascada de una finca no debe fallar al tocar su versión
+            """
+            CREATE TABLE IF NOT EXISTS finca_version (
+                finca_id INTEGER PRIMARY KEY,
+                version BIGINT NOT NULL DEFAULT 0
+            )
+            """,
+            """
+            CREATE OR REPLACE FUNCTION tocar_version_finca() RETURNS trigger
+            LANGUAGE plpgsql AS $$
+            BEGIN
+                IF TG_OP = 'DELETE' THEN
+                    INSERT INTO finca_version (finca_id, version)
+                    SELECT DISTINCT finca_id, 1 FROM filas_viejas WHERE finca_id IS NOT NULL ORDER BY finca_id
+                    ON CONFLICT (finca_id) DO UPDATE SET version = finca_version.version + 1;
+                ELSE
+                    INSERT INTO finca_version (finca_id, version)
+                    SELECT DISTINCT finca_id, 1 FROM filas_nuevas WHERE finca_id IS NOT NULL ORDER BY finca_id
+                    ON CONFLICT (finca_id) DO UPDATE SET version = finca_version.version + 1;
+                END IF;
+                RETURN NULL;
+            END
+            $$
+            """,
+        ] + [
+            sentencia
+            for tabla in ("registros", "animales", "salud_animal")
+            for sentencia in (
+                f"DROP TRIGGER IF EXISTS trg_version_{tabla}_insert ON {tabla}",
+                f"CREATE TRIGGER trg_version_{tabla}_insert AFTER INSERT ON {tabla} REFERENCING NEW TABLE AS filas_nuevas FOR EACH STATEMENT EXECUTE PROCEDURE tocar_version_finca()",
+                f"DROP TRIGGER IF EXISTS trg_version_{tabla}_update ON {tabla}",
+                f"CREATE TRIGGER trg_version_{tabla}_update AFTER UPDATE ON {tabla} REFERENCING NEW TABLE AS filas_nuevas FOR EACH STATEMENT EXECUTE PROCEDURE tocar_version_finca()",
+                f"DROP TRIGGER IF EXISTS trg_version_{tabla}_delete ON {tabla}",
+                f"CREATE TRIGGER trg_version_{tabla}_delete AFTER DELETE ON {tabla} REFERENCING OLD TABLE AS filas_viejas FOR EACH STATEMENT EXECUTE PROCEDURE tocar_version_finca()",
+            )
+        ],
+    },
+    {
+        "version": 19,
+        "descripcion": "Índice registros(finca_id, fecha, id) para paginar movimientos con cursor (fecha, id)",
+        "concurrente": True,
+        "sql": [
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_registros_finca_fecha_id ON registros (finca_id, fecha, id)",
+        ],
+    },
+    {
+        "version": 20,
+        "descripcion": "Tabla reportes_precalculados: primera página del reporte por finca y versión de datos (programador.py)",
+        "sql": [
+            """
+            CREATE TABLE IF NOT EXISTS reportes_precalculados (
+                finca_id INTEGER NOT NULL REFERENCES fincas(id) ON DELETE CASCADE,
+                titulo TEXT NOT NULL,
+                inicio DATE NOT NULL,
+                fin DATE NOT NULL,
+                version BIGINT NOT NULL,
+                texto TEXT NOT NULL,
+                siguiente JSONB,
+                generado_en TIMESTAMP NOT NULL DEFAULT NOW(),
+                PRIMARY KEY (finca_id, titulo)
+            )
+            """,
+        ],
+    },
+    {
+        "version": 21,
+        "descripcion": "mensajes_procesados.reclamado_en: un reclamo sin respuesta que venció se puede retomar",
+        "sql": [
+            "ALTER TABLE mensajes_procesados ADD COLUMN IF NOT EXISTS reclamado_en TIMESTAMPTZ NOT NULL DEFAULT now()",
+        ],
+    },
+    {
+        "version": 22,
+        "descripcion": "finca_version se incrementa al commit (constraint trigger diferido), no a mitad de la transacción",
+        "sql": [
+            # Al diferir el trigger, la fila de finca_version se bloquea siempre de
+            # última y solo durante el commit: sin inversión de orden frente a
+            # finca_resumen_diario ni una fila caliente retenida toda la transacción.
+            # Una sola vez por finca y transacción (lista en finca_version.tocadas).
+            """
+            CREATE OR REPLACE FUNCTION tocar_version_finca() RETURNS trigger
+            LANGUAGE plpgsql AS $$
+            DECLARE
+                fila_finca INTEGER;
+                tocadas TEXT;
+            BEGIN
+                IF TG_OP = 'DELETE' THEN
+                    fila_finca := OLD.finca_id;
+                ELSE
+                    fila_finca := NEW.finca_id;
+                END IF;
+                IF fila_finca IS NULL THEN
+                    RETURN NULL;
+                END IF;
+                tocadas := COALESCE(NULLIF(current_setting('finca_version.tocadas', true), ''), ',');
+                IF position(',' || fila_finca || ',' IN tocadas) > 0 THEN
+                    RETURN NULL;
+                END IF;
+                PERFORM set_config('finca_version.tocadas', tocadas || fila_finca || ',', true);
+                INSERT INTO finca_version (finca_id, version) VALUES (fila_finca, 1)
+                ON CONFLICT (finca_id) DO UPDATE SET version = finca_version.version + 1;
+                RETURN NULL;
+            END
+            $$
+            """,
+        ] + [
+            sentencia
+            for tabla in ("registros", "animales", "salud_animal")
+            for sentencia in (
+                f"DROP TRIGGER IF EXISTS trg_version_{tabla}_insert ON {tabla}",
+                f"DROP TRIGGER IF EXISTS trg_version_{tabla}_update ON {tabla}",
+                f"DROP TRIGGER IF EXISTS trg_version_{tabla}_delete ON {tabla}",
+                f"DROP TRIGGER IF EXISTS trg_version_{tabla} ON {tabla}",
+                f"CREATE CONSTRAINT TRIGGER trg_version_{tabla} AFTER INSERT OR UPDATE OR DELETE ON {tabla} DEFERRABLE INITIALLY DEFERRED FOR EACH ROW EXECUTE PROCEDURE tocar_version_finca()",
+            )
+        ],
+    },
+    {
+        "version": 23,
+        "descripcion": "Versiones de finca desde una secuencia global; TRUNCATE y fincas nuevas también la mueven",
+        "sql": [
+            # La caché de resultados de cada proceso usa (finca_id, version) como
+            # llave: una versión nunca se repite, ni tras /reiniciar-bd (la
+            # secuencia no se borra y arranca en epoch ms) ni con ids de finca reusados.
+            """
+            DO $$
+            BEGIN
+                IF NOT EXISTS (SELECT 1 FROM pg_class WHERE relname = 'finca_version_seq' AND relkind = 'S') THEN
+                    CREATE SEQUENCE finca_version_seq;
+                    PERFORM setval('finca_version_seq', GREATEST(
+                        (EXTRACT(EPOCH FROM clock_timestamp()) * 1000)::bigint,
+                        (SELECT COALESCE(MAX(version), 0) + 1 FROM finca_version)
+                    ));
+                END IF;
+            END
+            $$
+            """,
+            """
+            CREATE OR REPLACE FUNCTION tocar_version_finca() RETURNS trigger
+            LANGUAGE plpgsql AS $$
+            DECLARE
+                fila_finca INTEGER;
+                tocadas TEXT;
+            BEGIN
+                IF TG_OP = 'DELETE' THEN
+                    fila_finca := OLD.finca_id;
+                ELSE
+                    fila_finca := NEW.finca_id;
+                END IF;
+                IF fila_finca IS NULL THEN
+                    RETURN NULL;
+                END IF;
+                tocadas := COALESCE(NULLIF(current_setting('finca_version.tocadas', true), ''), ',');
+                IF position(',' || fila_finca || ',' IN tocadas) > 0 THEN
+                    RETURN NULL;
+                END IF;
+                PERFORM set_config('finca_version.tocadas', tocadas || fila_finca || ',', true);
+                INSERT INTO finca_version (finca_id, version) VALUES (fila_finca, nextval('finca_version_seq'))
+                ON CONFLICT (finca_id) DO UPDATE SET version = EXCLUDED.version;
+                RETURN NULL;
+            END
+            $$
+            """,
+            # TRUNCATE no dispara triggers por fila: mueve la versión de todas las fincas
+            """
+            CREATE OR REPLACE FUNCTION tocar_version_todas_fincas() RETURNS trigger
+            LANGUAGE plpgsql AS $$
+            BEGIN
+                INSERT INTO finca_version (finca_id, version)
+                SELECT id, nextval('finca_version_seq') FROM fincas ORDER BY id
+                ON CONFLICT (finca_id) DO UPDATE SET version = EXCLUDED.version;
+                RETURN NULL;
+            END
+            $$
+            """,
+            # Una finca nueva nace con versión propia, nunca con el 0 de otra anterior
+            """
+            CREATE OR REPLACE FUNCTION iniciar_version_finca() RETURNS trigger
+            LANGUAGE plpgsql AS $$
+            BEGIN
+                INSERT INTO finca_version (finca_id, version) VALUES (NEW.id, nextval('finca_version_seq'))
+                ON CONFLICT (finca_id) DO UPDATE SET version = EXCLUDED.version;
+                RETURN NULL;
+            END
+            $$
+            """,
+            "DROP TRIGGER IF EXISTS trg_version_fincas_insert ON fincas",
+            "CREATE TRIGGER trg_version_fincas_insert AFTER INSERT ON fincas FOR EACH ROW EXECUTE PROCEDURE iniciar_version_finca()",
+            """
+            INSERT INTO finca_version (finca_id, version)
+            SELECT id, nextval('finca_version_seq') FROM fincas ORDER BY id
+            ON CONFLICT (finca_id) DO UPDATE SET version = EXCLUDED.version
+            """,
+        ] + [
+            sentencia
+            for tabla in ("registros", "animales", "salud_animal", "pesajes", "finca_resumen_diario", "reportes_precalculados")
+            for sentencia in (
+                f"DROP TRIGGER IF EXISTS trg_version_{tabla}_truncate ON {tabla}",
+                f"CREATE TRIGGER trg_version_{tabla}_truncate AFTER TRUNCATE ON {tabla} FOR EACH STATEMENT EXECUTE PROCEDURE tocar_version_todas_fincas()",
+            )
+        ],
+    },
+]
+
+def _eliminar_indice_invalido(cursor, sentencia):
+    """Un CREATE INDEX CONCURRENTLY interrumpido deja un índice INVALID que IF NOT EXISTS no repara."""
+    nombre = re.search(r"INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)", sentencia, re.IGNORECASE)
+    if not nombre:
+        return
+    cursor.execute("""
+    SELECT 1 FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indexrelid
+    WHERE c.relname = %s AND NOT i.indisvalid
+    """, (nombre.group(1),))
+    if cursor.fetchone():
+        logger.warning(f"⚠️ Índice inválido {nombre.group(1)}, se recrea")
+        cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {nombre.group(1)}")
+
+def aplicar_migraciones(conn=None):
+    """
+    Aplica en orden las migraciones pendientes y retorna las versiones aplicadas.
+    Con `conn` usa esa conexión (la que tiene el advisory lock) y no pide otra al pool.
+    """
+    if conn is None:
+        with obtener_conexion() as conn:
+            return _aplicar_migraciones(conn)
+    return _aplicar_migraciones(conn)
+
+def _aplicar_migraciones(conn):
+    aplicadas = []
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            descripcion TEXT,
+            aplicada_en TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """)
+        cursor.execute("SELECT version FROM schema_version")
+        ya_aplicadas = {row[0] for row in cursor.fetchall()}
+    for migracion in MIGRACIONES:
+        version = migracion["version"]
+        if version in ya_aplicadas:
+            continue
+        logger.info(f"🧱 Aplicando migración {version}: {migracion['descripcion']}")
+        if migracion.get("funcion"):
+            # Migraciones por pasos: manejan sus propias transacciones
+            migracion["funcion"](conn)
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "INSERT INTO schema_version (version, descripcion) VALUES (%s, %s)",
+                    (version, migracion["descripcion"])
+                )
+        elif migracion.get("concurrente"):
+            with conn.cursor() as cursor:
+                for sentencia in migracion["sql"]:
+                    _eliminar_indice_invalido(cursor, sentencia)
+                    cursor.execute(sentencia)
+                cursor.execute(
+                    "INSERT INTO schema_version (version, descripcion) VALUES (%s, %s)",
+                    (version, migracion["descripcion"])
+                )
+        else:
+            conn.autocommit = False
+            try:
+                with conn.cursor() as cursor:
+                    for sentencia in migracion["sql"]:
+                        cursor.execute(sentencia)
+                    cursor.execute(
+                        "INSERT INTO schema_version (version, descripcion) VALUES (%s, %s)",
+                        (version, migracion["descripcion"])
+                    )
+                conn.commit()
+            except Exception:
                 conn.rollback()
-            print(f"❌ Error al conectar con PostgreSQL: {e}")
-            return False
-        finally:
-            if conn:
-                conn.close()
-                
+                raise
+            finally:
+                conn.autocommit = True
+        aplicadas.append(version)
+    return aplicadas
+
+def inicializar_bd(conn=None):
+    try:
+        aplicadas = aplicar_migraciones(conn)
+        if aplicadas:
+            logger.info(f"✅ Migraciones aplicadas: {aplicadas}")
+        else:
+            logger.info("✅ Esquema al día, sin migraciones pendientes")
+        print("✅ Base de datos lista (multi-finca + suscripción).")
+        return True
+    except Exception as e:
+        logger.error(f"❌ Error en inicialización: {e}")
+        print(f"❌ Error al conectar con PostgreSQL: {e}")
+        return False
+
+# === ARRANQUE: ESQUEMA UNA SOLA VEZ POR DESPLIEGUE ===
+# Ya no se inicializa la BD al importar este módulo. El despliegue ejecuta
+# `python bot.py` (fase release) y cada worker llama a preparar_bd() al
+# arrancar: si schema_version ya está al día, sale con una sola consulta.
+VERSION_ESQUEMA = max(m["version"] for m in MIGRACIONES)
+_ESQUEMA_LISTO = False
+
+def version_esquema_actual(cursor):
+    """Versión registrada en schema_version (0 si la tabla no existe)."""
+    cursor.execute("SELECT to_regclass('schema_version')")
+    if cursor.fetchone()[0] is None:
+        return 0
+    cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    return cursor.fetchone()[0]
+
+def preparar_bd():
+    """Deja el esquema al día; varios workers a la vez se serializan con un advisory lock."""
+    global _ESQUEMA_LISTO
+    if _ESQUEMA_LISTO:
+        return True
+    try:
+        with obtener_conexion() as conn:
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                if version_esquema_actual(cursor) >= VERSION_ESQUEMA:
+                    logger.info(f"✅ Esquema en versión {VERSION_ESQUEMA}, nada que migrar")
+                    _ESQUEMA_LISTO = True
+                    return True
+                # pg_try_advisory_lock en bucle y no pg_advisory_lock: una espera
+                # dentro de una sentencia mantiene un snapshot abierto y bloquearía
+                # los CREATE INDEX CONCURRENTLY del proceso que está migrando.
+                limite = time.monotonic() + _entero_env("ESQUEMA_ESPERA_MAXIMA", 300)
+                while True:
+                    cursor.execute("SELECT pg_try_advisory_lock(hashtext('finca-bot:esquema'))")
+                    if cursor.fetchone()[0]:
+                        break
+                    if time.monotonic() > limite:
+                        raise TimeoutError("Otro proceso sigue migrando el esquema")
+                    time.sleep(0.5)
+                try:
+                    # Otro proceso pudo migrar mientras esperábamos el candado
+                    if version_esquema_actual(cursor) < VERSION_ESQUEMA:
+                        # En esta misma conexión: con DB_POOL_MAX=1 pedir otra se bloquearía
+                        if not inicializar_bd(conn):
+                            return False
+                finally:
+                    cursor.execute("SELECT pg_advisory_unlock(hashtext('finca-bot:esquema'))")
+        _ESQUEMA_LISTO = True
+        return True
     except Exception as e:
-        logger.error(f"❌ Error crítico al conectar: {e}")
+        logger.error(f"❌ Error al preparar el esquema: {e}")
         print(f"❌ Error crítico al inicializar BD: {e}")
         return False
 
-try:
-    BD_OK = inicializar_bd()
-except Exception as e:
-    print(f"❌ Error crítico al inicializar BD: {e}")
-    BD_OK = False
+# === 2. PALABRAS CLAVE: CLASIFICADOR DE UNA SOLA PASADA ===
+# Vocabulario único para bot y formulario web. Se compila al importar en un
+# regex con forma de trie (prefijos comunes factorizados), así que recorrer el
+# texto no se encarece al agregar palabras. Especies y categorías son palabras
+# completas con plural opcional ("terneros" -> ternero, pero "cebada" no es ceba);
+# cultivos y sanidad coinciden por fragmento ("desparasitación" -> desparasit).
+ESPECIES_PALABRAS = {
+    "porcino": ["cerdo", "cerda", "lechón", "lechon", "lechones", "verraco", "porcino", "cochino", "chancho"],
+    "bovino": ["vaca", "toro", "ternero", "ternera", "novillo", "novilla", "vaquilla", "buey", "ganado", "bovino"],
+}
+# También nombran otra cosa ("las cerdas de la cola"): una palabra bovina en el
+# mismo texto manda sobre ellas. "ceba" es solo etapa, vale para ambas especies.
+ESPECIES_AMBIGUAS = {"cerda"}
+# palabra -> categoría guardada en animales.categoria
+CATEGORIAS_PALABRAS = {
+    "lechón": "lechón", "lechon": "lechón", "lechones": "lechón",
+    "cerda": "cerda", "verraco": "verraco", "ceba": "ceba", "engorda": "engorda",
+    "vaca": "vaca", "toro": "toro", "ternero": "ternero", "ternera": "ternera",
+    "novillo": "novillo", "novilla": "novilla", "vaquilla": "vaquilla", "lechera": "lechera", "buey": "buey",
+}
+CULTIVOS_PALABRAS = [
+    "maíz", "maiz", "papa", "arroz", "cacao", "café", "cafe", "yuca", "plátano", "platano",
+    "frijol", "trigo", "cebolla", "fruta", "citricos", "cítricos",
+]
+# En orden de prioridad: si el texto menciona varios, gana el primero
+SANIDAD_PALABRAS = {
+    "vacuna": ["vacuna", "vacunacion", "vacunación", "aftosa", "carbon", "carbón", "brucelosis", "peste"],
+    "desparasitación": ["desparasit", "lavado", "lombriz", "purga", "nuche", "vitamin", "garrapata", "gusano"],
+    "reproducción": ["monta", "insemin", "preñez", "celo", "reproduccion", "reproducción", "servicio"],
+}
+_PRIORIDAD_SANIDAD = {tipo: i for i, tipo in enumerate(SANIDAD_PALABRAS)}
+
+Clasificacion = namedtuple("Clasificacion", ["especie", "categoria", "cultivo", "tipo_sanidad"])
+
+def _regex_trie(palabras):
+    """Alternancia con prefijos factorizados; ante 'lechon' y 'lechones' prefiere la más larga."""
+    trie = {}
+    for palabra in palabras:
+        nodo = trie
+        for letra in palabra:
+            nodo = nodo.setdefault(letra, {})
+        nodo[""] = {}
+
+    def construir(nodo):
+        ramas = [re.escape(letra) + construir(hijo) for letra, hijo in sorted(nodo.items()) if letra]
+        if not ramas:
+            return ""
+        patron = ramas[0] if len(ramas) == 1 else "(?:" + "|".join(ramas) + ")"
+        if "" in nodo:
+            patron = "(?:" + patron + ")?"
+        return patron
+
+    return construir(trie)
 
-# === 2. PALABRAS CLAVE PARA ANIMALES ===
-PORCINO_PALABRAS = ["cerdo", "lechón", "cerda", "verraco", "lechon", "lechones","porcino" "cochino"]
-BOVINO_PALABRAS = ["vaca", "toro", "ternero", "ternera", "novillo", "novilla", "buey", "ganado"]
-CATEGORIAS_VALIDAS = ["lechón", "cerda", "verraco", "ceba", "toro", "ternero", "ternera", "novillo", "vaquilla", "engorda", "lechera"]
+def _regex_palabras(palabras, grupo):
+    """Palabras completas con plural opcional ("vacas", "bueyes"); el grupo captura la palabra sin plural."""
+    return r"\b(?P<" + grupo + ">" + _regex_trie(palabras) + r")(?:e?s)?\b"
+
+# palabra -> [(dimensión, valor), ...]; una palabra puede aportar especie y categoría
+_PALABRAS_CLASIFICADOR = {}
+for _especie, _palabras in ESPECIES_PALABRAS.items():
+    for _palabra in _palabras:
+        _dimension = "especie_ambigua" if _palabra in ESPECIES_AMBIGUAS else "especie"
+        _PALABRAS_CLASIFICADOR.setdefault(_palabra, []).append((_dimension, _especie))
+for _palabra, _categoria in CATEGORIAS_PALABRAS.items():
+    _PALABRAS_CLASIFICADOR.setdefault(_palabra, []).append(("categoria", _categoria))
+for _palabra in CULTIVOS_PALABRAS:
+    _PALABRAS_CLASIFICADOR.setdefault(_palabra, []).append(("cultivo", True))
+for _tipo, _palabras in SANIDAD_PALABRAS.items():
+    for _palabra in _palabras:
+        _PALABRAS_CLASIFICADOR.setdefault(_palabra, []).append(("sanidad", _tipo))
+_PALABRAS_ANIMAL = {p for palabras in ESPECIES_PALABRAS.values() for p in palabras} | set(CATEGORIAS_PALABRAS)
+_REGEX_CLASIFICADOR = re.compile(
+    _regex_palabras(_PALABRAS_ANIMAL, "animal")
+    + "|" + _regex_trie(p for p in _PALABRAS_CLASIFICADOR if p not in _PALABRAS_ANIMAL)
+)
+
+def clasificar_texto(texto):
+    """
+    Una pasada sobre el texto. Especie: porcino gana sobre bovino, salvo que la
+    única palabra porcina sea ambigua; categoría: la primera mencionada;
+    tipo_sanidad: vacuna > desparasitación > reproducción > 'sanidad'.
+    """
+    porcino = porcino_ambiguo = bovino = cultivo = False
+    categoria = None
+    tipo_sanidad = None
+    for coincidencia in _REGEX_CLASIFICADOR.finditer((texto or "").lower()):
+        for dimension, valor in _PALABRAS_CLASIFICADOR[coincidencia.group("animal") or coincidencia.group()]:
+            if dimension == "especie":
+                if valor == "porcino":
+                    porcino = True
+                else:
+                    bovino = True
+            elif dimension == "especie_ambigua":
+                porcino_ambiguo = True
+            elif dimension == "categoria":
+                if categoria is None:
+                    categoria = valor
+            elif dimension == "cultivo":
+                cultivo = True
+            elif tipo_sanidad is None or _PRIORIDAD_SANIDAD[valor] < _PRIORIDAD_SANIDAD[tipo_sanidad]:
+                tipo_sanidad = valor
+    especie = "porcino" if porcino else "bovino" if bovino else "porcino" if porcino_ambiguo else None
+    return Clasificacion(especie, categoria, cultivo, tipo_sanidad or "sanidad")
+
+# --- Marcas, pesos y categorías por animal ---
+# Un solo recorrido del texto: cada "marca|arete|chapeta X" abre un animal, el
+# "peso N kg" que le sigue (antes de la próxima marca) es su peso, y la primera
+# categoría mencionada antes de una marca ("vaca lechera" -> vaca) aplica a esa
+# marca y a las siguientes hasta que se nombre otra.
+MarcaAnimal = namedtuple("MarcaAnimal", ["marca", "peso", "categoria"])
+
+_REGEX_MARCAS = re.compile(
+    r"(?:marca|arete|chapeta)\s+(?P<marca>[a-z0-9-]+)"
+    r"|peso\s*(?P<peso>\d+(?:\.\d+)?)\s*(?:kg|kilos?)"
+    r"|" + _regex_palabras(CATEGORIAS_PALABRAS, "categoria"),
+    re.IGNORECASE
+)
+
+def extraer_marcas(texto):
+    """Lista de MarcaAnimal en orden de aparición, sin marcas repetidas. Tiempo lineal en el texto."""
+    animales = {}
+    actual = None
+    categoria = None
+    categoria_nueva = True
+    for token in _REGEX_MARCAS.finditer(texto or ""):
+        if token.lastgroup == "marca":
+            actual = token.group("marca").upper()
+            animales.setdefault(actual, [None, categoria])
+            categoria_nueva = True
+        elif token.lastgroup == "peso":
+            if actual is not None and animales[actual][0] is None:
+                animales[actual][0] = float(token.group("peso"))
+        elif categoria_nueva:
+            categoria = CATEGORIAS_PALABRAS[token.group("categoria").lower()]
+            categoria_nueva = False
+    return [MarcaAnimal(marca, peso, cat) for marca, (peso, cat) in animales.items()]
 
 # === 3. ESTADO DEL USUARIO ===
-user_state = {}
+# Las conversaciones a medio camino viven en un ConversationStore. En memoria
+# (por defecto) sirve con un solo proceso; con CONVERSACIONES_ALMACEN=postgres
+# el estado queda en una tabla UNLOGGED compartida por todos los workers/nodos.
+_AUSENTE = object()
+
+def _tamano_aproximado(valor):
+    """Bytes aproximados de un valor cacheado (texto, bytes, tuplas y listas de ellos)."""
+    if isinstance(valor, (str, bytes)):
+        return len(valor)
+    if isinstance(valor, (tuple, list)):
+        return sum(_tamano_aproximado(v) for v in valor)
+    return 0 if valor is None else 64
+
+class CacheTTL:
+    """
+    Diccionario LRU con expiración por entrada, seguro entre hilos. Con
+    max_bytes, además del número de entradas se acota el tamaño total.
+    """
+
+    def __init__(self, max_entradas=10000, ttl=300, max_bytes=None):
+        self.max_entradas = max_entradas
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._datos = OrderedDict()  # clave -> (expira_en, valor)
+        self._tamanos = {}  # clave -> bytes, solo con max_bytes
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+
+    def get(self, clave, defecto=None):
+        with self._lock:
+            item = self._datos.get(clave)
+            if item is not None and item[0] < time.monotonic():
+                self._quitar(clave)
+                item = None
+            if item is None:
+                self.fallos += 1
+                return defecto
+            self._datos.move_to_end(clave)
+            self.aciertos += 1
+            return item[1]
+
+    def set(self, clave, valor, ttl=None):
+        tamano = _tamano_aproximado(valor) if self.max_bytes else 0
+        with self._lock:
+            # Un valor más grande que todo el tope no se guarda
+            if self.max_bytes and tamano > self.max_bytes:
+                self._quitar(clave)
+                return
+            self._datos[clave] = (time.monotonic() + (ttl if ttl is not None else self.ttl), valor)
+            self._datos.move_to_end(clave)
+            if self.max_bytes:
+                self._bytes += tamano - self._tamanos.get(clave, 0)
+                self._tamanos[clave] = tamano
+            while len(self._datos) > self.max_entradas or (self.max_bytes and self._bytes > self.max_bytes):
+                self._quitar(next(iter(self._datos)))
+
+    def _quitar(self, clave):
+        self._datos.pop(clave, None)
+        self._bytes -= self._tamanos.pop(clave, 0)
+
+    def delete(self, clave):
+        with self._lock:
+            self._quitar(clave)
+
+    def eliminar_si(self, predicado):
+        """Elimina las entradas para las que predicado(clave, valor) es verdadero."""
+        with self._lock:
+            for clave in [c for c, (_, v) in self._datos.items() if predicado(c, v)]:
+                self._quitar(clave)
+
+    def limpiar(self):
+        with self._lock:
+            self._datos.clear()
+            self._tamanos.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._datos)
+
+    def estadisticas(self):
+        consultas = self.aciertos + self.fallos
+        datos = {
+            "entradas": len(self._datos),
+            "max_entradas": self.max_entradas,
+            "aciertos": self.aciertos,
+            "fallos": self.fallos,
+            "tasa_aciertos": round(self.aciertos / consultas, 4) if consultas else 0.0,
+        }
+        if self.max_bytes:
+            datos["bytes"] = self._bytes
+            datos["max_bytes"] = self.max_bytes
+        return datos
+
+@dataclass(slots=True)
+class ConversationState:
+    """
+    Conversación en curso. Solo guarda usuario_id y finca_id, no una copia de
+    usuario_info; con __slots__ cada estado es un objeto plano sin dicts anidados.
+    """
+    step: str = "waiting_for_category"
+    tipo: str = ""
+    subtipo: str = ""
+    detalle: str = ""
+    cantidad: float = None
+    valor: float = 0
+    unidad: str = ""
+    lugar: str = ""
+    observacion: str = ""
+    jornales: int = 0
+    usuario_id: int = None
+    finca_id: int = None
+    # Paginado de reportes e inventarios: qué se pide, página actual y cursor
+    # (última fila enviada) para pedir la siguiente con "más"
+    paginado: str = ""
+    pagina: int = 0
+    parametros_pagina: list = None
+    cursor_pagina: list = None
+    # Marcas de un solo mensaje; no se serializan
+    completed: bool = False
+    cancelado: bool = False
+
+    def a_json(self):
+        """Lista posicional [versión, step, tipo, ...]: sin nombres de campo en cada fila."""
+        return [_VERSION_ESTADO] + [getattr(self, campo) for campo in _CAMPOS_PERSISTENTES]
+
+    @classmethod
+    def desde_json(cls, valores):
+        """None si el formato no se puede leer (p. ej. filas de una versión posterior)."""
+        if not isinstance(valores, list) or not valores or valores[0] not in _VERSIONES_ESTADO_LEGIBLES:
+            return None
+        return cls(*valores[1:])
+
+# 2 agregó los campos de paginado al final. Un proceso con el código anterior
+# (reinicio escalonado) descarta las filas 2 en vez de fallar con demasiados
+# argumentos; las filas 1 se leen igual, los campos nuevos toman su valor por defecto.
+_VERSION_ESTADO = 2
+_VERSIONES_ESTADO_LEGIBLES = frozenset([1, _VERSION_ESTADO])
+_CAMPOS_PERSISTENTES = tuple(f.name for f in fields(ConversationState) if f.name not in ("completed", "cancelado"))
+
+class ConversationStore:
+    """Interfaz del almacén de conversaciones en curso, indexado por remitente o usuario."""
+
+    def get(self, clave):
+        """Retorna el estado guardado o None si no hay conversación (o expiró)."""
+        raise NotImplementedError
+
+    def set(self, clave, estado):
+        raise NotImplementedError
+
+    def delete(self, clave):
+        raise NotImplementedError
+
+    def __contains__(self, clave):
+        return self.get(clave) is not None
+
+class MemoryConversationStore(ConversationStore):
+    """Conversaciones en memoria del proceso, con tope LRU y expiración por inactividad."""
+
+    def __init__(self, max_conversaciones=5000, ttl=3600):
+        self._cache = CacheTTL(max_entradas=max_conversaciones, ttl=ttl)
+
+    def get(self, clave):
+        return self._cache.get(str(clave))
+
+    def set(self, clave, estado):
+        self._cache.set(str(clave), estado)
+
+    def delete(self, clave):
+        self._cache.delete(str(clave))
+
+    def __len__(self):
+        return len(self._cache)
+
+def _json_compacto(valor):
+    return json.dumps(valor, separators=(",", ":"))
+
+class PostgresConversationStore(ConversationStore):
+    """Una fila JSONB por remitente en la tabla UNLOGGED conversaciones (ConversationState.a_json)."""
+
+    def __init__(self, ttl=3600, probabilidad_purga=0.01):
+        self.ttl = ttl
+        self.probabilidad_purga = probabilidad_purga
+
+    def get(self, clave):
+        with obtener_conexion() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                SELECT estado FROM conversaciones
+                WHERE clave = %s AND actualizado_en > now() - make_interval(secs => %s)
+                """, (str(clave), self.ttl))
+                row = cursor.fetchone()
+        return ConversationState.desde_json(row[0]) if row else None
+
+    def set(self, clave, estado):
+        with obtener_conexion() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                INSERT INTO conversaciones (clave, estado, actualizado_en)
+                VALUES (%s, %s, now())
+                ON CONFLICT (clave) DO UPDATE
+                SET estado = EXCLUDED.estado, actualizado_en = EXCLUDED.actualizado_en
+                """, (str(clave), Json(estado.a_json(), dumps=_json_compacto)))
+                if random.random() < self.probabilidad_purga:
+                    cursor.execute(
+                        "DELETE FROM conversaciones WHERE actualizado_en < now() - make_interval(secs => %s)",
+                        (self.ttl,)
+                    )
+
+    def delete(self, clave):
+        with obtener_conexion() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("DELETE FROM conversaciones WHERE clave = %s", (str(clave),))
+
+def crear_almacen_conversaciones():
+    """Elige el almacén según CONVERSACIONES_ALMACEN (memoria | postgres)."""
+    tipo = os.environ.get("CONVERSACIONES_ALMACEN", "memoria").strip().lower()
+    ttl = _entero_env("CONVERSACIONES_TTL", 3600)
+    if tipo == "postgres":
+        logger.info("💬 Conversaciones en PostgreSQL (tabla conversaciones)")
+        return PostgresConversationStore(ttl=ttl)
+    return MemoryConversationStore(max_conversaciones=_entero_env("CONVERSACIONES_MAX", 5000), ttl=ttl)
+
+user_state = crear_almacen_conversaciones()
 
 # === 4. FUNCIONES DE SOPORTE ===
+# Caché de usuarios por teléfono: cada mensaje (incluido cada paso de un
+# registro guiado) necesita el rol y la suscripción del remitente. Los
+# números desconocidos también se cachean, por menos tiempo. Se invalida
+# explícitamente al renovar, registrar o activar fincas, y la invalidación se
+# publica con NOTIFY para que la apliquen todos los procesos (web, worker.py).
+# Límite: si la escucha se cae, los avisos de ese lapso se pierden; al
+# reconectar se vacía la caché, y mientras tanto el TTL acota el dato viejo.
+_USUARIOS_CACHE = CacheTTL(
+    max_entradas=_entero_env("USUARIOS_CACHE_MAX", 10000),
+    ttl=_entero_env("USUARIOS_CACHE_TTL", 300)
+)
+_USUARIOS_CACHE_TTL_NEGATIVO = _entero_env("USUARIOS_CACHE_TTL_NEGATIVO", 30)
+
+def estadisticas_cache_usuarios():
+    return _USUARIOS_CACHE.estadisticas()
+
+_CANAL_USUARIOS = "usuarios_cache"
+_ESCUCHA_USUARIOS = None
+_ESCUCHA_USUARIOS_LOCK = threading.Lock()
+
+def invalidar_usuario_cache(telefono=None, finca_id=None):
+    """
+    Olvida usuarios cacheados por teléfono y/o finca (sin argumentos, todos)
+    en este proceso y avisa a los demás. Llamar después del commit.
+    """
+    _invalidar_usuario_local(telefono, finca_id)
+    try:
+        with obtener_conexion() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "SELECT pg_notify(%s, %s)",
+                    (_CANAL_USUARIOS, json.dumps({"telefono": telefono, "finca_id": finca_id}))
+                )
+    except Exception as e:
+        logger.warning(f"⚠️ No se pudo avisar a los otros procesos la invalidación de usuarios: {e}")
+
+def _invalidar_usuario_local(telefono=None, finca_id=None):
+    if telefono is None and finca_id is None:
+        _USUARIOS_CACHE.limpiar()
+        return
+    if telefono is not None:
+        _USUARIOS_CACHE.delete(telefono)
+    if finca_id is not None:
+        _USUARIOS_CACHE.eliminar_si(lambda _, usuario: usuario is not None and usuario["finca_id"] == finca_id)
+
+def _escuchar_invalidaciones_usuarios():
+    """Hilo que aplica en este proceso las invalidaciones publicadas por cualquiera."""
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(_obtener_database_url())
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute(f"LISTEN {_CANAL_USUARIOS}")
+            # Lo cacheado antes de escuchar pudo perderse algún aviso
+            _USUARIOS_CACHE.limpiar()
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    # Sin avisos: comprobar que la conexión sigue viva
+                    with conn.cursor() as cursor:
+                        cursor.execute("SELECT 1")
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    aviso = json.loads(conn.notifies.pop(0).payload)
+                    _invalidar_usuario_local(aviso.get("telefono"), aviso.get("finca_id"))
+        except Exception as e:
+            logger.warning(f"⚠️ Escucha de invalidaciones de usuarios caída, se reintenta: {e}")
+            _USUARIOS_CACHE.limpiar()
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            time.sleep(5)
+
+def _asegurar_escucha_usuarios():
+    global _ESCUCHA_USUARIOS
+    if _ESCUCHA_USUARIOS is None:
+        with _ESCUCHA_USUARIOS_LOCK:
+            if _ESCUCHA_USUARIOS is None:
+                _ESCUCHA_USUARIOS = threading.Thread(
+                    target=_escuchar_invalidaciones_usuarios, name="usuarios-cache", daemon=True
+                )
+                _ESCUCHA_USUARIOS.start()
+
+def _escucha_usuarios_tras_fork():
+    # El hilo no sobrevive al fork: el hijo abre su propia escucha al primer uso
+    global _ESCUCHA_USUARIOS, _ESCUCHA_USUARIOS_LOCK
+    _ESCUCHA_USUARIOS = None
+    _ESCUCHA_USUARIOS_LOCK = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_escucha_usuarios_tras_fork)
+
 def obtener_usuario_por_whatsapp(telefono):
+    _asegurar_escucha_usuarios()
+    cacheado = _USUARIOS_CACHE.get(telefono, _AUSENTE)
+    if cacheado is not _AUSENTE:
+        return dict(cacheado) if cacheado else None
     try:
-        database_url = os.environ.get("DATABASE_URL")
-        with psycopg2.connect(database_url) as conn:
+        with obtener_conexion() as conn:
             with conn.cursor() as cursor:
                 cursor.execute("""
                 SELECT u.id, u.nombre, u.rol, u.finca_id, f.nombre AS finca_nombre, f.suscripcion_activa, f.vencimiento_suscripcion
@@ -200,7 +1469,7 @@ def obtener_usuario_por_whatsapp(telefono):
                 """, (telefono,))
                 row = cursor.fetchone()
                 if row:
-                    return {
+                    usuario = {
                         "id": row[0],
                         "nombre": row[1],
                         "rol": row[2],
@@ -209,6 +1478,9 @@ def obtener_usuario_por_whatsapp(telefono):
                         "suscripcion_activa": row[5],
                         "vencimiento_suscripcion": row[6]
                     }
+                    _USUARIOS_CACHE.set(telefono, usuario)
+                    return dict(usuario)
+                _USUARIOS_CACHE.set(telefono, None, ttl=_USUARIOS_CACHE_TTL_NEGATIVO)
     except Exception as e:
         print(f"❌ Error al buscar usuario: {e}")
     return None
@@ -218,8 +1490,7 @@ def registrar_nueva_finca(nombre_finca, remitente):
         nombre_finca = nombre_finca.strip()
         if len(nombre_finca) < 3:
             return "❌ El nombre debe tener al menos 3 caracteres."
-        database_url = os.environ.get("DATABASE_URL")
-        with psycopg2.connect(database_url) as conn:
+        with obtener_conexion() as conn:
             with conn.cursor() as cursor:
                 cursor.execute("SELECT 1 FROM usuarios WHERE telefono_whatsapp = %s", (remitente,))
                 if cursor.fetchone():
@@ -235,6 +1506,7 @@ def registrar_nueva_finca(nombre_finca, remitente):
                 VALUES (%s, %s, 'dueño', %s)
                 """, (remitente, "Dueño", finca_id))
                 conn.commit()
+                invalidar_usuario_cache(telefono=remitente)
                 return (
                     f"🏡 ¡Finca '{nombre_finca}' registrada!\n"
                     "💳 **Para activarla, debes suscribirte mensualmente.**\n"
@@ -260,400 +1532,776 @@ def registrar_nueva_finca(nombre_finca, remitente):
 def extraer_datos_animal(mensaje):
     datos = {"especie": None, "id_externo": None, "marca_o_arete": None, "categoria": None, "corral": None, "peso": None}
     mensaje = mensaje.lower()
-    if any(p in mensaje for p in PORCINO_PALABRAS):
-        datos["especie"] = "porcino"
-    elif any(p in mensaje for p in BOVINO_PALABRAS):
-        datos["especie"] = "bovino"
-    arete = re.search(r"(?:arete|chapeta)\s+(\d+)", mensaje)
-    if arete:
-        num = arete.group(1)
-        datos["marca_o_arete"] = num
-        datos["id_externo"] = f"C-{num}" if datos["especie"] == "porcino" else f"V-{num}"
-    marca = re.search(r"marca\s+([a-z0-9-]+)", mensaje, re.IGNORECASE)
-    if marca:
-        cod = marca.group(1).upper()
+    clasificacion = clasificar_texto(mensaje)
+    datos["especie"] = clasificacion.especie
+    datos["categoria"] = clasificacion.categoria
+    animales = extraer_marcas(mensaje)
+    if animales:
+        cod, peso, categoria = animales[0]
         datos["marca_o_arete"] = cod
         prefijo = "C-" if datos["especie"] == "porcino" else "V-M-"
         datos["id_externo"] = f"{prefijo}{cod}"
-    for cat in CATEGORIAS_VALIDAS:
-        if cat in mensaje:
-            datos["categoria"] = cat
-            break
+        datos["peso"] = peso
+        datos["categoria"] = categoria or datos["categoria"]
     corral = re.search(r"(?:corral|lugar)\s+([a-z0-9]+)", mensaje, re.IGNORECASE)
     if corral: datos["corral"] = corral.group(1).upper()
-    peso = re.search(r"peso\s*(\d+(?:\.\d+)?)\s*(kg|kilo|kilos)", mensaje)
-    if peso: datos["peso"] = float(peso.group(1))
     return datos
 
+def actualizar_pesos_animales(cursor, pesos, finca_id):
+    """
+    Aplica todos los pesos [(marca, peso), ...] en un solo UPDATE ... FROM (VALUES ...)
+    y los agrega al historial de pesajes en la misma sentencia, con el cursor del
+    llamador. Retorna las marcas actualizadas.
+    """
+    if not pesos:
+        return []
+    actualizadas = execute_values(cursor, '''
+    WITH actualizados AS (
+        UPDATE animales AS a
+        SET peso = v.peso
+        FROM (VALUES %s) AS v (marca, peso, finca_id)
+        WHERE a.finca_id = v.finca_id
+        AND (a.marca_o_arete = v.marca OR a.id_externo = v.marca)
+        RETURNING v.marca, a.finca_id, a.id_externo, v.peso
+    ), historial AS (
+        INSERT INTO pesajes (finca_id, id_externo, peso)
+        SELECT finca_id, id_externo, peso FROM actualizados
+    )
+    SELECT marca FROM actualizados
+    ''', [(marca, peso, finca_id) for marca, peso in pesos], template="(%s, %s::real, %s::integer)", page_size=len(pesos), fetch=True)
+    return [fila[0] for fila in actualizadas]
+
 def actualizar_peso_animal(marca_o_arete, nuevo_peso, finca_id):
     """Actualiza el peso de un animal si existe en la finca."""
     try:
-        database_url = os.environ.get("DATABASE_URL")
-        if not database_url:
-            return
-        with psycopg2.connect(database_url) as conn:
+        with obtener_conexion() as conn:
             with conn.cursor() as cursor:
-                cursor.execute("""
-                UPDATE animales
-                SET peso = %s
-                WHERE (marca_o_arete = %s OR id_externo = %s)
-                AND finca_id = %s
-                """, (nuevo_peso, marca_o_arete, marca_o_arete, finca_id))
-                if cursor.rowcount > 0:
+                if actualizar_pesos_animales(cursor, [(marca_o_arete, nuevo_peso)], finca_id):
                     print(f"✅ Peso actualizado: {marca_o_arete} → {nuevo_peso} kg")
                 else:
                     print(f"ℹ️ No se encontró el animal {marca_o_arete} para actualizar peso.")
-                conn.commit()
     except Exception as e:
         print(f"❌ Error al actualizar peso: {e}")
 
-def guardar_en_salud_animal(id_externo, tipo, tratamiento, observacion, finca_id):
-    """Guarda un registro de sanidad en la tabla salud_animal."""
-    try:
-        database_url = os.environ.get("DATABASE_URL")
-        if not database_url:
-            return
-        fecha = datetime.date.today().isoformat()
-        with psycopg2.connect(database_url) as conn:
-            with conn.cursor() as cursor:
-                cursor.execute('''
-                INSERT INTO salud_animal (id_externo, tipo, tratamiento, fecha, observacion, finca_id)
-                VALUES (%s, %s, %s, %s, %s, %s)
-                ''', (id_externo, tipo, tratamiento, fecha, observacion, finca_id))
-                conn.commit()
-                print(f"✅ Sanidad guardada para {id_externo}")
-    except Exception as e:
-        print(f"❌ Error al guardar en salud_animal: {e}")
+def registrar_sanidad_animales(cursor, animales, tipo, tratamiento, observacion, finca_id):
+    """
+    Sanidad de un lote de MarcaAnimal con el cursor del llamador: resuelve todas
+    las marcas en una consulta, inserta las filas de salud_animal en un solo INSERT
+    y aplica los pesos reportados en un solo UPDATE. Retorna (tratadas, faltantes).
+    """
+    if not animales:
+        return [], []
+    marcas = list(dict.fromkeys(animal.marca for animal in animales))
+    # Si la marca se repite entre especies, gana el animal activo más reciente
+    cursor.execute('''
+    SELECT DISTINCT ON (marca_o_arete) marca_o_arete, id_externo
+    FROM animales
+    WHERE finca_id = %s AND marca_o_arete = ANY(%s)
+    ORDER BY marca_o_arete, (estado = 'activo') DESC, id DESC
+    ''', (finca_id, marcas))
+    ids = dict(cursor.fetchall())
+    tratadas = [marca for marca in marcas if marca in ids]
+    faltantes = [marca for marca in marcas if marca not in ids]
+    if tratadas:
+        fecha = datetime.date.today()
+        execute_values(cursor, '''
+        INSERT INTO salud_animal (id_externo, tipo, tratamiento, fecha, observacion, finca_id)
+        VALUES %s
+        ''', [(ids[marca], tipo, tratamiento, fecha, observacion, finca_id) for marca in tratadas], page_size=len(tratadas))
+    pesos = [(animal.marca, animal.peso) for animal in animales if animal.peso is not None and animal.marca in ids]
+    actualizar_pesos_animales(cursor, pesos, finca_id)
+    return tratadas, faltantes
 
 def generar_inventario_animales(finca_id):
-    """Genera un resumen del inventario de animales activos en la finca."""
+    """Primera página del inventario de animales activos (las siguientes se piden con 'más')."""
     try:
-        database_url = os.environ.get("DATABASE_URL")
-        with psycopg2.connect(database_url) as conn:
-            with conn.cursor() as cursor:
-                cursor.execute("""
-                SELECT especie, marca_o_arete, categoria, peso, corral
-                FROM animales
-                WHERE finca_id = %s AND estado = 'activo'
-                ORDER BY especie, marca_o_arete
-                """, (finca_id,))
-                animales = cursor.fetchall()
-                if not animales:
-                    return "📋 No hay animales activos registrados en esta finca."
-                bovinos = []
-                porcinos = []
-                otros = []
-                for esp, marca, cat, peso, corral in animales:
-                    linea = f"• {marca}"
-                    if cat:
-                        linea += f" – {cat}"
-                    if peso:
-                        linea += f" – {peso} kg"
-                    if corral:
-                        linea += f" – {corral}"
-                    if esp == "bovino":
-                        bovinos.append(linea)
-                    elif esp == "porcino":
-                        porcinos.append(linea)
-                    else:
-                        otros.append(linea)
-                lines = [
-                    "📋 INVENTARIO DE ANIMALES ACTIVOS",
-                    f"Fecha: {datetime.date.today().strftime('%d/%b/%Y')}",
-                    ""
-                ]
-                if bovinos:
-                    lines.append(f"🐮 BOVINOS ({len(bovinos)})")
-                    lines.extend(bovinos)
-                    lines.append("")
-                if porcinos:
-                    lines.append(f"🐷 PORCINOS ({len(porcinos)})")
-                    lines.extend(porcinos)
-                    lines.append("")
-                if otros:
-                    lines.append(f"🦘 OTROS ({len(otros)})")
-                    lines.extend(otros)
-                    lines.append("")
-                lines.append(f"✅ Total: {len(animales)} animales activos")
-                return "\n".join(lines)
+        return pagina_inventario(finca_id)[0]
     except Exception as e:
         print(f"❌ Error al generar inventario: {e}")
         return "❌ No se pudo cargar el inventario de animales."
 
-def guardar_registro(tipo_actividad, accion, detalle, lugar=None, cantidad=None, valor=0, unidad=None, observacion=None, jornales=None, finca_id=None, usuario_id=None, mensaje_completo=None):
+# Ganancia diaria de peso (GDP) por animal y por corral, calculada en SQL
+GananciaAnimal = namedtuple(
+    "GananciaAnimal",
+    "marca especie corral pesajes peso_inicial peso_actual dias gdp gdp_corral animales_corral"
+)
+
+def consultar_ganancia_diaria(cursor, finca_id, especie=None, corral=None):
+    """
+    GDP de los animales activos con al menos dos días pesados, con el cursor del
+    llamador. Un pesaje por día (el último); la GDP del corral es el promedio de
+    sus animales. Retorna una lista de GananciaAnimal ordenada por corral y GDP.
+    """
+    cursor.execute("""
+    WITH diarios AS (
+        SELECT DISTINCT ON (p.id_externo, p.fecha) p.id_externo, p.fecha, p.peso
+        FROM pesajes p
+        WHERE p.finca_id = %(finca)s
+        ORDER BY p.id_externo, p.fecha, p.id DESC
+    ), extremos AS (
+        SELECT id_externo, fecha, peso,
+               FIRST_VALUE(peso) OVER serie AS peso_inicial,
+               FIRST_VALUE(fecha) OVER serie AS fecha_inicial,
+               COUNT(*) OVER (PARTITION BY id_externo) AS pesajes,
+               ROW_NUMBER() OVER (PARTITION BY id_externo ORDER BY fecha DESC) AS orden
+        FROM diarios
+        WINDOW serie AS (PARTITION BY id_externo ORDER BY fecha)
+    ), ganancias AS (
+        SELECT a.marca_o_arete, a.especie, COALESCE(a.corral, '—') AS corral, e.pesajes,
+               e.peso_inicial, e.peso, e.fecha - e.fecha_inicial AS dias,
+               (e.peso - e.peso_inicial) / (e.fecha - e.fecha_inicial) AS gdp
+        FROM extremos e
+        JOIN animales a ON a.id_externo = e.id_externo AND a.finca_id = %(finca)s
+        WHERE e.orden = 1 AND e.pesajes > 1 AND a.estado = 'activo'
+        AND (%(especie)s::text IS NULL OR a.especie = %(especie)s)
+        AND (%(corral)s::text IS NULL OR a.corral = %(corral)s)
+    )
+    SELECT *,
+           AVG(gdp) OVER (PARTITION BY corral) AS gdp_corral,
+           COUNT(*) OVER (PARTITION BY corral) AS animales_corral
+    FROM ganancias
+    ORDER BY corral, gdp DESC
+    """, {"finca": finca_id, "especie": especie, "corral": corral})
+    return [GananciaAnimal(*fila) for fila in cursor.fetchall()]
+
+def generar_reporte_ganancia(finca_id):
+    """Resumen de ganancia diaria de peso por corral y por animal para WhatsApp."""
+    try:
+        return _con_cache(
+            finca_id, ("ganancia", datetime.date.today()),
+            lambda cursor: _formatear_ganancia(consultar_ganancia_diaria(cursor, finca_id))
+        )
+    except Exception as e:
+        print(f"❌ Error al calcular ganancia de peso: {e}")
+        return "❌ No se pudo calcular la ganancia de peso."
+
+def _formatear_ganancia(ganancias):
+    if not ganancias:
+        return (
+            "📈 Aún no hay animales con dos pesajes en días distintos.\n"
+            "💡 Incluye el peso al registrar ingreso o sanidad: 'marca A1 peso 320 kg'"
+        )
+    lines = [
+        "📈 GANANCIA DIARIA DE PESO (GDP)",
+        f"Fecha: {datetime.date.today().strftime('%d/%b/%Y')}",
+        ""
+    ]
+    corral_actual = None
+    for g in ganancias:
+        if g.corral != corral_actual:
+            corral_actual = g.corral
+            if len(lines) > 3:
+                lines.append("")
+            lines.append(f"🏠 Corral {g.corral}: {g.gdp_corral:.2f} kg/día ({g.animales_corral} animales)")
+        lines.append(f"• {g.marca}: {g.peso_inicial:.0f} → {g.peso_actual:.0f} kg en {g.dias} días = {g.gdp:.2f} kg/día")
+    return "\n".join(lines)
+
+_COLUMNAS_REGISTRO = "fecha, tipo_actividad, accion, detalle, lugar, cantidad, valor, unidad, observacion, jornales, fecha_registro, finca_id, usuario_id"
+_SQL_INSERTAR_REGISTROS = f"""
+WITH nuevos AS (
+    INSERT INTO registros ({_COLUMNAS_REGISTRO}) VALUES %s
+    RETURNING id, finca_id, fecha, tipo_actividad, valor, jornales
+), resumen AS ({_sql_acumular_resumen("nuevos", 1)})
+SELECT id FROM nuevos ORDER BY id
+"""
+_SQL_INSERTAR_REGISTRO = _SQL_INSERTAR_REGISTROS.replace("VALUES %s", f"VALUES ({', '.join(['%s'] * 13)})")
+
+def _fila_registro(tipo_actividad, accion, detalle, lugar=None, cantidad=None, valor=0, unidad=None, observacion=None, jornales=None, finca_id=None, usuario_id=None):
+    return (datetime.date.today(), tipo_actividad, accion, detalle, lugar, cantidad, valor, unidad, observacion, jornales, datetime.datetime.now(), finca_id, usuario_id)
+
+def _insertar_registro(cursor, tipo_actividad, accion, detalle, lugar=None, cantidad=None, valor=0, unidad=None, observacion=None, jornales=None, finca_id=None, usuario_id=None):
+    """INSERT en registros con el cursor del llamador (misma transacción). Retorna el id."""
+    cursor.execute(_SQL_INSERTAR_REGISTRO, _fila_registro(tipo_actividad, accion, detalle, lugar, cantidad, valor, unidad, observacion, jornales, finca_id, usuario_id))
+    return cursor.fetchone()[0]
+
+def _anotar_animales_registro(cursor, registro_id, detalle, n_animales):
+    """Agrega al detalle del registro cuántos animales se procesaron (se conoce después de tocar animales)."""
+    cursor.execute("UPDATE registros SET detalle = %s WHERE id = %s", (f"{detalle} ({n_animales} animales)", registro_id))
+
+_SQL_ELIMINAR_REGISTRO = f"""
+WITH borrados AS (
+    DELETE FROM registros WHERE id = %s AND finca_id = %s
+    RETURNING id, finca_id, fecha, tipo_actividad, valor, jornales
+), resumen AS ({_sql_acumular_resumen("borrados", -1)})
+SELECT id FROM borrados
+"""
+
+def eliminar_registro(cursor, registro_id, finca_id):
+    """Borra el registro de la finca y lo descuenta del resumen diario. Retorna True si existía."""
+    cursor.execute(_SQL_ELIMINAR_REGISTRO, (registro_id, finca_id))
+    return cursor.fetchone() is not None
+
+def reconstruir_resumen_diario(finca_id=None):
+    """Recalcula finca_resumen_diario desde registros (una finca o todas). Retorna las filas escritas."""
+    with obtener_conexion() as conn:
+        with conn.cursor() as cursor:
+            # Bloquea escrituras en registros mientras se recalcula
+            cursor.execute("LOCK TABLE registros IN SHARE MODE")
+            if finca_id is None:
+                cursor.execute("DELETE FROM finca_resumen_diario")
+                cursor.execute("INSERT INTO finca_resumen_diario " + _SQL_RESUMEN_DESDE_REGISTROS)
+            else:
+                cursor.execute("DELETE FROM finca_resumen_diario WHERE finca_id = %s", (finca_id,))
+                cursor.execute(
+                    "INSERT INTO finca_resumen_diario " + _SQL_RESUMEN_DESDE_REGISTROS.replace("WHERE finca_id IS NOT NULL", "WHERE finca_id = %s"),
+                    (finca_id,)
+                )
+            filas = cursor.rowcount
+    logger.info(f"🧮 Resumen diario reconstruido ({'todas las fincas' if finca_id is None else f'finca {finca_id}'}): {filas} filas")
+    return filas
+
+def consultar_finanzas(cursor, finca_id, inicio, fin, tipo_actividad=None):
+    """(ingresos, gastos, movimientos) del dashboard y el Excel, leídos del resumen diario."""
+    cursor.execute("""
+    SELECT COALESCE(SUM(valor) FILTER (WHERE tipo_actividad IN ('produccion', 'salida_animal')), 0),
+           COALESCE(SUM(valor) FILTER (WHERE tipo_actividad = 'gasto'), 0) + COALESCE(SUM(valor_jornales), 0),
+           COALESCE(SUM(conteo), 0)
+    FROM finca_resumen_diario
+    WHERE finca_id = %s AND dia BETWEEN %s AND %s
+    AND (%s::text IS NULL OR tipo_actividad = %s)
+    """, (finca_id, inicio, fin, tipo_actividad, tipo_actividad))
+    return cursor.fetchone()
+
+def upsert_animales(cursor, animales, especie, categoria_defecto, corral, finca_id):
+    """
+    Todos los MarcaAnimal en un solo INSERT ... ON CONFLICT (una ida y vuelta),
+    con el cursor del llamador. No pisa animales de otra finca con el mismo
+    id_externo. Retorna (marcas_guardadas, errores).
+    """
+    if not animales:
+        return [], []
+    prefijo = "C-" if especie == "porcino" else "V-M-"
+    filas = [
+        (especie, f"{prefijo}{marca}", marca, categoria or categoria_defecto, corral, "activo", peso, finca_id)
+        for marca, peso, categoria in animales
+    ]
+    guardadas = execute_values(cursor, '''
+    INSERT INTO animales (especie, id_externo, marca_o_arete, categoria, corral, estado, peso, finca_id)
+    VALUES %s
+    ON CONFLICT (id_externo) DO UPDATE
+    SET peso = COALESCE(EXCLUDED.peso, animales.peso),
+        estado = EXCLUDED.estado,
+        categoria = COALESCE(EXCLUDED.categoria, animales.categoria)
+    WHERE animales.finca_id = EXCLUDED.finca_id
+    RETURNING marca_o_arete
+    ''', filas, page_size=len(filas), fetch=True)
+    guardadas = {fila[0] for fila in guardadas}
+    marcas_guardadas = [animal.marca for animal in animales if animal.marca in guardadas]
+    errores = [f"{animal.marca}: registrada en otra finca" for animal in animales if animal.marca not in guardadas]
+    pesajes = [(finca_id, f"{prefijo}{marca}", peso) for marca, peso, _ in animales if peso is not None and marca in guardadas]
+    if pesajes:
+        execute_values(cursor, "INSERT INTO pesajes (finca_id, id_externo, peso) VALUES %s", pesajes, page_size=len(pesajes))
+    return marcas_guardadas, errores
+
+# Estado final del animal según el subtipo de salida
+ESTADOS_SALIDA = {"venta": "vendido", "muerte": "muerto"}
+
+def registrar_salida_animales(cursor, marcas, estado, nota, finca_id):
+    """
+    Da de baja todas las marcas activas de la finca en un solo UPDATE ... = ANY,
+    con el cursor del llamador. Retorna (encontradas, faltantes) en el orden de `marcas`.
+    """
+    if not marcas:
+        return [], []
+    cursor.execute('''
+    UPDATE animales
+    SET estado = %s, observaciones = %s
+    WHERE finca_id = %s AND marca_o_arete = ANY(%s) AND estado = 'activo'
+    RETURNING marca_o_arete
+    ''', (estado, nota, finca_id, list(marcas)))
+    actualizadas = {fila[0] for fila in cursor.fetchall()}
+    encontradas = [marca for marca in marcas if marca in actualizadas]
+    faltantes = [marca for marca in marcas if marca not in actualizadas]
+    return encontradas, faltantes
+
+def guardar_registro(tipo_actividad, accion, detalle, lugar=None, cantidad=None, valor=0, unidad=None, observacion=None, jornales=None, finca_id=None, usuario_id=None, mensaje_completo=None, cursor=None):
+    """
+    Inserta el registro y aplica los pesos de `mensaje_completo` en la misma transacción.
+    Con `cursor` escribe en la transacción del llamador y los errores se propagan;
+    sin él abre la suya. Retorna el id del registro, o None si no se pudo guardar.
+    """
+    if cursor is not None:
+        return _guardar_registro_con_pesos(cursor, tipo_actividad, accion, detalle, lugar, cantidad, valor, unidad, observacion, jornales, finca_id, usuario_id, mensaje_completo)
     print(f"🔍 GUARDANDO REGISTRO en finca {finca_id}: {tipo_actividad} | {detalle}")
     try:
-        database_url = os.environ.get("DATABASE_URL")
-        if not database_url:
-            print("❌ DATABASE_URL no está definida")
-            return
-        fecha = datetime.date.today().isoformat()
-        with psycopg2.connect(database_url) as conn:
+        buffer = escritura_agrupada()
+        if buffer is not None and not any(animal.peso is not None for animal in extraer_marcas(mensaje_completo or "")):
+            # Sin pesos que aplicar: el registro viaja en el próximo lote (group commit)
+            registro_id = buffer.guardar(_fila_registro(tipo_actividad, accion, detalle, lugar, cantidad, valor, unidad, observacion, jornales, finca_id, usuario_id))
+            print(f"✅ REGISTRO GUARDADO en finca {finca_id} (id {registro_id}, agrupado)")
+            return registro_id
+        with obtener_conexion() as conn:
             with conn.cursor() as cursor:
-                cursor.execute('''
-                INSERT INTO registros (fecha, tipo_actividad, accion, detalle, lugar, cantidad, valor, unidad, observacion, jornales, fecha_registro, finca_id, usuario_id)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                ''', (fecha, tipo_actividad, accion, detalle, lugar, cantidad, valor, unidad, observacion, jornales, datetime.datetime.now().isoformat(), finca_id, usuario_id))
-                conn.commit()
-                print(f"✅ REGISTRO GUARDADO en finca {finca_id}")
-                # === EXTRAER PESO Y MARCA DE CUALQUIER MENSAJE ===
-                if mensaje_completo and finca_id:
-                    peso_match = re.search(r"peso\s*(\d+(?:\.\d+)?)\s*(?:kg|kilo|kilos)", mensaje_completo, re.IGNORECASE)
-                    if peso_match:
-                        nuevo_peso = float(peso_match.group(1))
-                        marca_match = re.search(r"(?:marca|arete|chapeta)\s+([a-z0-9-]+)", mensaje_completo, re.IGNORECASE)
-                        if marca_match:
-                            marca_o_arete = marca_match.group(1).upper()
-                            actualizar_peso_animal(marca_o_arete, nuevo_peso, finca_id)
+                registro_id = _guardar_registro_con_pesos(cursor, tipo_actividad, accion, detalle, lugar, cantidad, valor, unidad, observacion, jornales, finca_id, usuario_id, mensaje_completo)
+        print(f"✅ REGISTRO GUARDADO en finca {finca_id} (id {registro_id})")
+        return registro_id
     except Exception as e:
         print(f"❌ ERROR AL GUARDAR REGISTRO: {e}")
         import traceback
         print(traceback.format_exc())
+        return None
 
-def generar_reporte(frecuencia="semanal", formato="texto", finca_id=None):
+def _guardar_registro_con_pesos(cursor, tipo_actividad, accion, detalle, lugar, cantidad, valor, unidad, observacion, jornales, finca_id, usuario_id, mensaje_completo):
+    registro_id = _insertar_registro(cursor, tipo_actividad, accion, detalle, lugar, cantidad, valor, unidad, observacion, jornales, finca_id, usuario_id)
+    # === EXTRAER PESO Y MARCA DE CUALQUIER MENSAJE ===
+    if mensaje_completo and finca_id:
+        pesos = [(marca, peso) for marca, peso, _ in extraer_marcas(mensaje_completo) if peso is not None]
+        actualizar_pesos_animales(cursor, pesos, finca_id)
+    return registro_id
+
+# === CACHÉ DE RESULTADOS POR VERSIÓN DE DATOS ===
+# Cada escritura en registros, animales o salud_animal sube finca_version (triggers
+# de la migración 18). Reportes, dashboard y exportaciones se guardan con la clave
+# (finca_id, versión, parámetros): si nada cambió se sirven de memoria, y las
+# versiones viejas salen solas del LRU.
+_CACHE_RESULTADOS = CacheTTL(
+    max_entradas=_entero_env("RESULTADOS_CACHE_MAX", 500),
+    ttl=_entero_env("RESULTADOS_CACHE_TTL", 86400),
+    # Guarda Excel y HTML del dashboard: el tope real es de bytes, no de entradas
+    max_bytes=_entero_env("RESULTADOS_CACHE_MAX_BYTES", 32 * 1024 * 1024)
+)
+
+def version_finca(cursor, finca_id):
+    cursor.execute("SELECT version FROM finca_version WHERE finca_id = %s", (finca_id,))
+    fila = cursor.fetchone()
+    return fila[0] if fila else 0
+
+def tocar_version_finca(cursor, finca_id):
+    """Invalida los resultados de la finca por cambios fuera de las tablas con trigger (p. ej. la suscripción)."""
+    cursor.execute("""
+    INSERT INTO finca_version (finca_id, version) VALUES (%s, nextval('finca_version_seq'))
+    ON CONFLICT (finca_id) DO UPDATE SET version = EXCLUDED.version
+    """, (finca_id,))
+
+def resultado_en_cache(finca_id, version, parametros):
+    return _CACHE_RESULTADOS.get((finca_id, version, parametros))
+
+def guardar_resultado(finca_id, version, parametros, valor):
+    _CACHE_RESULTADOS.set((finca_id, version, parametros), valor)
+
+def limpiar_cache_resultados():
+    _CACHE_RESULTADOS.limpiar()
+
+def estadisticas_cache_resultados():
+    return _CACHE_RESULTADOS.estadisticas()
+
+def _con_cache(finca_id, parametros, calcular):
+    """Retorna el resultado cacheado para la versión actual de la finca o lo calcula con calcular(cursor)."""
+    with obtener_conexion() as conn:
+        with conn.cursor() as cursor:
+            version = version_finca(cursor, finca_id)
+            resultado = resultado_en_cache(finca_id, version, parametros)
+            if resultado is None:
+                resultado = calcular(cursor)
+                guardar_resultado(finca_id, version, parametros, resultado)
+    return resultado
+
+# === MOTOR DE REPORTES: TOTALES DEL RESUMEN DIARIO, EL DETALLE SE PAGINA ===
+_DIAS_FRECUENCIA = {"diario": 1, "semanal": 7, "quincenal": 15, "mensual": 30}
+
+DatosReporte = namedtuple(
+    "DatosReporte",
+    "inicio fin registros ingresos gastos jornales_valor num_gastos otras_por_tipo productos"
+)
+
+def consultar_datos_reporte(cursor, finca_id, inicio, fin):
+    """
+    Totales del periodo desde finca_resumen_diario (una fila por día y tipo)
+    y producción agrupada por producto. Retorna DatosReporte; los movimientos
+    se leen aparte, por páginas, con consultar_movimientos.
+    """
+    cursor.execute("""
+    SELECT tipo_actividad, SUM(conteo), SUM(valor_positivo), SUM(valor_jornales_positivo)
+    FROM finca_resumen_diario
+    WHERE finca_id = %s AND dia BETWEEN %s AND %s
+    GROUP BY tipo_actividad
+    HAVING SUM(conteo) > 0
+    """, (finca_id, inicio, fin))
+    registros = ingresos = gastos = jornales_valor = num_gastos = num_produccion = 0
+    otras_por_tipo = {}
+    for tipo, n, valor, valor_jornales in cursor.fetchall():
+        registros += n
+        jornales_valor += valor_jornales
+        if tipo == "produccion":
+            ingresos, num_produccion = valor, n
+        elif tipo == "gasto":
+            gastos, num_gastos = valor, n
+        else:
+            otras_por_tipo[tipo] = n
+
+    productos = []
+    if num_produccion:
+        cursor.execute("""
+        SELECT MIN(detalle), COALESCE(unidad, ''), COALESCE(SUM(cantidad), 0),
+               COALESCE(SUM(valor::float8) FILTER (WHERE valor > 0), 0), COUNT(*),
+               CASE WHEN MIN(lugar) = MAX(lugar) THEN MIN(lugar) END
+        FROM registros
+        WHERE finca_id = %s AND fecha BETWEEN %s AND %s AND tipo_actividad = 'produccion'
+        AND COALESCE(TRIM(detalle), '') <> ''
+        GROUP BY LOWER(TRIM(detalle)), COALESCE(unidad, '')
+        """, (finca_id, inicio, fin))
+        productos = sorted(cursor.fetchall(), key=lambda p: p[0].lower())
+    return DatosReporte(inicio, fin, registros, ingresos, gastos, jornales_valor, num_gastos, otras_por_tipo, productos)
+
+def consultar_movimientos(cursor, finca_id, inicio, fin, despues=None, limite=None):
+    """
+    Movimientos del periodo (todo menos producción) en orden (fecha, id),
+    a partir del cursor `despues` = (fecha, id) de la última fila enviada.
+    Keyset sobre idx_registros_finca_fecha_id: cada página lee solo sus filas.
+    """
+    limite = PAGINA_FILAS + 1 if limite is None else limite
+    fecha, registro_id = despues or (inicio, 0)
+    cursor.execute("""
+    SELECT fecha, id, tipo_actividad, detalle, lugar, cantidad, valor, unidad, observacion, jornales
+    FROM registros
+    WHERE finca_id = %s AND fecha BETWEEN %s AND %s AND tipo_actividad <> 'produccion'
+    AND (fecha, id) > (%s, %s)
+    ORDER BY fecha, id
+    LIMIT %s
+    """, (finca_id, inicio, fin, fecha, registro_id, limite))
+    return cursor.fetchall()
+
+def _cantidad_texto(cantidad):
+    return f"{cantidad:,.2f}".rstrip("0").rstrip(".") if cantidad else "0"
+
+def _linea_movimiento(row):
+    fecha, _, tipo, detalle, lugar, cantidad, valor, unidad, observacion, jornales = row
+    desc = f"• {fecha.strftime('%d/%m')} {tipo.replace('_', ' ').title()}: {detalle or 'actividad'}"
+    if lugar: desc += f" en {lugar}"
+    if cantidad:
+        desc += f" ({_cantidad_texto(cantidad)} {unidad or ''})".replace(" )", ")")
+    if jornales: desc += f" ({jornales} jornales)"
+    if valor and valor > 0: desc += f" → ${valor:,.0f}"
+    if observacion: desc += f". Obs: {observacion}"
+    return desc
+
+def formatear_reporte(datos, titulo):
+    """Resumen de WhatsApp (primera página) a partir de DatosReporte, sin la producción por producto."""
+    if not datos.registros:
+        return f"⚠️ No hay actividades registradas del {datos.inicio.strftime('%d/%m')} al {datos.fin.strftime('%d/%m')}."
+    return "\n".join(_lineas_resumen(datos, titulo))
+
+def _lineas_resumen(datos, titulo):
+    lines = [f"📅 {titulo}", f"Del {datos.inicio.strftime('%d/%m')} al {datos.fin.strftime('%d/%m')}", ""]
+    lines.append("📊 RESUMEN FINANCIERO")
+    lines.append(f"• Ingresos: ${datos.ingresos:,.0f}")
+    lines.append(f"• Gastos: ${datos.gastos:,.0f}")
+    lines.append(f"• Jornales: ${datos.jornales_valor:,.0f}")
+    balance = datos.ingresos - datos.gastos - datos.jornales_valor
+    lines.append(f"• Balance estimado: ${balance:,.0f}")
+    lines.append("")
+    if datos.num_gastos:
+        lines.append("💰 GASTOS")
+        lines.append(f"• Registros: {datos.num_gastos}")
+        if datos.gastos > 0:
+            lines.append(f"→ **TOTAL GASTOS: ${datos.gastos:,.0f}**")
+        lines.append("")
+    if datos.jornales_valor > 0:
+        lines.append("👷 COSTO TOTAL DE JORNALES")
+        lines.append(f"→ **${datos.jornales_valor:,.0f}**")
+        lines.append("")
+    if datos.otras_por_tipo:
+        lines.append("📝 OTRAS ACTIVIDADES")
+        for tipo, n in sorted(datos.otras_por_tipo.items()):
+            lines.append(f"• {tipo.replace('_', ' ').title()}: {n}")
+        lines.append("")
+    return lines
+
+def _filas_productos(datos):
+    """[(encabezado, línea), ...] de la producción agrupada por producto, la vegetal primero."""
+    es_cultivo = [clasificar_texto(p[0]).cultivo for p in datos.productos]
+    filas = []
+    for encabezado, cultivo in (("🌽 PRODUCCIÓN VEGETAL", True), ("🥛🥩 PRODUCCIÓN ANIMAL", False)):
+        for (nombre, unidad, cantidad, venta, n, lugar), c in zip(datos.productos, es_cultivo):
+            if c != cultivo:
+                continue
+            desc = f"• {_cantidad_texto(cantidad)} {unidad} de {nombre}".replace("  ", " ")
+            if lugar: desc += f" del {lugar}"
+            if n > 1: desc += f" ({n} registros)"
+            if venta > 0: desc += f" → Venta: ${venta:,.0f}"
+            filas.append((encabezado, desc))
+    return filas
+
+def _formato_con_encabezados():
+    """Formateador de filas (encabezado, línea) que escribe el encabezado al empezar cada sección de la página."""
+    anterior = []
+    def formatear(fila):
+        encabezado, linea = fila
+        if anterior and anterior[-1] == encabezado:
+            return linea
+        separador = "\n" if anterior else ""
+        anterior.append(encabezado)
+        return f"{separador}{encabezado}\n{linea}"
+    return formatear
+
+def _calcular_pagina_reporte(cursor, finca_id, inicio, fin, titulo, despues=None, pagina=1):
+    """
+    Página desde `despues`: None (la primera, con el resumen), ["productos", i]
+    (sigue la producción desde el producto i) o [fecha ISO, id] (sigue los movimientos).
+    Producción y movimientos cuentan contra PAGINA_CARACTERES.
+    """
+    formatear = _formato_con_encabezados()
+    if despues is None or despues[0] == _CURSOR_PRODUCTOS:
+        datos = consultar_datos_reporte(cursor, finca_id, inicio, fin)
+        if despues is None:
+            if not datos.registros:
+                return formatear_reporte(datos, titulo), None
+            lineas, desde = _lineas_resumen(datos, titulo), 0
+        else:
+            lineas, desde = [f"📅 {titulo} (pág. {pagina})", ""], despues[1]
+        productos = _filas_productos(datos)[desde:]
+        n = _llenar_pagina(lineas, productos, formatear)
+        if n < len(productos):
+            return "\n".join(lineas), [_CURSOR_PRODUCTOS, desde + n]
+        hay_movimientos = bool(datos.num_gastos or datos.otras_por_tipo)
+        cursor_fecha = None
+    else:
+        lineas = [f"📅 {titulo} (pág. {pagina})", ""]
+        hay_movimientos = True
+        cursor_fecha = (datetime.date.fromisoformat(despues[0]), despues[1])
+        productos = []
+    siguiente = None
+    if hay_movimientos:
+        filas = consultar_movimientos(cursor, finca_id, inicio, fin, cursor_fecha)
+        # Si la producción ya ocupó la página, los movimientos pueden empezar en la siguiente
+        n = _llenar_pagina(
+            lineas, filas, lambda fila: formatear(("📋 MOVIMIENTOS", _linea_movimiento(fila))),
+            al_menos_una=not productos
+        )
+        if n < len(filas):
+            siguiente = [filas[n - 1][0].isoformat(), filas[n - 1][1]] if n else [inicio.isoformat(), 0]
+    if siguiente is None:
+        if lineas[-1]:
+            lineas.append("")
+        lineas.append("✅ Todo bajo control. ¡Buen trabajo!")
+    return "\n".join(lineas), siguiente
+
+def pagina_reporte(finca_id, inicio, fin, titulo, despues=None, pagina=1):
+    """
+    Una página del reporte: la primera trae el resumen y todas traen la
+    producción y los movimientos que quepan desde el cursor `despues`.
+    La primera sale de reportes_precalculados si no hubo escrituras desde entonces.
+    Retorna (texto, siguiente cursor o None si era la última).
+    """
+    def calcular(cursor):
+        if despues is None:
+            guardado = leer_reporte_precalculado(cursor, finca_id, inicio, fin, titulo)
+            if guardado is not None:
+                return guardado
+        return _calcular_pagina_reporte(cursor, finca_id, inicio, fin, titulo, despues, pagina)
+    return _con_cache(
+        finca_id, ("reporte", inicio, fin, titulo, pagina, tuple(despues or ())), calcular
+    )
+
+def rango_reporte(frecuencia="semanal"):
+    """(inicio, fin, título) de los últimos días según la frecuencia (diario, semanal, quincenal, mensual)."""
+    hoy = datetime.date.today()
+    inicio = hoy - datetime.timedelta(days=_DIAS_FRECUENCIA.get(frecuencia, 7))
+    return inicio, hoy, f"REPORTE {frecuencia.upper()}"
+
+def generar_reporte_periodo(fecha_inicio, fecha_fin, titulo, finca_id=None):
+    """Primera página del reporte de cualquier rango de fechas."""
     if finca_id is None:
         return "❌ No se puede generar reporte sin finca."
-    hoy = datetime.date.today()
-    dias_map = {"diario": 1, "semanal": 7, "quincenal": 15, "mensual": 30}
-    dias = dias_map.get(frecuencia, 7)
-    inicio = hoy - datetime.timedelta(days=dias)
-    periodo = f"Del {inicio.strftime('%d/%m')} al {hoy.strftime('%d/%m')}"
     try:
-        database_url = os.environ.get("DATABASE_URL")
-        with psycopg2.connect(database_url) as conn:
-            with conn.cursor() as cursor:
-                cursor.execute("""
-                SELECT fecha, tipo_actividad, accion, detalle, lugar, cantidad, valor, unidad, observacion, jornales
-                FROM registros
-                WHERE fecha >= %s AND finca_id = %s
-                ORDER BY fecha, tipo_actividad
-                """, (inicio.isoformat(), finca_id))
-                registros = cursor.fetchall()
-                print(f"📊 Reporte cargado: {len(registros)} registros desde {inicio} (finca {finca_id})")
+        return pagina_reporte(finca_id, fecha_inicio, fecha_fin, titulo)[0]
     except Exception as e:
         return f"❌ Error al leer la base de datos: {e}"
-    
-    if formato == "texto":
-        lines = [f"📅 REPORTE {frecuencia.upper()}", periodo, ""]
-        total_ingresos = 0
-        total_gastos = 0
-        total_jornales_valor = 0
-        produccion_total = [r for r in registros if r[1] == "produccion"]
-        gastos = [r for r in registros if r[1] == "gasto"]
-        actividades_con_jornales = [r for r in registros if r[9] and r[9] > 0]
-        for row in produccion_total:
-            if row[6] > 0:
-                total_ingresos += row[6]
-        for row in gastos:
-            if row[6] > 0:
-                total_gastos += row[6]
-        for row in actividades_con_jornales:
-            if row[6] > 0:
-                total_jornales_valor += row[6]
-        lines.append("📊 RESUMEN FINANCIERO")
-        lines.append(f"• Ingresos: ${total_ingresos:,.0f}")
-        lines.append(f"• Gastos: ${total_gastos:,.0f}")
-        lines.append(f"• Jornales: ${total_jornales_valor:,.0f}")
-        balance = total_ingresos - total_gastos - total_jornales_valor
-        lines.append(f"• Balance estimado: ${balance:,.0f}")
-        lines.append("")
-        if produccion_total:
-            vegetal = []
-            animal = []
-            cultivos = {"maíz", "papa", "arroz", "cacao", "café", "yuca", "plátano", "frijol", "citricos", "cebolla","fruta"}
-            for row in produccion_total:
-                detalle = (row[3] or "").lower()
-                if any(cultivo in detalle for cultivo in cultivos):
-                    vegetal.append(row)
-                else:
-                    animal.append(row)
-            if vegetal:
-                lines.append("🌽 PRODUCCIÓN VEGETAL")
-                for row in vegetal:
-                    desc = f"• {row[5]} {row[7]} de {row[3]}"
-                    if row[4]: desc += f" del {row[4]}"
-                    if row[6] > 0: desc += f" → Venta: ${row[6]:,.0f}"
-                    if row[8]: desc += f". Obs: {row[8]}"
-                    lines.append(desc)
-                lines.append("")
-            if animal:
-                lines.append("🥛🥩 PRODUCCIÓN ANIMAL")
-                for row in animal:
-                    if not row[3]: continue
-                    desc = f"• {row[5]} {row[7]} de {row[3]}"
-                    if row[4]: desc += f" del {row[4]}"
-                    if row[6] > 0: desc += f" → Venta: ${row[6]:,.0f}"
-                    if row[8]: desc += f". Obs: {row[8]}"
-                    lines.append(desc)
-                lines.append("")
-        if gastos:
-            lines.append("💰 GASTOS")
-            for row in gastos:
-                cantidad = row[5] if row[5] is not None else ""
-                unidad = row[7] or ""
-                valor = row[6] if row[6] > 0 else 0
-                desc = f"• {row[3] or 'Gasto'}"
-                if cantidad and unidad:
-                    desc += f" ({cantidad} {unidad})"
-                elif cantidad:
-                    desc += f" ({cantidad})"
-                if valor > 0:
-                    desc += f" → ${valor:,.0f}"
-                if row[8]:
-                    desc += f". Obs: {row[8]}"
-                lines.append(desc)
-            if total_gastos > 0:
-                lines.append(f"→ **TOTAL GASTOS: ${total_gastos:,.0f}**")
-                lines.append("")
-        if total_jornales_valor > 0:
-            lines.append("👷 COSTO TOTAL DE JORNALES")
-            lines.append(f"→ **${total_jornales_valor:,.0f}**")
-            lines.append("")
-        otras_actividades = [r for r in registros if r[1] not in ["produccion", "gasto"]]
-        if otras_actividades:
-            lines.append("📝 OTRAS ACTIVIDADES")
-            for row in otras_actividades:
-                tipo = row[1].replace("_", " ").title()
-                desc = f"• {tipo}: {row[3] or 'actividad'}"
-                if row[4]: desc += f" en {row[4]}"
-                if row[5] and row[7]:
-                    desc += f" ({row[5]} {row[7]})"
-                if row[9]:
-                    desc += f" ({row[9]} jornales)"
-                if row[8]:
-                    desc += f". Obs: {row[8]}"
-                lines.append(desc)
-            lines.append("")
-        lines.append("✅ Todo bajo control. ¡Buen trabajo!")
-        return "\n".join(lines)
-    return registros
+
+def generar_reporte(frecuencia="semanal", formato="texto", finca_id=None):
+    """Primera página del reporte de la frecuencia. Solo hay formato texto (el Excel sale del dashboard)."""
+    if formato != "texto":
+        raise ValueError(f"Formato de reporte no soportado: {formato}")
+    return generar_reporte_periodo(*rango_reporte(frecuencia), finca_id=finca_id)
 
 def generar_reporte_personalizado(fecha_inicio, fecha_fin, finca_id=None):
-    if finca_id is None:
-        return "❌ No se puede generar reporte sin finca."
+    return generar_reporte_periodo(fecha_inicio, fecha_fin, "REPORTE PERSONALIZADO", finca_id=finca_id)
+
+# === REPORTES PRECALCULADOS (programador.py) ===
+# Guardados con la versión de datos leída ANTES de calcular: si entra una
+# escritura mientras tanto la versión ya no coincide y la copia no se sirve.
+def leer_reporte_precalculado(cursor, finca_id, inicio, fin, titulo):
+    """(texto, siguiente) guardado para ese rango si la finca no cambió desde entonces; si no, None."""
+    cursor.execute("""
+    SELECT r.texto, r.siguiente
+    FROM reportes_precalculados r
+    WHERE r.finca_id = %s AND r.titulo = %s AND r.inicio = %s AND r.fin = %s
+    AND r.version = COALESCE((SELECT version FROM finca_version WHERE finca_id = r.finca_id), 0)
+    """, (finca_id, titulo, inicio, fin))
+    fila = cursor.fetchone()
+    return (fila[0], fila[1]) if fila else None
+
+def precalcular_reporte(finca_id, frecuencia="semanal"):
+    """
+    Calcula y guarda la primera página del reporte de la finca, salvo que la
+    copia guardada siga al día. Retorna (texto, siguiente, recalculado).
+    """
+    inicio, fin, titulo = rango_reporte(frecuencia)
+    with obtener_conexion() as conn:
+        with conn.cursor() as cursor:
+            guardado = leer_reporte_precalculado(cursor, finca_id, inicio, fin, titulo)
+            if guardado is not None:
+                return guardado + (False,)
+            version = version_finca(cursor, finca_id)
+            texto, siguiente = _calcular_pagina_reporte(cursor, finca_id, inicio, fin, titulo)
+            cursor.execute("""
+            INSERT INTO reportes_precalculados (finca_id, titulo, inicio, fin, version, texto, siguiente)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (finca_id, titulo) DO UPDATE
+            SET inicio = EXCLUDED.inicio, fin = EXCLUDED.fin, version = EXCLUDED.version,
+                texto = EXCLUDED.texto, siguiente = EXCLUDED.siguiente, generado_en = NOW()
+            """, (finca_id, titulo, inicio, fin, version, texto, Json(siguiente)))
+    return texto, siguiente, True
+
+def fincas_activas():
+    """[(finca_id, nombre, [whatsapp de los dueños]), ...] de las fincas con suscripción vigente."""
+    with obtener_conexion() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+            SELECT f.id, f.nombre, ARRAY_REMOVE(ARRAY_AGG(u.telefono_whatsapp ORDER BY u.id), NULL)
+            FROM fincas f
+            LEFT JOIN usuarios u ON u.finca_id = f.id AND u.rol = 'dueño'
+            WHERE f.suscripcion_activa
+            AND (f.vencimiento_suscripcion IS NULL OR f.vencimiento_suscripcion >= CURRENT_DATE)
+            GROUP BY f.id
+            ORDER BY f.id
+            """)
+            return cursor.fetchall()
+
+# === PAGINADO DE REPORTES E INVENTARIOS: CURSOR KEYSET EN EL ESTADO DE LA CONVERSACIÓN ===
+# Cada página lee a lo sumo PAGINA_FILAS + 1 filas desde la última enviada
+# (sin OFFSET) y corta antes de PAGINA_CARACTERES (Twilio parte WhatsApp en 1600).
+PAGINA_FILAS = _entero_env("PAGINA_FILAS", 25)
+PAGINA_CARACTERES = _entero_env("PAGINA_CARACTERES", 1500)
+_PALABRAS_MAS = frozenset(["más", "mas", "siguiente"])
+_CURSOR_PRODUCTOS = "productos"
+_ICONOS_ESPECIE = {"bovino": "🐮", "porcino": "🐷"}
+
+def _llenar_pagina(lineas, filas, formatear, al_menos_una=True):
+    """
+    Agrega filas a `lineas` hasta PAGINA_FILAS o PAGINA_CARACTERES contando lo
+    que ya tiene la página. Con al_menos_una, la primera entra siempre (recortada
+    si no cabe). Retorna cuántas entraron.
+    """
+    usados = sum(len(linea) + 1 for linea in lineas)
+    n = 0
+    for fila in filas[:PAGINA_FILAS]:
+        linea = formatear(fila)
+        if usados + len(linea) + 1 > PAGINA_CARACTERES:
+            if n or not al_menos_una:
+                break
+            linea = linea[:max(PAGINA_CARACTERES - usados - 2, 0)] + "…"
+        lineas.append(linea)
+        usados += len(linea) + 1
+        n += 1
+    return n
+
+def _linea_animal(row):
+    marca, _, especie, categoria, peso, corral = row
+    linea = f"• {_ICONOS_ESPECIE.get(especie, '🦘')} {marca}"
+    if categoria:
+        linea += f" – {categoria}"
+    if peso:
+        linea += f" – {peso} kg"
+    if corral:
+        linea += f" – {corral}"
+    return linea
+
+def pagina_inventario(finca_id, despues=None, pagina=1):
+    """
+    Una página del inventario de animales activos en orden (marca_o_arete, id),
+    desde el cursor `despues` = [marca, id]; la primera trae los totales por especie.
+    Retorna (texto, siguiente cursor o None si era la última).
+    """
+    def calcular(cursor):
+        if despues is None:
+            cursor.execute("""
+            SELECT especie, COUNT(*) FROM animales
+            WHERE finca_id = %s AND estado = 'activo'
+            GROUP BY especie
+            """, (finca_id,))
+            conteos = dict(cursor.fetchall())
+            if not conteos:
+                return "📋 No hay animales activos registrados en esta finca.", None
+            lineas = [
+                "📋 INVENTARIO DE ANIMALES ACTIVOS",
+                f"Fecha: {datetime.date.today().strftime('%d/%b/%Y')}",
+                ""
+            ]
+            otros = sum(n for especie, n in conteos.items() if especie not in _ICONOS_ESPECIE)
+            if conteos.get("bovino"):
+                lineas.append(f"🐮 BOVINOS: {conteos['bovino']}")
+            if conteos.get("porcino"):
+                lineas.append(f"🐷 PORCINOS: {conteos['porcino']}")
+            if otros:
+                lineas.append(f"🦘 OTROS: {otros}")
+            lineas.append(f"✅ Total: {sum(conteos.values())} animales activos")
+            lineas.append("")
+        else:
+            lineas = [f"📋 INVENTARIO DE ANIMALES ACTIVOS (pág. {pagina})", ""]
+        marca, animal_id = despues or ("", 0)
+        cursor.execute("""
+        SELECT marca_o_arete, id, especie, categoria, peso, corral
+        FROM animales
+        WHERE finca_id = %s AND estado = 'activo' AND (marca_o_arete, id) > (%s, %s)
+        ORDER BY marca_o_arete, id
+        LIMIT %s
+        """, (finca_id, marca, animal_id, PAGINA_FILAS + 1))
+        filas = cursor.fetchall()
+        n = _llenar_pagina(lineas, filas, _linea_animal)
+        siguiente = [filas[n - 1][0], filas[n - 1][1]] if n < len(filas) else None
+        return "\n".join(lineas), siguiente
+    return _con_cache(finca_id, ("inventario", datetime.date.today(), pagina, tuple(despues or ())), calcular)
+
+def _sin_flujo(state):
+    """True si el estado no tiene un registro a medias (solo guarda el paginado)."""
+    return state.step == "waiting_for_category" and not state.tipo
+
+def responder_pagina(usuario_info, paginado, parametros=(), despues=None, pagina=1):
+    """
+    Genera una página de `paginado` ("reporte" o "inventario") y guarda en el
+    estado de la conversación el cursor de la siguiente, que se pide con 'más'.
+    """
+    finca_id = usuario_info["finca_id"]
     try:
-        database_url = os.environ.get("DATABASE_URL")
-        with psycopg2.connect(database_url) as conn:
-            with conn.cursor() as cursor:
-                cursor.execute("""
-                SELECT fecha, tipo_actividad, accion, detalle, lugar, cantidad, valor, unidad, observacion, jornales
-                FROM registros
-                WHERE fecha BETWEEN %s AND %s AND finca_id = %s
-                ORDER BY fecha
-                """, (fecha_inicio.isoformat(), fecha_fin.isoformat(), finca_id))
-                registros = cursor.fetchall()
-                print(f"📊 Reporte personalizado: {len(registros)} registros del {fecha_inicio} al {fecha_fin}")
+        if paginado == "reporte":
+            inicio, fin, titulo = parametros
+            texto, siguiente = pagina_reporte(
+                finca_id, datetime.date.fromisoformat(inicio), datetime.date.fromisoformat(fin),
+                titulo, despues, pagina
+            )
+        else:
+            texto, siguiente = pagina_inventario(finca_id, despues, pagina)
     except Exception as e:
+        print(f"❌ Error al generar página {pagina} de {paginado}: {e}")
         return f"❌ Error al leer la base de datos: {e}"
-    if not registros:
-        return f"⚠️ No hay actividades registradas del {fecha_inicio.strftime('%d/%m')} al {fecha_fin.strftime('%d/%m')}."
-    lines = [
-        f"📅 REPORTE PERSONALIZADO",
-        f"Del {fecha_inicio.strftime('%d/%m')} al {fecha_fin.strftime('%d/%m')}",
-        ""
-    ]
-    total_ingresos = 0
-    total_gastos = 0
-    total_jornales_valor = 0
-    produccion_total = [r for r in registros if r[1] == "produccion"]
-    gastos = [r for r in registros if r[1] == "gasto"]
-    actividades_con_jornales = [r for r in registros if r[9] and r[9] > 0]
-    for row in produccion_total:
-        if row[6] > 0:
-            total_ingresos += row[6]
-    for row in gastos:
-        if row[6] > 0:
-            total_gastos += row[6]
-    for row in actividades_con_jornales:
-        if row[6] > 0:
-            total_jornales_valor += row[6]
-    lines.append("📊 RESUMEN FINANCIERO")
-    lines.append(f"• Ingresos: ${total_ingresos:,.0f}")
-    lines.append(f"• Gastos: ${total_gastos:,.0f}")
-    lines.append(f"• Jornales: ${total_jornales_valor:,.0f}")
-    balance = total_ingresos - total_gastos - total_jornales_valor
-    lines.append(f"• Balance estimado: ${balance:,.0f}")
-    lines.append("")
-    if produccion_total:
-        vegetal = []
-        animal = []
-        cultivos = {"maíz", "papa", "arroz", "cacao", "café", "yuca", "plátano", "frijol", "trigo", "cebolla","frutas","citricos"}
-        for row in produccion_total:
-            detalle = (row[3] or "").lower()
-            if any(cultivo in detalle for cultivo in cultivos):
-                vegetal.append(row)
-            else:
-                animal.append(row)
-        if vegetal:
-            lines.append("🌽 PRODUCCIÓN VEGETAL")
-            for row in vegetal:
-                desc = f"• {row[5]} {row[7]} de {row[3]}"
-                if row[4]: desc += f" del {row[4]}"
-                if row[6] > 0: desc += f" → Venta: ${row[6]:,.0f}"
-                if row[8]: desc += f". Obs: {row[8]}"
-                lines.append(desc)
-            lines.append("")
-        if animal:
-            lines.append("🥛🥩 PRODUCCIÓN ANIMAL")
-            for row in animal:
-                if not row[3]: continue
-                desc = f"• {row[5]} {row[7]} de {row[3]}"
-                if row[4]: desc += f" del {row[4]}"
-                if row[6] > 0: desc += f" → Venta: ${row[6]:,.0f}"
-                if row[8]: desc += f". Obs: {row[8]}"
-                lines.append(desc)
-            lines.append("")
-    if gastos:
-        lines.append("💰 GASTOS")
-        for row in gastos:
-            cantidad = row[5] if row[5] is not None else ""
-            unidad = row[7] or ""
-            valor = row[6] if row[6] > 0 else 0
-            desc = f"• {row[3] or 'Gasto'}"
-            if cantidad and unidad:
-                desc += f" ({cantidad} {unidad})"
-            elif cantidad:
-                desc += f" ({cantidad})"
-            if valor > 0:
-                desc += f" → ${valor:,.0f}"
-            if row[8]:
-                desc += f". Obs: {row[8]}"
-            lines.append(desc)
-        if total_gastos > 0:
-            lines.append(f"→ **TOTAL GASTOS: ${total_gastos:,.0f}**")
-            lines.append("")
-    if total_jornales_valor > 0:
-        lines.append("👷 COSTO TOTAL DE JORNALES")
-        lines.append(f"→ **${total_jornales_valor:,.0f}**")
-        lines.append("")
-    otras_actividades = [r for r in registros if r[1] not in ["produccion", "gasto"]]
-    if otras_actividades:
-        lines.append("📝 OTRAS ACTIVIDADES")
-        for row in otras_actividades:
-            tipo = row[1].replace("_", " ").title()
-            desc = f"• {tipo}: {row[3] or 'actividad'}"
-            if row[4]: desc += f" en {row[4]}"
-            if row[5] and row[7]:
-                desc += f" ({row[5]} {row[7]})"
-            if row[9]:
-                desc += f" ({row[9]} jornales)"
-            if row[8]:
-                desc += f". Obs: {row[8]}"
-            lines.append(desc)
-        lines.append("")
-    lines.append("✅ Todo bajo control. ¡Buen trabajo!")
-    return "\n".join(lines)
+    user_key = usuario_info["id"]
+    state = user_state.get(user_key)
+    if siguiente is not None:
+        if state is None:
+            state = ConversationState(usuario_id=user_key, finca_id=finca_id)
+        state.paginado, state.pagina = paginado, pagina
+        state.parametros_pagina, state.cursor_pagina = list(parametros), siguiente
+        user_state.set(user_key, state)
+        texto += f"\n\n➡️ Página {pagina}. Escribe 'más' para ver la siguiente."
+    elif state is not None and state.paginado:
+        if _sin_flujo(state):
+            user_state.delete(user_key)
+        else:
+            state.paginado, state.pagina, state.parametros_pagina, state.cursor_pagina = "", 0, None, None
+            user_state.set(user_key, state)
+    return texto
 
 def vaciar_tablas():
     try:
-        database_url = os.environ.get("DATABASE_URL")
-        with psycopg2.connect(database_url) as conn:
+        with obtener_conexion() as conn:
             with conn.cursor() as cursor:
                 cursor.execute('''
-                TRUNCATE TABLE registros, animales, salud_animal
+                TRUNCATE TABLE registros, animales, salud_animal, pesajes, finca_resumen_diario, reportes_precalculados
                 RESTART IDENTITY CASCADE;
                 ''')
                 conn.commit()
+                limpiar_cache_resultados()
                 return "✅ Base de datos limpiada. Todo listo para empezar de nuevo."
     except Exception as e:
         print(f"❌ Error al limpiar BD: {e}")
@@ -661,8 +2309,7 @@ def vaciar_tablas():
 
 def consultar_estado_animal(arete):
     try:
-        database_url = os.environ.get("DATABASE_URL")
-        with psycopg2.connect(database_url) as conn:
+        with obtener_conexion() as conn:
             with conn.cursor() as cursor:
                 cursor.execute("""
                 SELECT especie, estado, peso, corral, fecha_registro, observaciones
@@ -722,12 +2369,7 @@ def renovar_suscripcion(telefono_dueño, dias_extension=30):
         str: Mensaje de confirmación o error
     """
     try:
-        database_url = os.environ.get("DATABASE_URL")
-        if not database_url:
-            logger.error("❌ DATABASE_URL no configurada en renovación")
-            return "❌ Error de configuración"
-        
-        with psycopg2.connect(database_url) as conn:
+        with obtener_conexion() as conn:
             with conn.cursor() as cur:
                 # 1. Verificar que la finca existe y obtener datos
                 cur.execute("""
@@ -756,8 +2398,12 @@ def renovar_suscripcion(telefono_dueño, dias_extension=30):
                         vencimiento_suscripcion = %s
                     WHERE id = %s
                 """, (nueva_fecha.isoformat(), finca_id))
+                # El dashboard cacheado muestra los días de suscripción
+                tocar_version_finca(cur, finca_id)
                 
                 conn.commit()
+                # La suscripción se cachea con cada usuario de la finca
+                invalidar_usuario_cache(finca_id=finca_id)
                 
                 # 4. Registrar en log
                 logger.info(f"✅ Renovación: {nombre_finca} extendida hasta {nueva_fecha}")
@@ -777,373 +2423,308 @@ def renovar_suscripcion(telefono_dueño, dias_extension=30):
         return f"❌ Error al renovar: {str(e)[:100]}"
 
 # === 5. FLUJO CONVERSACIONAL COMPLETO ===
-def iniciar_flujo_conversacional_existente(mensaje, user_key, state):
-    msg = mensaje.strip().lower()
-    if state["step"] == "waiting_for_category":
-        if msg in ["fin", "salir", "cancelar", "no", "nada"]:
-            if user_key in user_state:
-                del user_state[user_key]
-            return "✅ ¡Gracias por usar Finca Digital! Vuelve cuando necesites."
-        if msg in ["1", "siembra", "sembrar"]:
-            state["data"]["tipo"] = "siembra"
-            state["step"] = "waiting_for_detalle"
-            return "🌱 ¿Qué sembraste? (Ej: maíz, cacao, cafe)"
-        elif msg in ["2", "produccion", "cosecha", "leche", "carne"]:
-            state["data"]["tipo"] = "produccion"
-            state["step"] = "waiting_for_detalle"
-            return "🌾 ¿Qué produjiste o cosechaste? (Ej: cacao, cafe, leche, huevos)"
-        elif msg in ["3", "sanidad", "vacuna", "desparasitar"]:
-            state["data"]["tipo"] = "sanidad_animal"
-            state["step"] = "waiting_for_detalle"
-            return "💉 ¿Fue vacuna o desparasitación, Inseminación, monta?"
-        elif msg in ["4", "ingreso", "compra", "nacimiento", "inventario"]:
-            state["data"]["tipo"] = "ingreso_animal"
-            state["step"] = "waiting_for_subtipo"
-            return "❓ ¿Es por nacimiento, compra o inventario inicial?"
-        elif msg in ["5", "salida", "venta", "muerte"]:
-            state["data"]["tipo"] = "salida_animal"
-            state["step"] = "waiting_for_subtipo"
-            return "🐄 ¿Es por venta o muerte de animales?"
-        elif msg in ["6", "gasto", "pagamos", "compra"]:
-            state["data"]["tipo"] = "gasto"
-            state["step"] = "waiting_for_detalle"
-            return "💰 ¿Qué gastaste? (Ej: medicina, jornales, insumos)"
-        elif msg in ["7", "labor", "macaneo", "abono","cerca"]:
-            state["data"]["tipo"] = "labor"
-            state["step"] = "waiting_for_detalle"
-            return "🛠️ ¿Qué labor hiciste? (Ej: macaneo, abono, corte, reparacion)"
-        else:
-            return (
-                "🌿 Elige una opción:\n"
-                "1. 🌱 Siembra\n"
-                "2. 🌾 Producción (cosecha, leche, carne)\n"
-                "3. 💉 Sanidad animal\n"
-                "4. 🐷 Ingreso de animales (nacimientos, compras)\n"
-                "5. 🐄 Salida de animales (ventas, muertes)\n"
-                "6. 💰 Gasto\n"
-                "7. 🛠️ Labor\n"
-                "Escribe 'fin' o '0' para salir."
-            )
-    elif state["step"] == "waiting_for_subtipo":
-        tipo = state["data"]["tipo"]
-        if tipo == "ingreso_animal":
-            if "nac" in msg or "parto" in msg:
-                state["data"]["subtipo"] = "nacimiento"
-                state["step"] = "waiting_for_detalle"
-                return "🐷 ¿Qué tipo de animal nació? (Ej: lechón, ternera, ternero)"
-            elif "compra" in msg or "compramos" in msg:
-                state["data"]["subtipo"] = "compra"
-                state["step"] = "waiting_for_detalle"
-                return "🐷 ¿Qué animal compraste? (Ej: vaca, ternero, cerdo, cerda, toro)"
-            elif "inventario" in msg or "existencia" in msg or "inicial" in msg:
-                state["data"]["subtipo"] = "inventario_inicial"
-                state["step"] = "waiting_for_detalle"
-                return "📦 ¿Qué animales ya tenías en la finca? (Ej: 5 terneras, 3 cerdas)"
-            else:
-                return "❓ Por favor, especifica: ¿nacimiento, compra o inventario inicial?"
-        elif tipo == "salida_animal":
-            if "venta" in msg or "vendimos" in msg:
-                state["data"]["subtipo"] = "venta"
-                state["step"] = "waiting_for_detalle"
-                return "🐄 ¿Qué animal vendiste? (Ej: cerdos, terneros)"
-            elif "muerte" in msg or "murieron" in msg:
-                state["data"]["subtipo"] = "muerte"
-                state["step"] = "waiting_for_detalle"
-                return "🐄 ¿Qué animal murió? (Ej: ternero, cerda)"
-            else:
-                return "❓ Por favor, especifica: ¿venta o muerte?"
-    elif state["step"] == "waiting_for_detalle":
-        state["data"]["detalle"] = mensaje
-        state["step"] = "waiting_for_cantidad"
-        return "🔢 ¿Cuántas unidades? (Ej: 3, 10) — o 'ninguna'"
-    elif state["step"] == "waiting_for_cantidad":
-        if msg in ["ninguna", "no", "0", "sin"]:
-            state["data"]["cantidad"] = None
-        else:
-            try:
-                state["data"]["cantidad"] = float(msg)
-            except ValueError:
-                return "❌ Por favor, escribe un número (Ej: 3) o 'ninguna'"
-        state["step"] = "waiting_for_unidad"
-        return "📦 ¿En qué unidad? (Ej: animales, cabezas, kg)"
-    elif state["step"] == "waiting_for_unidad":
-        state["data"]["unidad"] = mensaje
-        tipo = state["data"]["tipo"]
-        actividades_con_jornales = ["siembra", "labor", "sanidad_animal"]
-        if tipo in actividades_con_jornales:
-            state["step"] = "waiting_for_jornales"
-            return "👷 ¿Cuántos jornales se usaron? (Ej: 2) — o '0' si no aplica"
-        elif tipo in ["ingreso_animal", "salida_animal", "gasto"]:
-            state["step"] = "waiting_for_valor"
-            return "💰 ¿Valor en COP? (Ej: 500000) — o '0' si no aplica"
-        else:
-            state["step"] = "waiting_for_lugar"
-            return "📍 ¿Dónde fue? (Ej: corral A, lote 3)"
-    elif state["step"] == "waiting_for_jornales":
-        try:
-            state["data"]["jornales"] = int(float(msg))
-        except ValueError:
-            return "❌ Por favor, escribe un número entero (Ej: 2) o '0'"
-        state["step"] = "waiting_for_valor"
-        return "💰 ¿Valor total de los jornales en COP? (Ej: 60000) — o '0' si no aplica"
-    elif state["step"] == "waiting_for_valor":
+# Tablas precompiladas del flujo: cada paso tiene su manejador y las palabras
+# de cada opción se resuelven con un dict/frozenset, sin recorrer listas.
+_PALABRAS_SALIR = frozenset(["fin", "salir", "cancelar", "no", "nada"])
+_PALABRAS_SIN_CANTIDAD = frozenset(["ninguna", "no", "0", "sin"])
+_PALABRAS_GUARDAR = frozenset(["fin", "salir", "listo", "guardar", "0"])
+_TIPOS_CON_JORNALES = frozenset(["siembra", "labor", "sanidad_animal"])
+_TIPOS_CON_VALOR = frozenset(["ingreso_animal", "salida_animal", "gasto"])
+
+# (palabras, tipo, siguiente paso, pregunta). Si una palabra aparece en dos
+# opciones gana la primera, igual que la cadena if/elif ("compra" -> ingreso).
+_OPCIONES_MENU = (
+    (("1", "siembra", "sembrar"), "siembra", "waiting_for_detalle",
+     "🌱 ¿Qué sembraste? (Ej: maíz, cacao, cafe)"),
+    (("2", "produccion", "cosecha", "leche", "carne"), "produccion", "waiting_for_detalle",
+     "🌾 ¿Qué produjiste o cosechaste? (Ej: cacao, cafe, leche, huevos)"),
+    (("3", "sanidad", "vacuna", "desparasitar"), "sanidad_animal", "waiting_for_detalle",
+     "💉 ¿Fue vacuna o desparasitación, Inseminación, monta?"),
+    (("4", "ingreso", "compra", "nacimiento", "inventario"), "ingreso_animal", "waiting_for_subtipo",
+     "❓ ¿Es por nacimiento, compra o inventario inicial?"),
+    (("5", "salida", "venta", "muerte"), "salida_animal", "waiting_for_subtipo",
+     "🐄 ¿Es por venta o muerte de animales?"),
+    (("6", "gasto", "pagamos", "compra"), "gasto", "waiting_for_detalle",
+     "💰 ¿Qué gastaste? (Ej: medicina, jornales, insumos)"),
+    (("7", "labor", "macaneo", "abono", "cerca"), "labor", "waiting_for_detalle",
+     "🛠️ ¿Qué labor hiciste? (Ej: macaneo, abono, corte, reparacion)"),
+)
+_MENU_POR_PALABRA = {}
+for _palabras, _tipo, _paso, _pregunta in _OPCIONES_MENU:
+    for _palabra in _palabras:
+        _MENU_POR_PALABRA.setdefault(_palabra, (_tipo, _paso, _pregunta))
+
+_MENU_CATEGORIAS = (
+    "🌿 Elige una opción:\n"
+    "1. 🌱 Siembra\n"
+    "2. 🌾 Producción (cosecha, leche, carne)\n"
+    "3. 💉 Sanidad animal\n"
+    "4. 🐷 Ingreso de animales (nacimientos, compras)\n"
+    "5. 🐄 Salida de animales (ventas, muertes)\n"
+    "6. 💰 Gasto\n"
+    "7. 🛠️ Labor\n"
+    "Escribe 'fin' o '0' para salir."
+)
+
+# tipo -> [(fragmentos, subtipo, pregunta), ...] en orden de prioridad; basta
+# con que un fragmento aparezca en el mensaje ("compramos" -> compra)
+_SUBTIPOS = {
+    "ingreso_animal": (
+        (("nac", "parto"), "nacimiento",
+         "🐷 ¿Qué tipo de animal nació? (Ej: lechón, ternera, ternero)"),
+        (("compra",), "compra",
+         "🐷 ¿Qué animal compraste? (Ej: vaca, ternero, cerdo, cerda, toro)"),
+        (("inventario", "existencia", "inicial"), "inventario_inicial",
+         "📦 ¿Qué animales ya tenías en la finca? (Ej: 5 terneras, 3 cerdas)"),
+    ),
+    "salida_animal": (
+        (("venta", "vendimos"), "venta", "🐄 ¿Qué animal vendiste? (Ej: cerdos, terneros)"),
+        (("muert", "muri"), "muerte", "🐄 ¿Qué animal murió? (Ej: ternero, cerda)"),
+    ),
+}
+_ACLARACION_SUBTIPO = {
+    "ingreso_animal": "❓ Por favor, especifica: ¿nacimiento, compra o inventario inicial?",
+    "salida_animal": "❓ Por favor, especifica: ¿venta o muerte?",
+}
+
+def _paso_categoria(state, mensaje, msg, user_key):
+    if msg in _PALABRAS_SALIR:
+        user_state.delete(user_key)
+        state.cancelado = True
+        return "✅ ¡Gracias por usar Finca Digital! Vuelve cuando necesites."
+    opcion = _MENU_POR_PALABRA.get(msg)
+    if opcion is None:
+        return _MENU_CATEGORIAS
+    state.tipo, state.step, pregunta = opcion
+    return pregunta
+
+def _opcion_subtipo(tipo, msg):
+    for opcion in _SUBTIPOS.get(tipo, ()):
+        if any(fragmento in msg for fragmento in opcion[0]):
+            return opcion
+    return None
+
+def resolver_subtipo(tipo, texto):
+    """Subtipo de `tipo` mencionado en el texto (mismo vocabulario del flujo de WhatsApp), o None."""
+    opcion = _opcion_subtipo(tipo, (texto or "").lower())
+    return opcion[1] if opcion else None
+
+def _paso_subtipo(state, mensaje, msg, user_key):
+    tipo = state.tipo
+    if tipo not in _SUBTIPOS:
+        return "❌ Error interno. Intenta de nuevo."
+    opcion = _opcion_subtipo(tipo, msg)
+    if opcion is None:
+        return _ACLARACION_SUBTIPO[tipo]
+    _, state.subtipo, pregunta = opcion
+    state.step = "waiting_for_detalle"
+    return pregunta
+
+def _paso_detalle(state, mensaje, msg, user_key):
+    state.detalle = mensaje
+    state.step = "waiting_for_cantidad"
+    return "🔢 ¿Cuántas unidades? (Ej: 3, 10) — o 'ninguna'"
+
+def _paso_cantidad(state, mensaje, msg, user_key):
+    if msg in _PALABRAS_SIN_CANTIDAD:
+        state.cantidad = None
+    else:
         try:
-            state["data"]["valor"] = float(msg)
+            state.cantidad = float(msg)
         except ValueError:
-            return "❌ Por favor, escribe un número (Ej: 60000)"
-        state["step"] = "waiting_for_lugar"
-        return "📍 ¿Dónde fue? (Ej: lote 3, corral A)"
-    elif state["step"] == "waiting_for_lugar":
-        state["data"]["lugar"] = mensaje
-        state["step"] = "waiting_for_observacion"
-        return "📝 ¿Observación? (Ej: marca D-01, D-03, T105)\nEscribe 'fin' para guardar."
-    elif state["step"] == "waiting_for_observacion":
-        if msg in ["fin", "salir", "listo", "guardar", "0"]:
-            state["data"]["observacion"] = ""
-        else:
-            state["data"]["observacion"] = mensaje
-        state["completed"] = True
-        return "¡Listo para guardar!"
-    return "❌ Error interno. Intenta de nuevo."
+            return "❌ Por favor, escribe un número (Ej: 3) o 'ninguna'"
+    state.step = "waiting_for_unidad"
+    return "📦 ¿En qué unidad? (Ej: animales, cabezas, kg)"
+
+def _paso_unidad(state, mensaje, msg, user_key):
+    state.unidad = mensaje
+    tipo = state.tipo
+    if tipo in _TIPOS_CON_JORNALES:
+        state.step = "waiting_for_jornales"
+        return "👷 ¿Cuántos jornales se usaron? (Ej: 2) — o '0' si no aplica"
+    if tipo in _TIPOS_CON_VALOR:
+        state.step = "waiting_for_valor"
+        return "💰 ¿Valor en COP? (Ej: 500000) — o '0' si no aplica"
+    state.step = "waiting_for_lugar"
+    return "📍 ¿Dónde fue? (Ej: corral A, lote 3)"
+
+def _paso_jornales(state, mensaje, msg, user_key):
+    try:
+        state.jornales = int(float(msg))
+    except ValueError:
+        return "❌ Por favor, escribe un número entero (Ej: 2) o '0'"
+    state.step = "waiting_for_valor"
+    return "💰 ¿Valor total de los jornales en COP? (Ej: 60000) — o '0' si no aplica"
+
+def _paso_valor(state, mensaje, msg, user_key):
+    try:
+        state.valor = float(msg)
+    except ValueError:
+        return "❌ Por favor, escribe un número (Ej: 60000)"
+    state.step = "waiting_for_lugar"
+    return "📍 ¿Dónde fue? (Ej: lote 3, corral A)"
+
+def _paso_lugar(state, mensaje, msg, user_key):
+    state.lugar = mensaje
+    state.step = "waiting_for_observacion"
+    return "📝 ¿Observación? (Ej: marca D-01, D-03, T105)\nEscribe 'fin' para guardar."
+
+def _paso_observacion(state, mensaje, msg, user_key):
+    state.observacion = "" if msg in _PALABRAS_GUARDAR else mensaje
+    state.completed = True
+    return "¡Listo para guardar!"
+
+# Tabla de transiciones: paso -> manejador
+_PASOS_FLUJO = {
+    "waiting_for_category": _paso_categoria,
+    "waiting_for_subtipo": _paso_subtipo,
+    "waiting_for_detalle": _paso_detalle,
+    "waiting_for_cantidad": _paso_cantidad,
+    "waiting_for_unidad": _paso_unidad,
+    "waiting_for_jornales": _paso_jornales,
+    "waiting_for_valor": _paso_valor,
+    "waiting_for_lugar": _paso_lugar,
+    "waiting_for_observacion": _paso_observacion,
+}
+
+def iniciar_flujo_conversacional_existente(mensaje, user_key, state):
+    manejador = _PASOS_FLUJO.get(state.step)
+    if manejador is None:
+        return "❌ Error interno. Intenta de nuevo."
+    return manejador(state, mensaje, mensaje.strip().lower(), user_key)
 
 def iniciar_flujo_conversacional_con_finca(mensaje, usuario_info):
     user_key = usuario_info["id"]
-    if user_key not in user_state:
-        user_state[user_key] = {
-            "step": "waiting_for_category",
-            "data": {
-                "tipo": "", "detalle": "", "cantidad": None, "valor": 0,
-                "unidad": "", "lugar": "", "observacion": "", "jornales": 0, "subtipo": ""
-            },
-            "usuario_info": usuario_info
-        }
-    state = user_state[user_key]
+    state = user_state.get(user_key)
+    if state is None:
+        state = ConversationState(usuario_id=usuario_info["id"], finca_id=usuario_info["finca_id"])
     respuesta = iniciar_flujo_conversacional_existente(mensaje, user_key, state)
-    if state.get("completed"):
-        datos = state["data"]
-        tipo = datos["tipo"]
-        subtipo = datos["subtipo"]
-        detalle = datos["detalle"]
-        cantidad = datos["cantidad"]
-        valor = datos["valor"]
-        unidad = datos["unidad"]
-        lugar = datos["lugar"]
-        observacion = datos["observacion"]
-        jornales = datos["jornales"]
-        finca_id = usuario_info["finca_id"]
-        usuario_id = usuario_info["id"]
+    if state.completed:
+        tipo = state.tipo
+        subtipo = state.subtipo
+        detalle = state.detalle
+        cantidad = state.cantidad
+        valor = state.valor
+        unidad = state.unidad
+        lugar = state.lugar
+        observacion = state.observacion
+        jornales = state.jornales
+        finca_id = state.finca_id
+        usuario_id = state.usuario_id
         mensaje_completo = f"{detalle} {lugar} {observacion}".strip()
         
         # === MANEJO ESPECIAL DE INGRESO DE ANIMALES ===
         if tipo == "ingreso_animal":
             if subtipo in ["nacimiento", "compra", "inventario_inicial"]:
                 texto_completo = f"{detalle} {observacion}"
-                marcas = []
-                for match in re.finditer(r"marca\s+([A-Za-z0-9-]+)", texto_completo):
-                    marca_capturada = match.group(1).upper()
-                    marcas.append(marca_capturada)
-                    print(f"🔍 Marca detectada: {marca_capturada}")
-                print(f"📊 Total marcas detectadas: {len(marcas)}")
-                especie = "bovino"
-                if any(p in detalle.lower() for p in ["lechón", "cerda", "verraco", "ceba", "cerdo", "chancho"]):
-                    especie = "porcino"
-                elif any(p in detalle.lower() for p in ["ternero", "ternera", "toro", "vaca", "novillo", "novilla"]):
-                    especie = "bovino"
-                animales_registrados = 0
-                errores_registro = []
-                for marca in marcas:
-                    try:
-                        prefijo = "C-" if especie == "porcino" else "V-M-"
-                        id_externo = f"{prefijo}{marca}"
-                        categoria = None
-                        if "lechón" in detalle.lower():
-                            categoria = "lechón"
-                        elif "cerda" in detalle.lower():
-                            categoria = "cerda"
-                        elif "ternera" in detalle.lower():
-                            categoria = "ternera"
-                        elif "ternero" in detalle.lower():
-                            categoria = "ternero"
-                        elif "toro" in detalle.lower():
-                            categoria = "toro"
-                        elif "vaca" in detalle.lower():
-                            categoria = "vaca"
-                        peso_valor = None
-                        pattern = r"marca\s+" + re.escape(marca) + r".*?peso\s*(\d+(?:\.\d+)?)\s*kg"
-                        peso_match = re.search(pattern, texto_completo, re.IGNORECASE)
-                        if peso_match:
-                            peso_valor = float(peso_match.group(1))
-                        database_url = os.environ.get("DATABASE_URL")
-                        with psycopg2.connect(database_url) as conn:
-                            with conn.cursor() as cursor:
-                                cursor.execute('''
-                                INSERT INTO animales (especie, id_externo, marca_o_arete, categoria, corral, estado, peso, finca_id)
-                                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                                ON CONFLICT (id_externo) DO UPDATE
-                                SET peso = EXCLUDED.peso, estado = EXCLUDED.estado, categoria = EXCLUDED.categoria
-                                ''', (
-                                    especie,
-                                    id_externo,
-                                    marca,
-                                    categoria,
-                                    lugar,
-                                    "activo",
-                                    peso_valor,
-                                    finca_id
-                                ))
-                                conn.commit()
-                                animales_registrados += 1
-                                print(f"✅ Animal registrado: {id_externo} ({marca})")
-                    except Exception as e:
-                        errores_registro.append(f"{marca}: {str(e)[:50]}")
-                        print(f"❌ Error al registrar animal {marca}: {e}")
-                guardar_registro(
-                    tipo,
-                    subtipo,
-                    f"{detalle} ({animales_registrados} animales)",
-                    lugar, cantidad, valor, unidad, observacion, jornales,
-                    finca_id=finca_id,
-                    usuario_id=usuario_id,
-                    mensaje_completo=mensaje_completo
-                )
+                animales = extraer_marcas(texto_completo)
+                marcas = [animal.marca for animal in animales]
+                print(f"📊 Total marcas detectadas: {len(marcas)} {marcas}")
+                clasificacion = clasificar_texto(detalle)
+                especie = clasificacion.especie or "bovino"
+                # Registro y animales en una sola transacción; el registro va primero,
+                # en el mismo orden de bloqueos que el formulario web
+                try:
+                    with obtener_conexion() as conn:
+                        with conn.cursor() as cursor:
+                            registro_id = _insertar_registro(
+                                cursor, tipo, subtipo, detalle,
+                                lugar, cantidad, valor, unidad, observacion, jornales, finca_id, usuario_id
+                            )
+                            marcas, errores_registro = upsert_animales(
+                                cursor, animales, especie, clasificacion.categoria, lugar, finca_id
+                            )
+                            _anotar_animales_registro(cursor, registro_id, detalle, len(marcas))
+                except Exception as e:
+                    print(f"❌ Error al registrar ingreso de animales: {e}")
+                    user_state.delete(user_key)
+                    return f"❌ No se pudo guardar el ingreso. Intenta de nuevo.\n{str(e)[:100]}"
+                animales_registrados = len(marcas)
+                for error in errores_registro:
+                    print(f"⚠️ {error}")
                 respuesta_final = f"✅ ¡Registrado en {usuario_info['finca_nombre']}!"
                 if animales_registrados > 0:
                     respuesta_final += f"\n🐮 {animales_registrados} animales guardados en inventario."
-                    respuesta_final += f"\n📋 Marcas: {', '.join(marcas)}"
+                    respuesta_final += f"\n📋 Marcas: {', '.join(marcas[:20])}"
+                    if len(marcas) > 20:
+                        respuesta_final += f" y {len(marcas) - 20} más"
                 else:
                     respuesta_final += "\n⚠️ No se detectaron marcas válidas."
                     respuesta_final += "\n💡 Formato correcto: 'marca LG01, marca LG02'"
                 if errores_registro:
                     respuesta_final += f"\n❌ Errores: {len(errores_registro)}"
-                if user_key in user_state:
-                    del user_state[user_key]
+                    respuesta_final += "".join(f"\n• {error}" for error in errores_registro[:5])
+                user_state.delete(user_key)
                 return respuesta_final
         
         # === MANEJO ESPECIAL DE SALIDA DE ANIMALES (NUEVO - CORREGIDO) ===
         elif tipo == "salida_animal":
             if subtipo in ["venta", "muerte"]:
                 texto_completo = f"{detalle} {observacion}"
-                marcas = []
-                for match in re.finditer(r"marca\s+([A-Za-z0-9-]+)", texto_completo):
-                    marca_capturada = match.group(1).upper()
-                    marcas.append(marca_capturada)
-                    print(f"🔍 Marca detectada para venta: {marca_capturada}")
-                print(f"📊 Total marcas para venta: {len(marcas)}")
-                
-                animales_vendidos = 0
-                errores_venta = []
-                for marca in marcas:
-                    try:
-                        database_url = os.environ.get("DATABASE_URL")
-                        with psycopg2.connect(database_url) as conn:
-                            with conn.cursor() as cursor:
-                                # Buscar el animal
-                                cursor.execute("""
-                                SELECT id_externo FROM animales
-                                WHERE (marca_o_arete = %s OR id_externo LIKE %s)
-                                AND finca_id = %s
-                                AND estado = 'activo'
-                                """, (marca, f"%{marca}%", finca_id))
-                                row = cursor.fetchone()
-                                
-                                if row:
-                                    id_externo = row[0]
-                                    # Actualizar estado a 'vendido'
-                                    cursor.execute("""
-                                    UPDATE animales 
-                                    SET estado = 'vendido',
-                                        observaciones = %s
-                                    WHERE id_externo = %s
-                                    """, (f"Vendido: {detalle} - {observacion}", id_externo))
-                                    conn.commit()
-                                    animales_vendidos += 1
-                                    print(f"✅ Animal {marca} marcado como vendido")
-                                else:
-                                    errores_venta.append(f"{marca}: no encontrado o ya vendido")
-                                    print(f"⚠️ Animal {marca} no encontrado o ya está vendido")
-                    except Exception as e:
-                        errores_venta.append(f"{marca}: {str(e)[:50]}")
-                        print(f"❌ Error al actualizar venta para {marca}: {e}")
-                
-                # Guardar registro de la actividad (siempre, haya marcas o no)
-                guardar_registro(
-                    tipo,
-                    subtipo,
-                    f"{detalle} ({animales_vendidos} animales)",
-                    lugar, cantidad, valor, unidad, observacion, jornales,
-                    finca_id=finca_id,
-                    usuario_id=usuario_id,
-                    mensaje_completo=mensaje_completo
-                )
+                marcas = [animal.marca for animal in extraer_marcas(texto_completo)]
+                print(f"📊 Total marcas para {subtipo}: {len(marcas)} {marcas}")
+                estado = ESTADOS_SALIDA[subtipo]
+                nota = f"{'Vendido' if subtipo == 'venta' else 'Muerte'}: {detalle} - {observacion}"
+                # Registro y baja de animales en una sola transacción (registro primero)
+                try:
+                    with obtener_conexion() as conn:
+                        with conn.cursor() as cursor:
+                            registro_id = _insertar_registro(
+                                cursor, tipo, subtipo, detalle,
+                                lugar, cantidad, valor, unidad, observacion, jornales, finca_id, usuario_id
+                            )
+                            encontradas, faltantes = registrar_salida_animales(cursor, marcas, estado, nota, finca_id)
+                            _anotar_animales_registro(cursor, registro_id, detalle, len(encontradas))
+                except Exception as e:
+                    print(f"❌ Error al registrar salida de animales: {e}")
+                    user_state.delete(user_key)
+                    return f"❌ No se pudo guardar la salida. Intenta de nuevo.\n{str(e)[:100]}"
+                for marca in faltantes:
+                    print(f"⚠️ Animal {marca} no encontrado o ya no está activo")
                 
                 # ✅ MENSAJE DE CONFIRMACIÓN DETALLADO
                 respuesta_final = f"✅ ¡Registrado en {usuario_info['finca_nombre']}!"
-                if animales_vendidos > 0:
-                    respuesta_final += f"\n💸 {animales_vendidos} animales marcados como vendidos."
-                    respuesta_final += f"\n📋 Marcas: {', '.join(marcas)}"
-                else:
+                if encontradas:
+                    icono, verbo = ("💸", "vendidos") if subtipo == "venta" else ("🪦", "muertos")
+                    respuesta_final += f"\n{icono} {len(encontradas)} animales marcados como {verbo}."
+                    respuesta_final += f"\n📋 Marcas: {', '.join(encontradas)}"
+                elif not marcas:
                     respuesta_final += "\n⚠️ No se detectaron marcas válidas."
                     respuesta_final += "\n💡 Formato correcto: 'marca LG01, marca LG02'"
-                if errores_venta:
-                    respuesta_final += f"\n❌ Errores: {len(errores_venta)}"
-                if user_key in user_state:
-                    del user_state[user_key]
+                if faltantes:
+                    respuesta_final += f"\n⚠️ No encontradas o ya no activas: {', '.join(faltantes)}"
+                user_state.delete(user_key)
                 return respuesta_final
         
         # === MANEJO ESPECIAL DE SANIDAD ANIMAL ===
         elif tipo == "sanidad_animal":
-            guardar_registro(
-                tipo, tipo,
-                detalle, lugar, cantidad, valor, unidad, observacion, jornales,
-                finca_id=finca_id,
-                usuario_id=usuario_id,
-                mensaje_completo=mensaje_completo
-            )
-            texto = mensaje_completo.lower()
-            marcas_encontradas = re.findall(r"marca\s+([a-z0-9-]+)", texto, re.IGNORECASE)
-            marcas_encontradas = [m.upper() for m in marcas_encontradas]
-            parejas = {}
-            for match in re.finditer(r"marca\s+([a-z0-9-]+)\s+(?:peso\s+(\d+(?:\.\d+)?)\s*kg)?", texto, re.IGNORECASE):
-                marca = match.group(1).upper()
-                peso = float(match.group(2)) if match.group(2) else None
-                parejas[marca] = peso
-            if not parejas and marcas_encontradas:
-                for marca in marcas_encontradas:
-                    parejas[marca] = None
-            for marca, peso in parejas.items():
-                try:
-                    database_url = os.environ.get("DATABASE_URL")
-                    with psycopg2.connect(database_url) as conn:
-                        with conn.cursor() as cursor:
-                            cursor.execute("""
-                            SELECT id_externo FROM animales
-                            WHERE (marca_o_arete = %s OR id_externo LIKE %s)
-                            AND finca_id = %s
-                            """, (marca, f"%{marca}%", finca_id))
-                            row = cursor.fetchone()
-                            if row:
-                                id_externo = row[0]
-                                detalle_lower = detalle.lower()
-                                if any(kw in detalle_lower for kw in ["vacuna", "vacunacion", "vacunación", "aftosa", "carbon", "carbón", "brucelosis"]):
-                                    tipo_sanidad = "vacuna"
-                                elif any(kw in detalle_lower for kw in ["desparasit", "lavado"," lombriz", "purga", " purgante", "nuche", "vitamin" "garrapata", "gusano"]):
-                                    tipo_sanidad = "desparasitación"
-                                elif any(kw in detalle_lower for kw in ["monta", "insemin", "preñez", "celo", "reproduccion", "reproducción", "inseminacion", "servicio"]):
-                                    tipo_sanidad = "reproducción"
-                                else:
-                                    tipo_sanidad = "sanidad"
-                                guardar_en_salud_animal(id_externo, tipo_sanidad, detalle, observacion, finca_id)
-                                if peso is not None:
-                                    actualizar_peso_animal(marca, peso, finca_id)
-                except Exception as e:
-                    print(f"❌ Error al registrar sanidad para {marca}: {e}")
-            if user_key in user_state:
-                del user_state[user_key]
-            return f"✅ ¡Registrado en {usuario_info['finca_nombre']}! {detalle}"
+            tipo_sanidad = clasificar_texto(detalle).tipo_sanidad
+            # Registro, salud_animal y pesos en una sola transacción
+            try:
+                with obtener_conexion() as conn:
+                    with conn.cursor() as cursor:
+                        _insertar_registro(
+                            cursor, tipo, tipo, detalle, lugar, cantidad, valor, unidad,
+                            observacion, jornales, finca_id, usuario_id
+                        )
+                        tratadas, faltantes = registrar_sanidad_animales(
+                            cursor, extraer_marcas(mensaje_completo), tipo_sanidad, detalle, observacion, finca_id
+                        )
+            except Exception as e:
+                print(f"❌ Error al registrar sanidad animal: {e}")
+                user_state.delete(user_key)
+                return f"❌ No se pudo guardar la sanidad. Intenta de nuevo.\n{str(e)[:100]}"
+            respuesta_final = f"✅ ¡Registrado en {usuario_info['finca_nombre']}! {detalle}"
+            if tratadas:
+                respuesta_final += f"\n💉 {len(tratadas)} animales con {tipo_sanidad}."
+            if faltantes:
+                respuesta_final += f"\n⚠️ No encontradas: {', '.join(faltantes)}"
+            user_state.delete(user_key)
+            return respuesta_final
         
         # === OTROS TIPOS DE REGISTRO ===
         else:
-            guardar_registro(
+            registro_id = guardar_registro(
                 tipo,
                 subtipo if tipo in ["ingreso_animal", "salida_animal"] else tipo,
                 detalle, lugar, cantidad, valor, unidad, observacion, jornales,
@@ -1151,10 +2732,13 @@ def iniciar_flujo_conversacional_con_finca(mensaje, usuario_info):
                 usuario_id=usuario_id,
                 mensaje_completo=mensaje_completo
             )
-            if user_key in user_state:
-                del user_state[user_key]
+            user_state.delete(user_key)
+            if registro_id is None:
+                return "❌ No se pudo guardar el registro. Intenta de nuevo."
             return f"✅ ¡Registrado en {usuario_info['finca_nombre']}! {detalle}"
     
+    if not state.cancelado:
+        user_state.set(user_key, state)
     return respuesta
 
 # === 6. ENTRADA PRINCIPAL: VALIDACIÓN DE VENCIMIENTO AUTOMÁTICO ===
@@ -1165,14 +2749,15 @@ def procesar_mensaje_whatsapp(mensaje, remitente=None):
     mensaje = mensaje.strip()
     if not mensaje:
         return "❌ Mensaje vacío."
-    if remitente in user_state and user_state[remitente].get("esperando_nombre_finca"):
+    estado_remitente = user_state.get(remitente)
+    if estado_remitente and estado_remitente.step == "esperando_nombre_finca":
         nombre_finca = mensaje
-        del user_state[remitente]
+        user_state.delete(remitente)
         return registrar_nueva_finca(nombre_finca, remitente)
     usuario_info = obtener_usuario_por_whatsapp(remitente)
     if not usuario_info:
         if mensaje.lower() in ["8", "finca", "registrar", "hola", "hi", "buenos días", "buenas", "menu", "ayuda"]:
-            user_state[remitente] = {"esperando_nombre_finca": True}
+            user_state.set(remitente, ConversationState(step="esperando_nombre_finca"))
             return (
                 "🏡 Bienvenido a Finca Digital.\n"
                 "Para comenzar, ¿cómo se llama tu finca?\n"
@@ -1203,6 +2788,14 @@ def procesar_mensaje_whatsapp(mensaje, remitente=None):
         else:
             return "⚠️ Solo el dueño puede renovar la suscripción. Contacta al administrador."
         
+    if mensaje.strip().lower().rstrip(".!") in _PALABRAS_MAS:
+        state = user_state.get(usuario_info["id"])
+        if state is not None and state.paginado:
+            return responder_pagina(
+                usuario_info, state.paginado, state.parametros_pagina, state.cursor_pagina, state.pagina + 1
+            )
+        if state is None or _sin_flujo(state):
+            return "📄 No hay más páginas."
     if "reporte" in mensaje.lower():
         rango = re.search(r"reporte.*?del\s+(\d{1,2})/(\d{1,2})\s+al\s+(\d{1,2})/(\d{1,2})", mensaje.lower())
         if rango:
@@ -1213,19 +2806,24 @@ def procesar_mensaje_whatsapp(mensaje, remitente=None):
                 fecha_fin = datetime.date(año, m2, d2)
                 if fecha_inicio > fecha_fin:
                     fecha_inicio, fecha_fin = fecha_fin, fecha_inicio
-                return generar_reporte_personalizado(fecha_inicio, fecha_fin, finca_id=usuario_info["finca_id"])
+                return responder_pagina(
+                    usuario_info, "reporte", [fecha_inicio.isoformat(), fecha_fin.isoformat(), "REPORTE PERSONALIZADO"]
+                )
             except Exception as e:
                 print(f"❌ Error al parsear fechas: {e}")
         freq = "semanal"
         if "diario" in mensaje.lower(): freq = "diario"
         elif "mensual" in mensaje.lower(): freq = "mensual"
         elif "quincenal" in mensaje.lower(): freq = "quincenal"
-        return generar_reporte(frecuencia=freq, formato="texto", finca_id=usuario_info["finca_id"])
+        inicio, fin, titulo = rango_reporte(freq)
+        return responder_pagina(usuario_info, "reporte", [inicio.isoformat(), fin.isoformat(), titulo])
     if mensaje.lower().startswith("estado animal "):
         arete = mensaje.split(" ", 2)[2].strip()
         return consultar_estado_animal(arete)
     if mensaje.strip().lower() in ["inventario animales", "lista de animales", "inventario"]:
-        return generar_inventario_animales(usuario_info["finca_id"])
+        return responder_pagina(usuario_info, "inventario")
+    if mensaje.strip().lower() in ["ganancia de peso", "ganancia diaria", "crecimiento", "gdp"]:
+        return generar_reporte_ganancia(usuario_info["finca_id"])
     if mensaje.lower().startswith("exportar reporte"):
         return "📎 El reporte en Excel estará disponible pronto en tu WhatsApp."
     if mensaje.strip().lower() in ["ayuda", "help", "menu", "hola"]:
@@ -1241,4 +2839,319 @@ def procesar_mensaje_whatsapp(mensaje, remitente=None):
             "7. 🛠️ Labor\n"
             "Escribe 'fin' para salir."
         )
-    return iniciar_flujo_conversacional_con_finca(mensaje, usuario_info)
\ No newline at end of file
+    return iniciar_flujo_conversacional_con_finca(mensaje, usuario_info)
+
+# === 7. COLA DURABLE DE MENSAJES ENTRANTES (WEBHOOK_MODO=cola) ===
+# El webhook inserta el mensaje y responde al instante; worker.py lo toma con
+# FOR UPDATE SKIP LOCKED, así varios procesos se reparten la cola sin bloquearse.
+COLA_MAX_INTENTOS = _entero_env("COLA_MAX_INTENTOS", 3)
+COLA_TIMEOUT_PROCESANDO = _entero_env("COLA_TIMEOUT_PROCESANDO", 300)
+
+def encolar_mensaje_entrante(remitente, cuerpo, message_sid=None):
+    """Guarda el mensaje como pendiente. Retorna el id, o None si el MessageSid ya estaba."""
+    with obtener_conexion() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO inbound_messages (message_sid, remitente, cuerpo)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (message_sid) DO NOTHING
+                RETURNING id
+            """, (message_sid or None, remitente, cuerpo))
+            fila = cursor.fetchone()
+    return fila[0] if fila else None
+
+def tomar_mensaje_entrante():
+    """Reclama el pendiente más antiguo y lo marca 'procesando'. Retorna dict o None."""
+    with obtener_conexion() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                UPDATE inbound_messages
+                SET estado = 'procesando', intentos = intentos + 1, tomado_en = now()
+                WHERE id = (
+                    SELECT id FROM inbound_messages m
+                    WHERE estado = 'pendiente'
+                      -- FIFO por remitente: solo su mensaje más antiguo y sin otro en curso
+                      AND NOT EXISTS (
+                          SELECT 1 FROM inbound_messages previo
+                          WHERE previo.remitente = m.remitente
+                            AND previo.estado IN ('pendiente', 'procesando')
+                            AND (previo.id < m.id OR previo.estado = 'procesando')
+                      )
+                    ORDER BY id
+                    FOR UPDATE SKIP LOCKED
+                    LIMIT 1
+                )
+                RETURNING id, remitente, cuerpo, intentos, message_sid
+            """)
+            fila = cursor.fetchone()
+    if not fila:
+        return None
+    return {"id": fila[0], "remitente": fila[1], "cuerpo": fila[2], "intentos": fila[3], "message_sid": fila[4]}
+
+def finalizar_mensaje_entrante(mensaje_id, respuesta=None, error=None):
+    """Cierra el trabajo como 'ok' o 'error' y registra la latencia desde que llegó."""
+    with obtener_conexion() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                UPDATE inbound_messages
+                SET estado = %s, respuesta = %s, error = %s, terminado_en = now(),
+                    latencia_ms = (EXTRACT(EPOCH FROM now() - recibido_en) * 1000)::int
+                WHERE id = %s
+            """, ("error" if error else "ok", respuesta, error, mensaje_id))
+
+def reencolar_mensajes_colgados(timeout=None):
+    """Devuelve a 'pendiente' lo que quedó 'procesando' por un worker caído; agota intentos en 'error'."""
+    timeout = COLA_TIMEOUT_PROCESANDO if timeout is None else timeout
+    with obtener_conexion() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                UPDATE inbound_messages
+                SET estado = CASE WHEN intentos >= %s THEN 'error' ELSE 'pendiente' END,
+                    error = CASE WHEN intentos >= %s THEN 'intentos agotados' ELSE error END
+                WHERE estado = 'procesando' AND tomado_en < now() - make_interval(secs => %s)
+            """, (COLA_MAX_INTENTOS, COLA_MAX_INTENTOS, timeout))
+            return cursor.rowcount
+
+def estadisticas_cola():
+    """Conteo por estado y latencia de la última hora."""
+    with obtener_conexion() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT estado, COUNT(*) FROM inbound_messages GROUP BY estado")
+            datos = {estado: total for estado, total in cursor.fetchall()}
+            cursor.execute("""
+                SELECT COUNT(*),
+                       percentile_cont(0.5) WITHIN GROUP (ORDER BY latencia_ms),
+                       percentile_cont(0.99) WITHIN GROUP (ORDER BY latencia_ms)
+                FROM inbound_messages
+                WHERE terminado_en > now() - interval '1 hour'
+            """)
+            total, p50, p99 = cursor.fetchone()
+    datos["ultima_hora"] = {"terminados": total, "latencia_p50_ms": p50, "latencia_p99_ms": p99}
+    return datos
+
+# === 8. IDEMPOTENCIA POR MESSAGESID ===
+# Twilio reintenta el webhook si no respondemos a tiempo. El primer intento
+# reclama el MessageSid en mensajes_procesados; los reintentos reciben la
+# respuesta guardada sin volver a tocar registros ni animales.
+_SIDS_PROCESADOS = CacheTTL(
+    max_entradas=_entero_env("IDEMPOTENCIA_CACHE_MAX", 20000),
+    ttl=_entero_env("IDEMPOTENCIA_CACHE_TTL", 3600)
+)
+_IDEMPOTENCIA_HORAS = _entero_env("IDEMPOTENCIA_HORAS", 48)
+# Un reclamo sin respuesta más viejo que esto es de un proceso que murió y se
+# retoma. Debe ser menor que COLA_TIMEOUT_PROCESANDO para que el trabajo
+# rescatado de la cola encuentre el reclamo ya vencido.
+IDEMPOTENCIA_RECLAMO_TIMEOUT = _entero_env("IDEMPOTENCIA_RECLAMO_TIMEOUT", 120)
+
+def reclamar_message_sid(message_sid):
+    """Retorna (nuevo, respuesta_previa). respuesta_previa es None si el primer intento sigue en curso."""
+    previa = _SIDS_PROCESADOS.get(message_sid, _AUSENTE)
+    if previa is not _AUSENTE:
+        return False, previa
+    with obtener_conexion() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO mensajes_procesados (message_sid) VALUES (%s)
+                ON CONFLICT (message_sid) DO UPDATE SET reclamado_en = now()
+                WHERE mensajes_procesados.respuesta IS NULL
+                  AND mensajes_procesados.reclamado_en < now() - make_interval(secs => %s)
+                RETURNING 1
+            """, (message_sid, IDEMPOTENCIA_RECLAMO_TIMEOUT))
+            if cursor.fetchone():
+                return True, None
+            cursor.execute("SELECT respuesta FROM mensajes_procesados WHERE message_sid = %s", (message_sid,))
+            fila = cursor.fetchone()
+    previa = fila[0] if fila else None
+    if previa is not None:
+        _SIDS_PROCESADOS.set(message_sid, previa)
+    return False, previa
+
+def guardar_respuesta_message_sid(message_sid, respuesta):
+    """Guarda la respuesta del primer intento y, de vez en cuando, purga los SIDs viejos."""
+    with obtener_conexion() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "UPDATE mensajes_procesados SET respuesta = %s WHERE message_sid = %s",
+                (respuesta or "", message_sid)
+            )
+            if random.random() < 0.01:
+                cursor.execute(
+                    "DELETE FROM mensajes_procesados WHERE creado_en < now() - make_interval(hours => %s)",
+                    (_IDEMPOTENCIA_HORAS,)
+                )
+    _SIDS_PROCESADOS.set(message_sid, respuesta or "")
+
+def liberar_message_sid(message_sid):
+    """Si el procesamiento falló, suelta el SID para que el reintento de Twilio lo procese."""
+    with obtener_conexion() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("DELETE FROM mensajes_procesados WHERE message_sid = %s AND respuesta IS NULL", (message_sid,))
+
+def limpiar_cache_message_sid():
+    _SIDS_PROCESADOS.limpiar()
+
+def procesar_mensaje_idempotente(mensaje, remitente=None, message_sid=None):
+    """procesar_mensaje_whatsapp una sola vez por MessageSid. Retorna (respuesta, duplicado)."""
+    with candado_remitente(remitente):
+        if not message_sid:
+            return procesar_mensaje_whatsapp(mensaje, remitente=remitente), False
+        nuevo, previa = reclamar_message_sid(message_sid)
+        if not nuevo:
+            print(f"♻️ [BOT] Reintento de {message_sid}, se reutiliza la respuesta")
+            return previa, True
+        try:
+            respuesta = procesar_mensaje_whatsapp(mensaje, remitente=remitente)
+        except Exception:
+            liberar_message_sid(message_sid)
+            raise
+        guardar_respuesta_message_sid(message_sid, respuesta)
+        return respuesta, False
+
+# === 9. ORDEN POR REMITENTE ===
+# El paso de la conversación vive en user_state; dos mensajes del mismo número
+# procesados a la vez se pisan el "step". Candados rayados por remitente:
+# remitentes distintos corren en paralelo, el mismo remitente en serie.
+# Entre procesos, el orden lo garantiza la cola durable (WEBHOOK_MODO=cola).
+_CANDADOS_REMITENTE = [threading.Lock() for _ in range(_entero_env("CANDADOS_REMITENTE", 256))]
+
+def fragmento_remitente(remitente, total):
+    """Índice estable en [0, total) para repartir remitentes entre candados o colas."""
+    return zlib.crc32((remitente or "").encode("utf-8")) % total
+
+def candado_remitente(remitente):
+    return _CANDADOS_REMITENTE[fragmento_remitente(remitente, len(_CANDADOS_REMITENTE))]
+
+# === 10. ESCRITURA AGRUPADA DE REGISTROS (GROUP COMMIT) ===
+# Con REGISTROS_AGRUPAR_MS > 0, los registros sueltos se acumulan unos
+# milisegundos y se escriben con un INSERT multi-fila y un solo commit. Cada
+# llamador espera su lote: el usuario recibe la confirmación después del commit.
+REGISTROS_AGRUPAR_MS = _entero_env("REGISTROS_AGRUPAR_MS", 0)
+REGISTROS_LOTE_MAX = _entero_env("REGISTROS_LOTE_MAX", 200)
+
+class _RegistroPendiente:
+    __slots__ = ("fila", "listo", "registro_id", "error")
+
+    def __init__(self, fila):
+        self.fila = fila
+        self.listo = threading.Event()
+        self.registro_id = None
+        self.error = None
+
+class EscrituraAgrupada:
+    """Buffer write-behind de registros con un hilo que hace flush cada `espera_ms` o al llenar `max_lote`."""
+
+    def __init__(self, espera_ms=5, max_lote=200):
+        self._espera = espera_ms / 1000
+        self._max_lote = max(1, max_lote)
+        self._pendientes = []
+        self._condicion = threading.Condition()
+        self._stats = {"lotes": 0, "registros": 0, "lote_max": 0, "flush_total_ms": 0.0, "flush_max_ms": 0.0, "errores": 0}
+        self._hilo = threading.Thread(target=self._bucle, name="registros-agrupados", daemon=True)
+        self._hilo.start()
+
+    def guardar(self, fila, timeout=30):
+        """
+        Encola la fila de _fila_registro y espera el commit de su lote. Retorna el id.
+        Si vence `timeout` antes de que el hilo tome la fila, se retira y lanza
+        TimeoutError (no se guardó); si ya va en un lote, espera su resultado.
+        """
+        pendiente = _RegistroPendiente(fila)
+        with self._condicion:
+            self._pendientes.append(pendiente)
+            if len(self._pendientes) == 1 or len(self._pendientes) >= self._max_lote:
+                self._condicion.notify()
+        if not pendiente.listo.wait(timeout):
+            with self._condicion:
+                retirada = pendiente in self._pendientes
+                if retirada:
+                    self._pendientes.remove(pendiente)
+            if retirada:
+                raise TimeoutError("el lote de registros no se tomó a tiempo; la fila no se guardó")
+            # Informar error aquí haría que el usuario reenvíe una fila que el lote sí puede guardar
+            pendiente.listo.wait()
+        if pendiente.error is not None:
+            raise pendiente.error
+        return pendiente.registro_id
+
+    def _bucle(self):
+        while True:
+            with self._condicion:
+                while not self._pendientes:
+                    self._condicion.wait()
+                # Ventana de agrupación desde el primer pendiente, salvo que el lote se llene antes
+                limite = time.monotonic() + self._espera
+                while len(self._pendientes) < self._max_lote:
+                    restante = limite - time.monotonic()
+                    if restante <= 0:
+                        break
+                    self._condicion.wait(restante)
+                lote = self._pendientes[:self._max_lote]
+                del self._pendientes[:self._max_lote]
+            self._escribir(lote)
+
+    def _escribir(self, lote):
+        inicio = time.monotonic()
+        try:
+            with obtener_conexion() as conn:
+                with conn.cursor() as cursor:
+                    ids = execute_values(cursor, _SQL_INSERTAR_REGISTROS, [p.fila for p in lote], page_size=len(lote), fetch=True)
+            for pendiente, (registro_id,) in zip(lote, ids):
+                pendiente.registro_id = registro_id
+        except Exception as e:
+            # Una fila mala no tumba a las demás: se reintenta cada una en su transacción
+            logger.warning(f"⚠️ Lote de {len(lote)} registros falló ({e}); se escriben uno a uno")
+            for pendiente in lote:
+                try:
+                    with obtener_conexion() as conn:
+                        with conn.cursor() as cursor:
+                            cursor.execute(_SQL_INSERTAR_REGISTRO, pendiente.fila)
+                            pendiente.registro_id = cursor.fetchone()[0]
+                except Exception as e_fila:
+                    pendiente.error = e_fila
+        latencia_ms = (time.monotonic() - inicio) * 1000
+        with self._condicion:
+            self._stats["lotes"] += 1
+            self._stats["registros"] += len(lote)
+            self._stats["lote_max"] = max(self._stats["lote_max"], len(lote))
+            self._stats["flush_total_ms"] += latencia_ms
+            self._stats["flush_max_ms"] = max(self._stats["flush_max_ms"], latencia_ms)
+            self._stats["errores"] += sum(1 for p in lote if p.error is not None)
+        for pendiente in lote:
+            pendiente.listo.set()
+
+    def estadisticas(self):
+        with self._condicion:
+            datos = dict(self._stats)
+            datos["pendientes"] = len(self._pendientes)
+        datos["espera_ms"] = self._espera * 1000
+        datos["lote_promedio"] = round(datos["registros"] / (datos["lotes"] or 1), 2)
+        datos["flush_promedio_ms"] = round(datos["flush_total_ms"] / (datos["lotes"] or 1), 3)
+        return datos
+
+_ESCRITURA_AGRUPADA = None
+_ESCRITURA_AGRUPADA_LOCK = threading.Lock()
+
+def escritura_agrupada():
+    """El buffer del proceso, creado al primer uso; None si REGISTROS_AGRUPAR_MS = 0."""
+    global _ESCRITURA_AGRUPADA
+    if REGISTROS_AGRUPAR_MS <= 0:
+        return None
+    if _ESCRITURA_AGRUPADA is None:
+        with _ESCRITURA_AGRUPADA_LOCK:
+            if _ESCRITURA_AGRUPADA is None:
+                _ESCRITURA_AGRUPADA = EscrituraAgrupada(REGISTROS_AGRUPAR_MS, REGISTROS_LOTE_MAX)
+    return _ESCRITURA_AGRUPADA
+
+def estadisticas_escritura_agrupada():
+    buffer = escritura_agrupada()
+    if buffer is None:
+        return {"activo": False}
+    return {"activo": True, **buffer.estadisticas()}
+
+# === EJECUCIÓN DIRECTA: MIGRAR ESQUEMA (FASE RELEASE DEL DESPLIEGUE) ===
+if __name__ == "__main__":
+    import sys
+    if "--reconstruir-resumen" in sys.argv:
+        # Reparación: python bot.py --reconstruir-resumen
+        exit(0) if preparar_bd() and reconstruir_resumen_diario() is not None else exit(1)
+    exit(0) if preparar_bd() else exit(1)
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+mensajeria.py - Mensajes salientes de WhatsApp y procesamiento en segundo plano
+Permite responder fuera del request de Twilio (modo asíncrono del webhook)
+"""
+import os
+import json
+import queue
+import threading
+import time
+import zlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+MENSAJE_ERROR = "❌ Hubo un error al procesar tu mensaje. Intenta más tarde."
+
+# === 1. CLIENTES DE MENSAJES SALIENTES ===
+class ClienteMensajes:
+    """Interfaz para enviar un mensaje de WhatsApp fuera de la respuesta TwiML."""
+
+    def enviar(self, destino, texto):
+        """Envía `texto` a `destino` ('whatsapp:+57...') y retorna un id del mensaje."""
+        raise NotImplementedError
+
+    def enviar_plantilla(self, destino, plantilla, variables):
+        """
+        Envía una plantilla aprobada de WhatsApp (Content SID de Twilio). Es lo
+        único que WhatsApp acepta fuera de las 24 h desde el último mensaje del usuario.
+        """
+        raise NotImplementedError
+
+class ClienteTwilio(ClienteMensajes):
+    """Envía por la API REST de Twilio."""
+
+    def __init__(self, account_sid=None, auth_token=None, remitente=None):
+        from twilio.rest import Client
+        self._cliente = Client(
+            account_sid or os.environ.get("TWILIO_ACCOUNT_SID"),
+            auth_token or os.environ.get("TWILIO_AUTH_TOKEN")
+        )
+        self.remitente = remitente or os.environ.get("TWILIO_WHATSAPP_FROM")
+        if not self.remitente:
+            raise EnvironmentError("TWILIO_WHATSAPP_FROM no configurado: no hay número remitente")
+
+    def enviar(self, destino, texto):
+        mensaje = self._cliente.messages.create(from_=self.remitente, to=destino, body=texto)
+        return mensaje.sid
+
+    def enviar_plantilla(self, destino, plantilla, variables):
+        mensaje = self._cliente.messages.create(
+            from_=self.remitente, to=destino, content_sid=plantilla, content_variables=json.dumps(variables)
+        )
+        return mensaje.sid
+
+class ClienteMensajesLocal(ClienteMensajes):
+    """Stub en memoria para pruebas y desarrollo: guarda lo que se habría enviado."""
+
+    def __init__(self):
+        self.enviados = []
+        self._lock = threading.Lock()
+
+    def enviar(self, destino, texto):
+        with self._lock:
+            self.enviados.append((destino, texto))
+            return f"LOCAL{len(self.enviados)}"
+
+    def enviar_plantilla(self, destino, plantilla, variables):
+        return self.enviar(destino, f"[{plantilla}] {json.dumps(variables, ensure_ascii=False)}")
+
+def crear_cliente_mensajes():
+    """
+    ClienteTwilio si hay credenciales configuradas. El stub local solo con
+    MENSAJERIA_LOCAL=1 (desarrollo y pruebas); sin ninguno de los dos falla al
+    arrancar en vez de descartar las respuestas en silencio.
+    """
+    if os.environ.get("MENSAJERIA_LOCAL") == "1":
+        logger.warning("⚠️ MENSAJERIA_LOCAL=1: los mensajes salientes quedan en ClienteMensajesLocal")
+        return ClienteMensajesLocal()
+    if os.environ.get("TWILIO_ACCOUNT_SID") and os.environ.get("TWILIO_AUTH_TOKEN"):
+        return ClienteTwilio()
+    raise EnvironmentError(
+        "Sin credenciales de Twilio (TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN) para enviar mensajes; "
+        "usa MENSAJERIA_LOCAL=1 solo en desarrollo"
+    )
+
+# === 2. PROCESAMIENTO EN SEGUNDO PLANO ===
+class ProcesadorAsincrono:
+    """
+    Colas en memoria + pool de hilos. El webhook encola y responde de inmediato;
+    los hilos ejecutan `procesar(mensaje, remitente=..., message_sid=...)`, que
+    retorna (respuesta, duplicado), y envían la respuesta por el ClienteMensajes
+    salvo que sea un reintento ya atendido.
+    Cada hilo consume su propia cola y el remitente decide la cola: los mensajes
+    de un mismo número salen en orden (FIFO) y números distintos van en paralelo.
+    """
+
+    def __init__(self, procesar, cliente, hilos=4, max_pendientes=1000):
+        self._procesar = procesar
+        self._cliente = cliente
+        self._colas = [queue.Queue(maxsize=max(1, max_pendientes // hilos)) for _ in range(hilos)]
+        self._lock = threading.Lock()
+        self._stats = {"encolados": 0, "procesados": 0, "errores": 0, "latencia_total_ms": 0.0, "latencia_max_ms": 0.0}
+        self._hilos = [
+            threading.Thread(target=self._trabajar, args=(cola,), name=f"procesador-{i}", daemon=True)
+            for i, cola in enumerate(self._colas)
+        ]
+        for hilo in self._hilos:
+            hilo.start()
+
+    def encolar(self, remitente, mensaje, message_sid=None):
+        """Encola un mensaje entrante; lanza queue.Full si la cola está llena."""
+        cola = self._colas[zlib.crc32((remitente or "").encode("utf-8")) % len(self._colas)]
+        cola.put_nowait((remitente, mensaje, message_sid, time.monotonic()))
+        with self._lock:
+            self._stats["encolados"] += 1
+
+    def _trabajar(self, cola):
+        while True:
+            item = cola.get()
+            if item is None:
+                cola.task_done()
+                break
+            remitente, mensaje, message_sid, recibido = item
+            error = False
+            try:
+                try:
+                    respuesta, duplicado = self._procesar(mensaje, remitente=remitente, message_sid=message_sid)
+                except Exception as e:
+                    logger.error(f"❌ Error procesando mensaje de {remitente}: {e}")
+                    respuesta, duplicado = MENSAJE_ERROR, False
+                    error = True
+                if respuesta and not duplicado:
+                    self._cliente.enviar(remitente, respuesta)
+            except Exception as e:
+                logger.error(f"❌ No se pudo enviar la respuesta a {remitente}: {e}")
+                error = True
+            finally:
+                latencia_ms = (time.monotonic() - recibido) * 1000
+                with self._lock:
+                    self._stats["procesados"] += 1
+                    self._stats["errores"] += int(error)
+                    self._stats["latencia_total_ms"] += latencia_ms
+                    self._stats["latencia_max_ms"] = max(self._stats["latencia_max_ms"], latencia_ms)
+                cola.task_done()
+
+    def esperar(self):
+        """Bloquea hasta que las colas queden vacías (útil en pruebas)."""
+        for cola in self._colas:
+            cola.join()
+
+    def detener(self):
+        for cola in self._colas:
+            cola.put(None)
+        for hilo in self._hilos:
+            hilo.join()
+
+    def estadisticas(self):
+        with self._lock:
+            datos = dict(self._stats)
+        datos["pendientes"] = sum(cola.qsize() for cola in self._colas)
+        datos["hilos"] = len(self._hilos)
+        datos["latencia_promedio_ms"] = round(datos["latencia_total_ms"] / (datos["procesados"] or 1), 3)
+        return datos
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+programador.py - Precalcula el reporte semanal de cada finca activa fuera de hora pico
+Pensado para cron / Heroku Scheduler, p. ej. los lunes a las 4 a.m.:
+    0 4 * * 1  python programador.py --enviar
+El comando "reporte semanal" responde con la copia guardada mientras no haya escrituras nuevas.
+
+Con --enviar (o PROGRAMADOR_ENVIAR=1) además avisa a los dueños por WhatsApp.
+Necesita credenciales de Twilio (MENSAJERIA_LOCAL=1 solo simula el envío).
+WhatsApp rechaza mensajes libres iniciados por el negocio si el dueño no
+escribió en las últimas 24 h: en producción configura PROGRAMADOR_PLANTILLA_SID
+con una plantilla aprobada (Content SID de Twilio) cuya variable {{1}} es el
+nombre de la finca, p. ej. "📅 Tu reporte semanal de {{1}} está listo.
+Escribe 'reporte semanal' para verlo.". Sin plantilla se envía el reporte
+completo como mensaje libre, que solo llega dentro de esa ventana.
+"""
+import os
+import sys
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+import bot
+import mensajeria
+
+PLANTILLA_SID = os.environ.get("PROGRAMADOR_PLANTILLA_SID")
+
+def precalcular_finca(finca_id, nombre, dueños, cliente=None):
+    """
+    Precalcula el reporte semanal de la finca y, si hay cliente, avisa a cada
+    dueño por separado. Retorna (recalculado, enviados, fallidos).
+    """
+    texto, siguiente, recalculado = bot.precalcular_reporte(finca_id, "semanal")
+    enviados = fallidos = 0
+    if cliente is None:
+        return recalculado, enviados, fallidos
+    if siguiente is not None:
+        texto += "\n\n➡️ Escribe 'reporte semanal' y luego 'más' para ver todos los movimientos."
+    for destino in dueños:
+        # Un dueño fuera de la ventana de 24 h no impide avisar a los demás
+        try:
+            if PLANTILLA_SID:
+                cliente.enviar_plantilla(destino, PLANTILLA_SID, {"1": nombre})
+            else:
+                cliente.enviar(destino, texto)
+            enviados += 1
+        except Exception as e:
+            logger.warning(f"⚠️ No se pudo enviar el reporte de la finca {finca_id} a {destino}: {e}")
+            fallidos += 1
+    return recalculado, enviados, fallidos
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    enviar = "--enviar" in argv or os.environ.get("PROGRAMADOR_ENVIAR") == "1"
+    cliente = None
+    if enviar:
+        try:
+            cliente = mensajeria.crear_cliente_mensajes()
+        except EnvironmentError as e:
+            logger.error(f"❌ --enviar sin cliente de Twilio: {e}")
+            return 1
+        if not PLANTILLA_SID:
+            logger.warning("⚠️ Sin PROGRAMADOR_PLANTILLA_SID: solo llegan los reportes a dueños que escribieron en las últimas 24 h")
+    if not bot.preparar_bd():
+        logger.error("❌ No se pudo preparar el esquema; el programador no arranca.")
+        return 1
+    # Acotado para no agotar el pool de conexiones (DB_POOL_MAX) con muchas fincas
+    hilos = int(os.environ.get("PROGRAMADOR_HILOS", "4"))
+    recalculados = enviados = fallidos = errores = 0
+
+    try:
+        fincas = bot.fincas_activas()
+        with ThreadPoolExecutor(max_workers=hilos, thread_name_prefix="programador") as pool:
+            futuros = {
+                pool.submit(precalcular_finca, finca_id, nombre, dueños, cliente): finca_id
+                for finca_id, nombre, dueños in fincas
+            }
+            for futuro in as_completed(futuros):
+                try:
+                    recalculado, n_enviados, n_fallidos = futuro.result()
+                except Exception as e:
+                    logger.error(f"❌ Error con el reporte de la finca {futuros[futuro]}: {e}")
+                    errores += 1
+                    continue
+                recalculados += int(recalculado)
+                enviados += n_enviados
+                fallidos += n_fallidos
+    finally:
+        bot.cerrar_pool()
+
+    destino_envio = " (simulados en ClienteMensajesLocal)" if isinstance(cliente, mensajeria.ClienteMensajesLocal) else ""
+    logger.info(
+        f"✅ Reportes semanales: {len(fincas)} fincas, {recalculados} recalculados, "
+        f"{len(fincas) - recalculados - errores} ya al día, {errores} errores; "
+        f"envíos: {enviados} enviados{destino_envio}, {fallidos} fallidos"
+    )
+    return 1 if errores else 0
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""
+test_clasificador.py - Especie del clasificador de palabras clave (no toca la base de datos)
+Uso: python -m pytest -q test_clasificador.py
+"""
+import pytest
+
+import bot
+
+@pytest.mark.parametrize("texto", [
+    "novillo de ceba",
+    "ganado de ceba",
+    "cebada para las vacas",
+])
+def test_ceba_no_es_porcino(texto):
+    assert bot.clasificar_texto(texto).especie == "bovino"
+    assert bot.extraer_datos_animal(texto)["especie"] == "bovino"
+
+def test_cebada_no_es_categoria():
+    assert bot.clasificar_texto("cebada").categoria is None
+    assert bot.clasificar_texto("10 de ceba").categoria == "ceba"
+
+def test_bovino_explicito_gana_a_porcino_ambiguo():
+    assert bot.clasificar_texto("vaca con garrapatas en las cerdas de la cola").especie == "bovino"
+    assert bot.clasificar_texto("cerdas de ceba").especie == "porcino"
+    assert bot.clasificar_texto("vacas y lechones").especie == "porcino"
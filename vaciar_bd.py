@@ -17,8 +17,10 @@ def vaciar_tablas():
         # Vaciar todas las tablas (en orden correcto por dependencias)
         tablas = [
             "salud_animal",
-            "produccion",
+            "pesajes",
             "registros",
+            "finca_resumen_diario",
+            "reportes_precalculados",
             "animales"
         ]
 
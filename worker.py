@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+worker.py - Procesa la cola durable inbound_messages (WEBHOOK_MODO=cola)
+Escala agregando procesos: cada uno toma trabajos con FOR UPDATE SKIP LOCKED.
+"""
+import os
+import signal
+import threading
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+import bot
+import mensajeria
+
+_DETENER = threading.Event()
+
+def procesar_trabajo(trabajo, cliente):
+    """Ejecuta un mensaje de la cola, envía la respuesta y cierra el trabajo."""
+    try:
+        # Si un worker murió a mitad de este mensaje, el SID ya está reclamado
+        # y no se repiten las escrituras al reintentarlo.
+        respuesta, duplicado = bot.procesar_mensaje_idempotente(
+            trabajo["cuerpo"], remitente=trabajo["remitente"], message_sid=trabajo["message_sid"]
+        )
+    except Exception as e:
+        logger.error(f"❌ Error procesando mensaje {trabajo['id']}: {e}")
+        # Cerrar el trabajo y avisar al usuario por separado: si falla el aviso, el trabajo igual queda cerrado
+        try:
+            bot.finalizar_mensaje_entrante(trabajo["id"], respuesta=mensajeria.MENSAJE_ERROR, error=f"{type(e).__name__}: {e}")
+        except Exception as e2:
+            logger.error(f"❌ No se pudo cerrar el mensaje {trabajo['id']}: {e2}")
+        try:
+            cliente.enviar(trabajo["remitente"], mensajeria.MENSAJE_ERROR)
+        except Exception as e2:
+            logger.error(f"❌ No se pudo avisar el error del mensaje {trabajo['id']}: {e2}")
+        return
+    if respuesta is None and duplicado:
+        # Otro intento tiene el SID reclamado y aún no respondió: no se cierra como
+        # 'ok' sin respuesta. Queda 'procesando' y reencolar_mensajes_colgados lo
+        # devuelve a la cola cuando el reclamo ya venció.
+        logger.warning(f"⚠️ Mensaje {trabajo['id']} con el SID reclamado por otro intento; se reintentará")
+        return
+    error_envio = None
+    if respuesta and not duplicado:
+        try:
+            cliente.enviar(trabajo["remitente"], respuesta)
+        except Exception as e:
+            logger.error(f"❌ No se pudo enviar la respuesta del mensaje {trabajo['id']}: {e}")
+            error_envio = f"envío: {e}"
+    bot.finalizar_mensaje_entrante(trabajo["id"], respuesta=respuesta, error=error_envio)
+
+def bucle_trabajo(cliente, espera):
+    """Toma trabajos hasta que se pida detener; duerme `espera` segundos si la cola está vacía."""
+    while not _DETENER.is_set():
+        # Ningún error (BD, Twilio) debe matar el hilo: se registra y se sigue
+        try:
+            trabajo = bot.tomar_mensaje_entrante()
+            if trabajo is None:
+                _DETENER.wait(espera)
+                continue
+            procesar_trabajo(trabajo, cliente)
+        except Exception as e:
+            logger.error(f"❌ Error en el bucle de la cola: {e}")
+            _DETENER.wait(espera)
+
+def main():
+    if not bot.preparar_bd():
+        logger.error("❌ No se pudo preparar el esquema; el worker no arranca.")
+        return 1
+    try:
+        cliente = mensajeria.crear_cliente_mensajes()
+    except EnvironmentError as e:
+        logger.error(f"❌ {e}; el worker no arranca.")
+        return 1
+    hilos = int(os.environ.get("COLA_HILOS", "4"))
+    espera = float(os.environ.get("COLA_ESPERA", "0.5"))
+
+    signal.signal(signal.SIGTERM, lambda *_: _DETENER.set())
+    signal.signal(signal.SIGINT, lambda *_: _DETENER.set())
+
+    trabajadores = [
+        threading.Thread(target=bucle_trabajo, args=(cliente, espera), name=f"cola-{i}", daemon=True)
+        for i in range(hilos)
+    ]
+    for t in trabajadores:
+        t.start()
+    logger.info(f"✅ Worker de cola iniciado con {hilos} hilos")
+
+    # Rescate periódico de trabajos colgados por workers caídos
+    while not _DETENER.is_set():
+        try:
+            rescatados = bot.reencolar_mensajes_colgados()
+            if rescatados:
+                logger.warning(f"⚠️ {rescatados} mensajes colgados devueltos a la cola")
+        except Exception as e:
+            logger.error(f"❌ Error al reencolar mensajes colgados: {e}")
+        _DETENER.wait(30)
+
+    for t in trabajadores:
+        t.join()
+    bot.cerrar_pool()
+    logger.info("🛑 Worker de cola detenido")
+    return 0
+
+if __name__ == "__main__":
+    exit(main())